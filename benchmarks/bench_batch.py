@@ -0,0 +1,44 @@
+"""
+Time taken to configure a display with twenty commands, sent one by one
+and in a :meth:`pyds9.DS9.batch`.
+
+Usage::
+
+    python benchmarks/bench_batch.py [target] [count]
+
+A ds9 instance matching ``target`` (default: ``DS9:*``) must be running on
+this host.
+"""
+from __future__ import print_function
+
+import sys
+
+from pyds9 import DS9
+
+from bench_persistent import timeit
+
+COMMANDS = (['scale zscale', 'cmap heat', 'zoom to fit', 'pan to 100 100',
+             'grid no'] +
+            ['regions command {circle %d %d 10}' % (10 * i, 10 * i)
+             for i in range(15)])
+
+
+def main(target='DS9:*', count=20):
+    d = DS9(target, start=False)
+
+    def one_by_one():
+        for command in COMMANDS:
+            d.set(command)
+
+    def batched():
+        with d.batch():
+            one_by_one()
+
+    print('one by one %8.2f ms' % timeit(one_by_one, count))
+    print('batched    %8.2f ms' % timeit(batched, count))
+    d.set('regions delete all')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'DS9:*',
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20)
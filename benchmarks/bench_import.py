@@ -0,0 +1,47 @@
+"""
+Time taken by ``import pyds9`` in a fresh interpreter, on top of the import
+of numpy that it needs anyway.
+
+Usage::
+
+    python benchmarks/bench_import.py [count] [threshold_ms]
+
+Exits with status 1 if the median overhead of pyds9 over numpy is above
+``threshold_ms`` (default: 150 ms), so that it can be used to catch
+regressions, e.g. an eager import of astropy.
+"""
+from __future__ import print_function
+
+import statistics
+import subprocess
+import sys
+
+CODE = ('import time; start = time.perf_counter(); import {}; '
+        'print(time.perf_counter() - start)')
+
+
+def import_time(module, count):
+    """Return the median time to import ``module``, in milliseconds"""
+    times = []
+    for _ in range(count):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       CODE.format(module)],
+                                      stderr=subprocess.DEVNULL)
+        times.append(float(out.decode().split()[-1]) * 1e3)
+    return statistics.median(times)
+
+
+def main(count=10, threshold=150.):
+    numpy_ms = import_time('numpy', count)
+    pyds9_ms = import_time('pyds9', count)
+    overhead = pyds9_ms - numpy_ms
+    print('import numpy %8.1f ms' % numpy_ms)
+    print('import pyds9 %8.1f ms (%.1f ms on top of numpy, threshold %.1f '
+          'ms)' % (pyds9_ms, overhead, threshold))
+    return overhead <= threshold
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 150.
+    sys.exit(0 if main(count, threshold) else 1)
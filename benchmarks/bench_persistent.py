@@ -0,0 +1,55 @@
+"""
+Per-command latency of small ds9 commands, with and without a persistent xpa
+connection.
+
+Usage::
+
+    python benchmarks/bench_persistent.py [target] [count]
+
+A ds9 instance matching ``target`` (default: ``DS9:*``) must be running.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from pyds9 import DS9, xpa
+
+
+def timeit(func, count):
+    """Return the mean time per call of ``func``, in milliseconds"""
+    func()
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) / count * 1e3
+
+
+def main(target='DS9:*', count=1000):
+    d = DS9(target, start=False)
+    tid = d.id.encode()
+    handle = xpa.XPAOpen(None)
+    try:
+        results = [
+            ('xpaget, new connection per call',
+             lambda: xpa.xpaget(tid, b'frame', 1)),
+            ('xpaget, persistent connection',
+             lambda: xpa.xpaget(tid, b'frame', 1, xpa=handle)),
+            ('DS9.get, verify=True', lambda: d.get('frame')),
+        ]
+        d_noverify = DS9(d.id, start=False, verify=False)
+        results.append(('DS9.get, verify=False',
+                        lambda: d_noverify.get('frame')))
+        d_ttl = DS9(d.id, start=False, verify_ttl=5)
+        results.append(('DS9.get, verify_ttl=5',
+                        lambda: d_ttl.get('frame')))
+        for name, func in results:
+            print('%-35s %8.3f ms/command' % (name, timeit(func, count)))
+    finally:
+        xpa.XPAClose(handle)
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else 'DS9:*'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(target, count)
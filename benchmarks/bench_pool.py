@@ -0,0 +1,49 @@
+"""
+Latency of a short job (a few commands) that starts its own ds9, and of the
+same job run on a ds9 leased from a :class:`pyds9.DS9Pool`.
+
+Usage::
+
+    python benchmarks/bench_pool.py [count]
+
+ds9 must be in the PATH.
+"""
+from __future__ import print_function
+
+import itertools
+import sys
+
+from pyds9 import DS9, DS9Pool
+
+from bench_persistent import timeit
+
+
+def job(d):
+    d.set('cmap heat')
+    d.set('scale log')
+    return d.get('frame')
+
+
+def main(count=10):
+    numbers = itertools.count()
+
+    def own_ds9():
+        d = DS9('bench_pool_own%d' % next(numbers))
+        try:
+            job(d)
+        finally:
+            d.set('exit')
+            d.close()
+
+    print('own ds9    %8.1f ms/job' % timeit(own_ds9, count))
+    with DS9Pool(2, prefix='bench_pool') as pool:
+        def leased():
+            with pool.lease() as d:
+                job(d)
+
+        print('leased ds9 %8.1f ms/job' % timeit(leased, count * 10))
+        print('utilization %.2f' % pool.stats()['utilization'])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,65 @@
+"""
+Time taken to draw 1k, 100k and 1M circles, from a region string built by
+a Python loop and sent with ``DS9.set``, and with :meth:`DS9.set_regions`.
+
+Usage::
+
+    python benchmarks/bench_regions.py [target]
+
+Without ``target``, only the formatting of the regions is timed. Otherwise,
+a ds9 instance matching ``target`` must be running: the regions are drawn,
+then deleted.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy
+
+from pyds9 import DS9
+from pyds9.pyds9 import REGIONS_CHUNK, _region_lines
+
+
+def loop_regions(x, y, r):
+    return 'image\n' + ''.join('circle(%.3f,%.3f,%.3f)\n' % row
+                               for row in zip(x.tolist(), y.tolist(),
+                                              r.tolist()))
+
+
+def vectorized_regions(x, y, r):
+    # in chunks, as set_regions does
+    return b'image\n' + b''.join(
+        _region_lines('circle', [c[start:start + REGIONS_CHUNK]
+                                 for c in (x, y, r)], None, 3)
+        for start in range(0, len(x), REGIONS_CHUNK))
+
+
+def elapsed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1e3
+
+
+def main(target=None):
+    d = None if target is None else DS9(target, start=False)
+    for n in (1000, 100000, 1000000):
+        x, y = numpy.random.random((2, n)) * 4096
+        r = numpy.random.random(n) * 10 + 1
+        print('%8d regions' % n)
+        print('  format, loop       %10.1f ms' %
+              elapsed(loop_regions, x, y, r))
+        print('  format, vectorized %10.1f ms' %
+              elapsed(vectorized_regions, x, y, r))
+        if d is None:
+            continue
+        print('  set, loop          %10.1f ms' % elapsed(
+            lambda: d.set('regions', loop_regions(x, y, r))))
+        d.set('regions delete all')
+        print('  set_regions        %10.1f ms' % elapsed(
+            lambda: d.set_regions(x=x, y=y, r=r)))
+        d.set('regions delete all')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
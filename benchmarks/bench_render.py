@@ -0,0 +1,53 @@
+"""
+Throughput of :func:`pyds9.render_many`, turning FITS files into png
+images, with pools of 1, 2 and 4 ds9 instances, and each xpa backend.
+
+Usage::
+
+    python benchmarks/bench_render.py [count] [xpa_backend ...]
+
+The throughput should grow with the number of ds9 instances, with either
+backend: each ds9 connection has its own copy of libxpa. ds9 must be in the
+PATH.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+import numpy
+
+from pyds9 import render_many, set_xpa_backend
+
+
+def main(count=100, backends=('libxpa', 'asyncio')):
+    tmpdir = tempfile.mkdtemp()
+    paths = [os.path.join(tmpdir, 'image%d.fits' % i) for i in range(8)]
+    for path in paths:
+        data = numpy.random.random((1024, 1024)).astype(numpy.float32)
+        fits.PrimaryHDU(data).writeto(path)
+    settings = {'scale': 'zscale', 'cmap': 'heat'}
+    for backend in backends:
+        set_xpa_backend(backend)
+        for workers in (1, 2, 4):
+            inputs = (paths[i % len(paths)] for i in range(count))
+            results = render_many(inputs, settings, workers=workers,
+                                  prefix='bench_render%d.' % workers)
+            # the pool starts with the first image
+            next(results)
+            start = time.perf_counter()
+            n = sum(1 for _ in results)
+            elapsed = time.perf_counter() - start
+            print('%-8s %d ds9 %8.1f images/s' % (backend, workers,
+                                                  n / elapsed))
+    for path in paths:
+        os.remove(path)
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+         sys.argv[2:] or ('libxpa', 'asyncio'))
@@ -0,0 +1,40 @@
+"""
+Frame rate of set_np2arr for a stream of frames, through the xpa socket and
+through a shared memory segment.
+
+Usage::
+
+    python benchmarks/bench_shm.py [target] [count]
+
+A ds9 instance matching ``target`` (default: ``DS9:*``) must be running on
+the same host.
+"""
+from __future__ import print_function
+
+import sys
+
+import numpy
+
+from pyds9 import DS9
+
+from bench_persistent import timeit
+
+
+def main(target='DS9:*', count=20):
+    d = DS9(target, start=False)
+    try:
+        for side in (512, 2048):
+            frame = numpy.random.random((side, side)).astype(numpy.float32)
+            for transport in ('xpa', 'shm'):
+                ms = timeit(lambda: d.set_np2arr(frame, transport=transport),
+                            count)
+                print('%4dx%-4d %-4s %8.2f ms/frame %8.1f fps' %
+                      (side, side, transport, ms, 1e3 / ms))
+    finally:
+        d.close()
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else 'DS9:*'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(target, count)
@@ -0,0 +1,49 @@
+"""
+Command latency and array throughput of a ds9 started with the xpa inet
+method (tcp sockets) and with the local method (unix sockets).
+
+Usage::
+
+    python benchmarks/bench_xpa_method.py [count]
+
+Two ds9 instances are started, and stopped at the end: ds9 must be in the
+PATH and xpans must be running.
+"""
+from __future__ import print_function
+
+import sys
+
+import numpy
+
+from pyds9 import DS9, ds9Globals
+
+from bench_persistent import timeit
+
+
+def start(title, method):
+    ds9Globals['xpa_method'] = method
+    try:
+        return DS9(title)
+    finally:
+        ds9Globals['xpa_method'] = 'inet'
+
+
+def main(count=1000):
+    instances = [start('bench_inet', 'inet'), start('bench_local', 'local')]
+    try:
+        frame = numpy.random.random((2048, 2048)).astype(numpy.float32)
+        for d in instances:
+            ms = timeit(lambda: d.get('frame'), count)
+            print('%-6s %8.3f ms/command' % (d.method, ms))
+        for d in instances:
+            ms = timeit(lambda: d.set_np2arr(frame), max(count // 100, 5))
+            print('%-6s %8.2f ms/frame  %8.1f MB/s' %
+                  (d.method, ms, frame.nbytes / ms / 1e3))
+    finally:
+        for d in instances:
+            d.set('exit')
+            d.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,46 @@
+"""
+Per-call overhead of the xpa bindings, for a growing maximum number of
+access points ``n``.
+
+Usage::
+
+    python benchmarks/bench_xpacall.py [target] [count]
+
+A ds9 instance matching ``target`` (default: ``DS9:*``) must be running.
+The calls go through a persistent xpa connection, so that the time is
+dominated by the bindings rather than by connection setup.
+"""
+from __future__ import print_function
+
+import sys
+
+from pyds9 import ds9_targets, xpa
+
+from bench_persistent import timeit
+
+
+def main(target='DS9:*', count=1000):
+    tid = ds9_targets(target)[0].split()[1].encode()
+    handle = xpa.XPAOpen(None)
+    try:
+        for n in (1, 16, 1024):
+            results = [
+                ('xpaget', lambda: xpa.xpaget(tid, b'frame', n, xpa=handle)),
+                ('xpaset', lambda: xpa.xpaset(tid, b'frame 1', None, -1, n,
+                                              xpa=handle)),
+                ('xpaaccess', lambda: xpa.xpaaccess(tid, None, n,
+                                                    xpa=handle)),
+            ]
+            for name, func in results:
+                print('%-10s n=%-5d %8.3f ms/call' %
+                      (name, n, timeit(func, count)))
+        print('%-18s %8.3f ms/call' %
+              ('ds9_targets()', timeit(lambda: ds9_targets(target), count)))
+    finally:
+        xpa.XPAClose(handle)
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else 'DS9:*'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(target, count)
@@ -18,3 +18,4 @@ from ._astropy_init import *
 # For egg_info test builds to pass, put package imports here.
 if not _ASTROPY_SETUP_:
     from .pyds9 import *
+    from .pool import *
@@ -0,0 +1,839 @@
+"""
+Pure-Python implementation of the XPA client protocol, on top of asyncio
+
+The access points (e.g. ds9) are looked up in the xpans name server, then each
+request goes through a command channel to the access point and, when data are
+exchanged, a data channel, as in libxpa's ``client.c``. No compiled code is
+involved.
+
+The coroutines :func:`get`, :func:`set`, :func:`info` and :func:`access` never
+block the event loop, serve all the matching access points concurrently, and
+can be cancelled at any time: the connections used by a cancelled request are
+closed. The synchronous functions (:func:`xpaget`, :func:`xpaset`, ...) have
+the same signatures and results as those of :mod:`pyds9.xpa`, so that this
+module can replace it (see :func:`pyds9.set_xpa_backend`); they run the
+coroutines in an event loop private to the calling thread, or in a helper
+thread if the calling thread is already running an event loop.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import itertools
+import os
+import socket
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pwd
+except ImportError:
+    # e.g. on Windows
+    pwd = None
+
+__all__ = ['AccessPoint', 'Client', 'lookup', 'get', 'set', 'info', 'access',
+           'unix_method', 'tmpdir', 'XPAOpen', 'XPAClose', 'xpaget',
+           'xpagetbuf', 'xpagetall', 'xpagetfd', 'xpaset', 'xpasetall',
+           'xpasetfd', 'xpainfo', 'xpaaccess']
+
+# default value for n (max number of access points)
+xpa_n = 1024
+
+# version of the protocol announced to xpans
+XPA_VERSION = '2.1.17'
+
+# defaults of libxpa for the name server and the temporary directory
+XPA_NSPORT = 14285
+XPA_TMPDIR = '/tmp/.xpa'
+
+# size of the chunks sent and received through the data channels
+CHUNK_SIZE = 1 << 18
+
+
+class AccessPoint(collections.namedtuple('AccessPoint',
+                                         'xclass name method info')):
+    """An access point, as returned by the name server"""
+
+    @property
+    def fullname(self):
+        """The "class:name method" of the access point"""
+        return '%s:%s %s' % (self.xclass, self.name, self.method)
+
+
+def _timeout(name, default):
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _short_timeout():
+    return _timeout('XPA_SHORT_TIMEOUT', 15)
+
+
+def _long_timeout():
+    return _timeout('XPA_LONG_TIMEOUT', 180)
+
+
+def unix_method():
+    """Whether XPA_METHOD asks for unix sockets"""
+    method = os.environ.get('XPA_METHOD', 'inet').lower()
+    return method in ('unix', 'local') and hasattr(socket, 'AF_UNIX')
+
+
+def tmpdir():
+    """The directory of the unix sockets of the xpa local method"""
+    for name in ('XPA_TMPDIR', 'TMPDIR', 'TMP'):
+        if os.environ.get(name):
+            return os.environ[name]
+    return XPA_TMPDIR
+
+
+def _users():
+    """The users whose access points are looked up"""
+    users = os.environ.get('XPA_NSUSERS') or os.environ.get('LOGNAME')
+    if not users and pwd is not None:
+        try:
+            users = pwd.getpwuid(os.geteuid()).pw_name
+        except KeyError:
+            pass
+    return users or '*'
+
+
+def _ns_method(flag=0):
+    """The method of the name server (see XPANSMethod in libxpa)
+
+    With ``flag`` 0, the channel used to look up access points; with ``flag``
+    1, the access point of xpans itself.
+    """
+    if unix_method():
+        method = (os.environ.get('XPA_NSUNIX') or
+                  os.path.join(tmpdir(), 'xpans_unix'))
+        if flag:
+            head, tail = os.path.split(method)
+            method = os.path.join(head, tail.rsplit('.', 1)[0] + '.xpa-%d' %
+                                  flag)
+        return method
+    method = os.environ.get('XPA_NSINET', '$host:$port')
+    if flag:
+        host, _, ports = method.rpartition(':')
+        ports = ports.split(',')
+        if len(ports) > flag:
+            port = ports[flag]
+        else:
+            port = _parse_port(ports[0]) + flag
+        method = '%s:%s' % (host, port)
+    return method
+
+
+def _parse_port(port):
+    if port == '$port':
+        return XPA_NSPORT
+    return int(port, 0)
+
+
+@functools.lru_cache(maxsize=None)
+def _host_ip():
+    """The ip of this host"""
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return '127.0.0.1'
+
+
+def _parse_ip_port(method):
+    """Return the (ip, port) of an inet method, as XPAParseIpPort, or None
+
+    The ip can be given in hexadecimal (as in the methods registered in
+    xpans), as a host name, or as ``$host`` or ``$localhost``.
+    """
+    host, sep, port = method.split(',', 1)[0].partition(':')
+    if not sep:
+        host, port = '', host
+    try:
+        port = _parse_port(port)
+    except ValueError:
+        return None
+    if not 0 < port < 65536:
+        return None
+    try:
+        return socket.inet_ntoa(struct.pack('!I', int(host, 16))), port
+    except (ValueError, struct.error):
+        pass
+    if host in ('', '$host'):
+        return _host_ip(), port
+    if host == '$localhost':
+        return '127.0.0.1', port
+    try:
+        return socket.gethostbyname(host), port
+    except OSError:
+        return None
+
+
+def _to_str(s):
+    if s is None:
+        return ''
+    if isinstance(s, bytes):
+        return s.decode('utf-8')
+    return s
+
+
+class _Channel(object):
+    """A connection to a server, made to ``ip`` (None for unix sockets)"""
+
+    def __init__(self, reader, writer, ip):
+        self.reader = reader
+        self.writer = writer
+        self.ip = ip
+        self.loop = asyncio.get_running_loop()
+
+    async def writeline(self, line):
+        self.writer.write(line.encode('utf-8') + b'\n')
+        if self.writer.transport.get_write_buffer_size():
+            await asyncio.wait_for(self.writer.drain(), _short_timeout())
+
+    async def readline(self, timeout):
+        """Return the next line, stripped, or None at the end of file"""
+        line = await asyncio.wait_for(self.reader.readline(), timeout)
+        if not line:
+            return None
+        return line.decode('utf-8', 'replace').strip()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except RuntimeError:
+            # its event loop is already closed: the socket is closed when the
+            # transport is garbage collected
+            pass
+
+
+async def _open(method, ip=None):
+    """Open a channel to an inet ("ip:port") or unix (path) method
+
+    The channel goes to ``ip``, if given, rather than to the ip of the
+    method. Raises OSError if the server cannot be reached.
+    """
+    timeout = _short_timeout()
+    if ':' not in method:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(method, limit=CHUNK_SIZE), timeout)
+        return _Channel(reader, writer, None)
+    address = _parse_ip_port(method)
+    if address is None:
+        raise OSError('invalid xpa method: %s' % method)
+    host, port = address
+    if ip is not None:
+        hosts = [ip]
+    elif host == _host_ip():
+        # use the loopback first, as libxpa does
+        hosts = ['127.0.0.1', host]
+    else:
+        hosts = [host]
+    for host in hosts:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=CHUNK_SIZE),
+                timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            error = exc
+        else:
+            return _Channel(reader, writer, host)
+    raise OSError(str(error))
+
+
+class _Stale(Exception):
+    """A channel kept by a client turned out to be closed by the server"""
+
+
+class Client(object):
+    """Connections kept open between requests
+
+    Passing the same client to successive calls (the ``client`` argument of
+    the coroutines, or the handle returned by :func:`XPAOpen` for the
+    synchronous functions) reuses the connection to the name server and the
+    command channels to the access points, like a persistent libxpa handle.
+
+    The connections belong to the event loop that opened them: they are
+    dropped if the client is used by another loop. Connections are removed
+    from the client while a request uses them, so concurrent requests never
+    share one. In a forked child process, the connections inherited from the
+    parent are left alone: they are still used by the parent.
+    """
+
+    def __init__(self):
+        self._idle = collections.defaultdict(list)
+        self._loop = None
+        self._pid = os.getpid()
+
+    def _checkout(self, key):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._pid != os.getpid():
+            self.close()
+            self._loop = loop
+        idle = self._idle.get(key)
+        return idle.pop() if idle else None
+
+    def _checkin(self, key, channel):
+        if channel.loop is self._loop:
+            self._idle[key].append(channel)
+        else:
+            channel.close()
+
+    def close(self):
+        """Close all the connections"""
+        if self._pid != os.getpid():
+            # closing them would unregister the sockets from the selector
+            # that the parent shares with us
+            self._idle = collections.defaultdict(list)
+            self._pid = os.getpid()
+            return
+        for channels in self._idle.values():
+            for channel in channels:
+                channel.close()
+        self._idle.clear()
+
+
+@contextlib.contextmanager
+def _client(client):
+    """Yield ``client``, or a temporary client if it is None"""
+    if client is not None:
+        yield client
+        return
+    client = Client()
+    try:
+        yield client
+    finally:
+        client.close()
+
+
+async def _using(client, key, open_, func):
+    """Return ``await func(channel, reused)``, on an idle channel of
+    ``client`` or a new one opened by ``open_()``
+
+    ``func`` returns its result and whether the channel can be reused. A
+    reused channel found closed (``func`` raises _Stale) is replaced with a
+    new one. The channel is closed if ``func`` fails or is cancelled.
+    """
+    while True:
+        channel = client._checkout(key)
+        reused = channel is not None
+        if channel is None:
+            channel = await open_()
+        try:
+            result, keep = await func(channel, reused)
+        except _Stale:
+            channel.close()
+            continue
+        except BaseException:
+            channel.close()
+            raise
+        if keep:
+            client._checkin(key, channel)
+        else:
+            channel.close()
+        return result
+
+
+async def _open_ns():
+    """Open a channel to the name server"""
+    channel = await _open(_ns_method())
+    try:
+        await channel.writeline('version %s' % XPA_VERSION)
+        # XPA$VERSION <version of xpans>
+        await channel.readline(_short_timeout())
+    except BaseException:
+        channel.close()
+        raise
+    return channel
+
+
+async def lookup(template, type='*', client=None):
+    """Return the access points matching ``template``
+
+    ``type`` restricts the search to the access points accepting get
+    (``'g'``), set (``'s'``) or info (``'i'``) requests. As in libxpa, an
+    "ip:port" or unix socket template designates an access point without
+    asking the name server, and ``xpans`` designates the name server itself.
+
+    Returns
+    -------
+    list of :class:`AccessPoint`
+        empty if the name server cannot be reached
+    """
+    template = _to_str(template)
+    if template == 'xpans':
+        return [AccessPoint('XPANS', 'xpans', _ns_method(1), 'NONE')]
+    if ((':' in template and _parse_ip_port(template)) or
+            (template.startswith(tmpdir()) and os.path.exists(template))):
+        return [AccessPoint('?', '?', template, 'NONE')]
+
+    async def find(channel, reused):
+        points = []
+        for word in template.split():
+            xclass, sep, name = word.partition(':')
+            if not sep:
+                xclass, name = '*', word
+            try:
+                await channel.writeline('lookup %s:%s %s %s' % (
+                    xclass or '*', name or '*', type, _users()))
+                line = await channel.readline(_short_timeout())
+            except OSError:
+                line = None
+            if line is None and reused:
+                raise _Stale()
+            # the matches end with a XPA$<status> line
+            while line is not None and not line.startswith('XPA$'):
+                fields = line.split()
+                if len(fields) >= 4:
+                    info = fields[5] if len(fields) > 5 else 'NONE'
+                    points.append(AccessPoint(fields[0], fields[1],
+                                              fields[3], info))
+                line = await channel.readline(_short_timeout())
+            if line is None:
+                return points, False
+        return points, True
+
+    with _client(client) as client:
+        try:
+            return await _using(client, 'xpans', _open_ns, find)
+        except (OSError, asyncio.TimeoutError):
+            return []
+
+
+# ids of the requests, as in libxpa: the first letter of the type and a count
+_ids = itertools.count(1)
+
+# access point types looked up for each request
+_LOOKUP_TYPES = {'xpaget': 'g', 'xpaset': 's', 'xpainfo': 'i',
+                 'xpaaccess': '*'}
+
+
+async def _reply(channel, tid, timeout):
+    """Return the next line for the request ``tid``, without the id, or None
+    at the end of file; lines of other requests are skipped"""
+    while True:
+        line = await channel.readline(timeout)
+        if line is None:
+            return None
+        rid, _, rest = line.partition(' ')
+        if rid == tid:
+            return rest
+
+
+async def _request(client, point, cmd, paramlist, transfer=None):
+    """Send the ``cmd`` request to ``point``
+
+    ``transfer`` is awaited with the data channel, if the access point opens
+    one. Raises OSError if the access point cannot be reached.
+
+    Returns
+    -------
+    (error, reply)
+        the error message (None on success) and the final line sent by the
+        access point (None if it sent none)
+    """
+    where = '(%s)' % point.fullname
+
+    async def exchange(channel, reused):
+        tid = '%s%d' % (cmd[3], next(_ids))
+        line = '%s -e %s -i %s %s:%s' % (cmd, sys.byteorder, tid,
+                                         point.xclass, point.name)
+        if paramlist:
+            line += ' ' + paramlist
+        try:
+            await channel.writeline(line)
+            reply = await _reply(channel, tid, _short_timeout())
+        except (OSError, asyncio.TimeoutError):
+            reply = None
+        if reply is None:
+            if reused:
+                raise _Stale()
+            return ('XPA$ERROR: no response from server during handshake %s'
+                    % where, None), False
+        status, _, rest = reply.partition(' ')
+        words = rest.split()
+        if status in ('XPA$NODATA', 'XPA$NOBUF'):
+            method = None
+        elif status == 'XPA$DATA' and words[:1] == ['connect']:
+            method = point.method
+            request = 'xpadata -f %s %s' % tuple((words[1:3] + ['?'] * 2)[:2])
+        elif status == 'XPA$BUF' and words:
+            # protocol 2.0 and 2.1: data channel without request
+            method = words[0]
+            request = None
+        else:
+            # the access point closes the channel after a refusal
+            return (rest, None), False
+        try:
+            await channel.writeline('xpanagle')
+            if method is not None:
+                data = await _open(method, channel.ip)
+                try:
+                    if request:
+                        await data.writeline(request)
+                    await transfer(data)
+                finally:
+                    data.close()
+            reply = await _reply(channel, tid, _long_timeout())
+        except (OSError, asyncio.TimeoutError) as exc:
+            return ('XPA$ERROR: %s %s' % (str(exc) or 'timeout', where),
+                    None), False
+        if reply is None:
+            # no reply from the server callback: assume it is ok
+            return (None, None), False
+        if reply.startswith('XPA$OK'):
+            return (None, reply), True
+        return (reply, reply), True
+
+    return await _using(client, point.method,
+                        lambda: _open(point.method), exchange)
+
+
+async def _requests(template, cmd, paramlist, n, client, send):
+    """Send a request to each of the (up to ``n``) access points matching
+    ``template``, concurrently
+
+    ``send(client, point, paramlist)`` sends the ``cmd`` request to one
+    access point and returns its reply. Access points that cannot be reached
+    are skipped, as in libxpa.
+    """
+    paramlist = _to_str(paramlist)
+
+    async def one(point):
+        try:
+            return await send(client, point, paramlist)
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+    with _client(client) as client:
+        points = (await lookup(template, _LOOKUP_TYPES[cmd], client))[:abs(n)]
+        if len(points) == 1:
+            replies = [await one(points[0])]
+        else:
+            replies = await asyncio.gather(*[one(point) for point in points])
+    return [reply for reply in replies if reply is not None]
+
+
+async def _receive(channel, write):
+    """Pass the data read from ``channel`` to ``write`` until the end of
+    file; ``write`` may return an awaitable"""
+    timeout = _long_timeout()
+    while True:
+        chunk = await asyncio.wait_for(channel.reader.read(CHUNK_SIZE),
+                                       timeout)
+        if not chunk:
+            return
+        result = write(chunk)
+        if result is not None:
+            await result
+
+
+async def _send(channel, chunks):
+    """Send the chunks of data from the async iterable ``chunks``"""
+    timeout = _long_timeout()
+    async for chunk in chunks:
+        channel.writer.write(chunk)
+        await asyncio.wait_for(channel.writer.drain(), timeout)
+
+
+async def _buffer_chunks(view):
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield view[start:start + CHUNK_SIZE]
+
+
+async def _fd_chunks(fd):
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, os.read, fd, CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+async def get(template, paramlist=None, n=xpa_n, client=None):
+    """Get data from the access points matching ``template``
+
+    Returns
+    -------
+    list of (name, data, error) tuples
+        one per access point (up to ``n``): ``name`` is its "class:name
+        method", ``data`` the bytearray it returned (None on error) and
+        ``error`` its error message (None on success)
+    """
+    async def send(client, point, paramlist):
+        data = bytearray()
+        error, _ = await _request(
+            client, point, 'xpaget', paramlist,
+            lambda channel: _receive(channel, data.extend))
+        return point.fullname, None if error else data, error
+
+    return await _requests(template, 'xpaget', paramlist, n, client, send)
+
+
+async def _getfd(template, paramlist, fds, n, client):
+    """Like get, but write the data to the file descriptors ``fds``
+
+    With a negative ``n``, all the replies go to ``fds[0]``: each one is then
+    written once complete, between markers if there are several.
+    """
+    loop = asyncio.get_running_loop()
+    points = []
+
+    async def send(client, point, paramlist):
+        points.append(point)
+        if n >= 0:
+            fd = fds[len(points) - 1]
+            error, _ = await _request(
+                client, point, 'xpaget', paramlist,
+                lambda channel: _receive(channel, functools.partial(
+                    loop.run_in_executor, None, _write_all, fd)))
+            return point.fullname, error
+        data = bytearray()
+        error, _ = await _request(
+            client, point, 'xpaget', paramlist,
+            lambda channel: _receive(channel, data.extend))
+        if len(points) > 1:
+            data[:0] = ('XPA$BEGIN %s\n' % point.fullname).encode()
+            data += ('XPA$END   %s\n' % point.fullname).encode()
+        await loop.run_in_executor(None, _write_all, fds[0], data)
+        return point.fullname, error
+
+    n = min(n, len(fds)) if n >= 0 else n
+    return await _requests(template, 'xpaget', paramlist, n, client, send)
+
+
+async def set(template, paramlist=None, buf=None, n=xpa_n, client=None):
+    """Send ``paramlist`` and the data in ``buf`` (any C-contiguous object
+    supporting the buffer protocol, or None) to the access points matching
+    ``template``
+
+    The data are sent straight from the memory of ``buf``, in chunks.
+
+    Returns
+    -------
+    list of (name, error) tuples
+        one per access point (up to ``n``): ``name`` is its "class:name
+        method" and ``error`` its error message (None on success)
+    """
+    view = memoryview(b'' if buf is None else buf).cast('B')
+
+    async def send(client, point, paramlist):
+        error, _ = await _request(
+            client, point, 'xpaset', paramlist,
+            lambda channel: _send(channel, _buffer_chunks(view)))
+        return point.fullname, error
+
+    return await _requests(template, 'xpaset', paramlist, n, client, send)
+
+
+async def _setfd(template, paramlist, fd, n, client):
+    """Like set, but send the data read from ``fd``
+
+    The data are streamed to a single access point; they are read at once if
+    several access points match ``template``.
+    """
+    points = await lookup(template, 's', client)
+    if len(points[:abs(n)]) > 1:
+        data = bytearray()
+        async for chunk in _fd_chunks(fd):
+            data += chunk
+        return await set(template, paramlist, data, n, client)
+
+    async def send(client, point, paramlist):
+        error, _ = await _request(
+            client, point, 'xpaset', paramlist,
+            lambda channel: _send(channel, _fd_chunks(fd)))
+        return point.fullname, error
+
+    return await _requests(template, 'xpaset', paramlist, n, client, send)
+
+
+async def info(template, paramlist=None, n=xpa_n, client=None):
+    """Send an info message to the access points matching ``template``
+
+    Returns
+    -------
+    list of (name, error) tuples
+        as :func:`set`
+    """
+    async def send(client, point, paramlist):
+        error, _ = await _request(client, point, 'xpainfo', paramlist)
+        return point.fullname, error
+
+    return await _requests(template, 'xpainfo', paramlist, n, client, send)
+
+
+async def access(template, paramlist=None, n=xpa_n, client=None):
+    """Check which access points matching ``template`` are alive
+
+    Returns
+    -------
+    list of (name, error) tuples
+        as :func:`set`
+    """
+    async def send(client, point, paramlist):
+        error, reply = await _request(client, point, 'xpaaccess', paramlist)
+        name = point.fullname
+        # an access point addressed by its method tells its name in the reply
+        if name.startswith('?:?') and reply and '(' in reply:
+            name = reply[reply.rindex('(') + 1:reply.rindex(')')]
+        return name, error
+
+    return await _requests(template, 'xpaaccess', paramlist, n, client, send)
+
+
+# The synchronous functions below mirror those of pyds9.xpa. Their ``xpa``
+# argument is an optional Client, returned by XPAOpen, which keeps the
+# connections open between calls.
+
+
+class _EventLoop(object):
+    """An event loop, closed when the thread owning it ends, and the helper
+    thread running it while the owner runs another event loop"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = None
+
+    def __del__(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.loop.close()
+
+
+_event_loops = threading.local()
+
+
+def _after_fork():
+    """Close the event loop inherited by a child process, as its selector
+    is shared with the parent"""
+    event_loop = getattr(_event_loops, 'event_loop', None)
+    if event_loop is not None:
+        del _event_loops.event_loop
+        event_loop.loop.close()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _run(coro):
+    """Run ``coro`` in the event loop of the calling thread
+
+    If the calling thread is running an event loop (e.g. in Jupyter), which
+    cannot be nested, the loop of the thread is run by a helper thread, and
+    the caller blocks until the coroutine is done.
+    """
+    event_loop = getattr(_event_loops, 'event_loop', None)
+    if event_loop is None:
+        event_loop = _event_loops.event_loop = _EventLoop()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return event_loop.loop.run_until_complete(coro)
+    if event_loop.executor is None:
+        event_loop.executor = ThreadPoolExecutor(1)
+    return event_loop.executor.submit(event_loop.loop.run_until_complete,
+                                      coro).result()
+
+
+def _check(errors):
+    """Raise a ValueError with the error messages, if any"""
+    errmsg = ''.join(err + '\n' for err in errors if err)
+    if errmsg:
+        raise ValueError(errmsg)
+
+
+def XPAOpen(mode):
+    return Client()
+
+
+def XPAClose(xpa):
+    xpa.close()
+
+
+def xpaget(target, plist=None, n=xpa_n, xpa=None):
+    buf = xpagetbuf(target, plist, n, xpa)
+    if buf is not None:
+        buf = [bytes(b) for b in buf]
+    return buf
+
+
+def xpagetbuf(target, plist=None, n=xpa_n, xpa=None):
+    """Like xpaget, but return the data as a list of bytearrays"""
+    replies = _run(get(target, plist, n, xpa))
+    _check(err for _, _, err in replies)
+    if not replies:
+        return None
+    return [data for _, data, _ in replies if data]
+
+
+def xpagetall(target, plist=None, n=xpa_n, xpa=None):
+    """Like xpaget, but report the reply of each target instead of raising
+
+    Returns a list of ``(name, data, error)`` tuples, as :func:`get`, with
+    the data as bytes.
+    """
+    return [(name, None if data is None else bytes(data), err)
+            for name, data, err in _run(get(target, plist, n, xpa))]
+
+
+def xpagetfd(target, plist=None, fds=None, n=xpa_n, xpa=None):
+    """Like xpaget, but write the data to the file descriptors ``fds``
+
+    If ``n`` is negative, the replies of up to ``-n`` targets are all written
+    to ``fds[0]``. Returns the number of targets processed.
+    """
+    replies = _run(_getfd(target, plist, fds, n, xpa))
+    _check(err for _, err in replies)
+    return len(replies)
+
+
+def xpaset(target, plist=None, buf=None, blen=-1, n=xpa_n, xpa=None):
+    replies = xpasetall(target, plist, buf, blen, n, xpa)
+    _check(err for _, err in replies)
+    return len(replies)
+
+
+def xpasetall(target, plist=None, buf=None, blen=-1, n=xpa_n, xpa=None):
+    """Like xpaset, but report the outcome for each target instead of raising
+
+    Returns a list of ``(name, error)`` tuples, as :func:`set`.
+    """
+    if buf is not None and blen >= 0:
+        buf = memoryview(buf).cast('B')[:blen]
+    return _run(set(target, plist, buf, n, xpa))
+
+
+def xpasetfd(target, plist=None, fd=-1, n=xpa_n, xpa=None):
+    """Like xpaset, but send the data read from the file descriptor ``fd``
+
+    Returns the number of targets processed.
+    """
+    replies = _run(_setfd(target, plist, fd, n, xpa))
+    _check(err for _, err in replies)
+    return len(replies)
+
+
+def xpainfo(target, plist=None, n=xpa_n, xpa=None):
+    replies = _run(info(target, plist, n, xpa))
+    _check(err for _, err in replies)
+    return len(replies)
+
+
+def xpaaccess(target, plist=None, n=xpa_n, xpa=None):
+    replies = _run(access(target, plist, n, xpa))
+    _check(err for _, err in replies)
+    if not replies:
+        return None
+    return [name for name, _ in replies]
@@ -0,0 +1,476 @@
+"""
+A pool of ds9 instances started in advance, and leased to the jobs that
+need one
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+from io import BytesIO
+import itertools
+import os
+import subprocess
+import threading
+import time
+
+import numpy
+
+from .pyds9 import DS9, _start_ds9, _wait_targets
+
+__all__ = ['DS9Pool', 'render_many']
+
+
+def _start_xvfb(args=()):
+    """Start a virtual X server on a free display
+
+    Returns
+    -------
+    (subprocess.Popen, str)
+        the Xvfb process and its display, e.g. ``':1'``
+    """
+    rfd, wfd = os.pipe()
+    try:
+        process = subprocess.Popen(['Xvfb', '-displayfd', str(wfd),
+                                    '-nolisten', 'tcp'] + list(args),
+                                   pass_fds=(wfd,),
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+    except OSError:
+        os.close(rfd)
+        raise ValueError('cannot start Xvfb')
+    finally:
+        os.close(wfd)
+    # Xvfb writes the display number once it is ready
+    with os.fdopen(rfd) as f:
+        display = f.readline().strip()
+    if not display:
+        process.kill()
+        process.wait()
+        raise ValueError('Xvfb failed to start')
+    return process, ':' + display
+
+
+class DS9Pool(object):
+    """A pool of ds9 instances, started in advance and leased to the jobs,
+    so that the jobs do not wait for ds9 to start::
+
+        >>> with DS9Pool(4, xvfb=True) as pool:
+        ...     with pool.lease() as d:
+        ...         d.set_np2arr(image)
+        ...         png = d.get('png')
+
+    Each ds9 gets a unique title (``prefix`` followed by a number), and can
+    run under a virtual X server, started and stopped with the pool. A
+    leased :class:`DS9` object is used by a single job at a time: it is
+    returned by :meth:`release` (or at the end of the :meth:`lease`
+    block), which restores the initial state of ds9 with
+    :attr:`reset_commands`.
+
+    A ds9 found dead when it is leased, or that fails to be reset, is
+    stopped and replaced by a new one in the background; :meth:`check`
+    does the same for all the idle instances. :meth:`stats` reports the
+    use of the pool.
+
+    :param size: number of ds9 instances
+    :param start: True, or the ds9 command line arguments (as in the
+     :class:`DS9` constructor)
+    :param xvfb: run ds9 under a virtual X server (Xvfb must be in the
+     PATH)? If a list, the extra Xvfb command line arguments
+    :param prefix: prefix of the ds9 titles (default:
+     ``'pyds9pool.<pid>.'``)
+    :param wait: seconds to wait for each ds9 to start
+    :param verify: the verify argument of the :class:`DS9` objects
+    :param verify_ttl: the verify_ttl argument of the :class:`DS9` objects
+    """
+
+    #: commands restoring a ds9 to its initial state, when it is returned
+    reset_commands = ('frame delete all', 'frame new', 'scale linear',
+                      'scale mode minmax', 'cmap grey')
+
+    def __init__(self, size, start=True, xvfb=False, prefix=None, wait=10,
+                 verify=True, verify_ttl=None):
+        if size < 1:
+            raise ValueError('the pool needs at least one ds9')
+        self.size = size
+        self._start = start
+        self._wait = wait
+        self._verify = verify
+        self._verify_ttl = verify_ttl
+        self._prefix = prefix or 'pyds9pool.%d.' % os.getpid()
+        self._numbers = itertools.count()
+        self._cond = threading.Condition()
+        self._idle = deque()
+        # id(ds9) => (ds9, start of the lease)
+        self._busy = {}
+        # ds9 title => process
+        self._processes = {}
+        self._starting = 0
+        self._error = None
+        self._closed = False
+        self._leases = 0
+        self._replaced = 0
+        self._busy_time = 0.
+        self._created = time.monotonic()
+        self._executor = ThreadPoolExecutor(size)
+        self._xvfb = None
+        self._env = None
+        if xvfb:
+            self._xvfb, display = _start_xvfb(
+                xvfb if isinstance(xvfb, (list, tuple)) else ())
+            self._env = {'DISPLAY': display}
+
+        try:
+            with self._cond:
+                self._starting = size
+            for _ in range(size):
+                self._executor.submit(self._add_new)
+            with self._cond:
+                while self._starting:
+                    self._cond.wait()
+                if len(self._idle) < size:
+                    raise ValueError('cannot start the ds9 pool: %s' %
+                                     self._error)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_instance(self):
+        """Start a ds9, and return its DS9 object"""
+        title = '%s%d' % (self._prefix, next(self._numbers))
+        with self._cond:
+            if self._closed:
+                raise ValueError('the pool is closed')
+            process = _start_ds9(title, self._start, self._env)
+            self._processes[title] = process
+        if not _wait_targets(title, self._wait, process):
+            with self._cond:
+                self._processes.pop(title, None)
+            process.kill()
+            process.wait()
+            raise ValueError('no active ds9 running for target: %s' % title)
+        return DS9(title, start=False, verify=self._verify,
+                   verify_ttl=self._verify_ttl)
+
+    def _add_new(self):
+        """Start a ds9, and add it to the idle instances"""
+        try:
+            d = self._new_instance()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._starting -= 1
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self._starting -= 1
+            if not self._closed:
+                self._idle.append(d)
+                self._cond.notify_all()
+                return
+        self._stop(d)
+
+    def _stop(self, d):
+        """Stop the ds9 of ``d``, and close its connections"""
+        try:
+            # the process may be the mac OSX ``open``, rather than ds9
+            d.set('exit')
+        except ValueError:
+            pass
+        d.close()
+        with self._cond:
+            process = self._processes.pop(d.target, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    def _replace(self, d):
+        """Stop the ds9 of ``d``, and start another one in the background"""
+        self._stop(d)
+        with self._cond:
+            if self._closed:
+                return
+            self._starting += 1
+            self._replaced += 1
+            self._executor.submit(self._add_new)
+
+    def _healthy(self, d):
+        """Whether the ds9 of ``d`` still runs"""
+        return d.target in self._processes and d._running()
+
+    def acquire(self, timeout=None):
+        """Lease a ds9, waiting for one to be available
+
+        :param timeout: maximum number of seconds to wait (default: no limit)
+
+        :rtype: :class:`DS9` object, to be returned with :meth:`release`
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while not self._idle:
+                    if self._closed:
+                        raise ValueError('the pool is closed')
+                    if not self._busy and not self._starting:
+                        raise ValueError('no ds9 left in the pool: %s' %
+                                         self._error)
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise ValueError('no ds9 available after %s '
+                                             'seconds' % timeout)
+                    self._cond.wait(remaining)
+                d = self._idle.popleft()
+            if self._healthy(d):
+                with self._cond:
+                    self._busy[id(d)] = (d, time.monotonic())
+                    self._leases += 1
+                return d
+            self._replace(d)
+
+    def release(self, d):
+        """Return a ds9 leased by :meth:`acquire`, after resetting it"""
+        with self._cond:
+            try:
+                d, start = self._busy.pop(id(d))
+            except KeyError:
+                raise ValueError('ds9 not leased from this pool: %s' %
+                                 d.target)
+            self._busy_time += time.monotonic() - start
+        try:
+            reset = all(d.set(cmd) for cmd in self.reset_commands)
+        except ValueError:
+            reset = False
+        if not reset:
+            self._replace(d)
+            return
+        with self._cond:
+            if not self._closed:
+                self._idle.append(d)
+                self._cond.notify()
+                return
+        self._stop(d)
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """Lease a ds9 for the duration of a ``with`` block (see
+        :meth:`acquire`)"""
+        d = self.acquire(timeout)
+        try:
+            yield d
+        finally:
+            self.release(d)
+
+    def check(self):
+        """Replace the idle ds9 instances that are no longer running
+
+        :rtype: number of instances replaced
+        """
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        dead = [d for d in idle if not self._healthy(d)]
+        with self._cond:
+            self._idle.extend(d for d in idle if d not in dead)
+            self._cond.notify_all()
+        for d in dead:
+            self._replace(d)
+        return len(dead)
+
+    def stats(self):
+        """Report the use of the pool
+
+        :rtype: dict with the number of ds9 instances ``idle``, ``busy``
+         (leased) and ``starting``, the total number of ``leases`` and of
+         instances ``replaced``, and the ``utilization``: the fraction of
+         the time the instances have been leased, since the pool was created
+        """
+        with self._cond:
+            now = time.monotonic()
+            busy_time = self._busy_time + sum(now - start for _, start
+                                              in self._busy.values())
+            return {'size': self.size, 'idle': len(self._idle),
+                    'busy': len(self._busy), 'starting': self._starting,
+                    'leases': self._leases, 'replaced': self._replaced,
+                    'utilization': busy_time / (self.size *
+                                                (now - self._created))}
+
+    def close(self):
+        """Stop all the ds9 instances, including the leased ones"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        # let the ds9 instances being started register their process
+        self._executor.shutdown(wait=True)
+        with self._cond:
+            instances = list(self._idle) + [d for d, _ in
+                                             self._busy.values()]
+            self._idle.clear()
+        for d in instances:
+            self._stop(d)
+        with self._cond:
+            processes = list(self._processes.values())
+            self._processes.clear()
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if self._xvfb is not None:
+            self._xvfb.terminate()
+            self._xvfb.wait()
+            self._xvfb = None
+
+
+def _load(d, item):
+    """Display ``item`` (a path, a numpy array or an HDU list) in ds9"""
+    if isinstance(item, (str, os.PathLike)):
+        d.set('file ' + os.fspath(item))
+    elif isinstance(item, numpy.ndarray):
+        d.set_np2arr(item)
+    else:
+        d.set_fits(item)
+
+
+def _render(d, item, settings, format):
+    """Display ``item`` in ds9 with ``settings``, and return the image"""
+    _load(d, item)
+    for command, value in settings.items():
+        if command == 'regions':
+            if not isinstance(value, str):
+                value = '\n'.join(value)
+            d.set('regions', value)
+        else:
+            d.set('%s %s' % (command, value))
+    return d.get(format, decode=False)
+
+
+def _to_rgb(image):
+    """Decode a png or jpeg image into an RGB array"""
+    from PIL import Image
+    with Image.open(BytesIO(image)) as im:
+        return numpy.asarray(im.convert('RGB'))
+
+
+def render_many(inputs, settings=None, workers=4, format='png',
+                output='bytes', ordered=True, max_pending=None, pool=None,
+                **kwargs):
+    """Render images with ds9, on several ds9 instances in parallel, e.g. to
+    make the previews of many FITS files::
+
+        >>> for i, png in render_many(paths, {'scale': 'zscale',
+        ...                                   'cmap': 'heat'}, workers=8):
+        ...     with open('preview%d.png' % i, 'wb') as f:
+        ...         f.write(png)
+
+    Each input is displayed in a ds9 leased from a :class:`DS9Pool`, and
+    the ``settings`` are applied in order: each item is an xpa command and
+    its parameters, e.g. ``'scale': 'log'``, except ``'regions'``, whose
+    value is sent as the region data (a string, or a list of regions). ds9
+    then renders the image with the ``format`` command (e.g. ``'png'``, or
+    ``'jpeg 90'``).
+
+    The inputs are consumed and the images yielded as the rendering goes:
+    at most ``max_pending`` inputs are being rendered, or waiting to be
+    yielded, at a time. The ds9 instances render in parallel with either
+    xpa backend: each connection has its own copy of the XPA library.
+
+    Parameters
+    ----------
+    inputs : iterable
+        paths of the images to load with the ``file`` command, numpy arrays
+        (see :meth:`DS9.set_np2arr`) or astropy HDU lists (see
+        :meth:`DS9.set_fits`)
+    settings : dict, optional
+        xpa command => parameters, applied to each input
+    workers : int, optional
+        number of ds9 instances started, if ``pool`` is not given
+    format : string, optional
+        command returning the rendered image (default: ``'png'``)
+    output : string, optional
+        ``'bytes'`` to yield the image as returned by ds9, ``'rgb'`` to
+        decode it into a (height, width, 3) uint8 array (needs Pillow)
+    ordered : bool, optional
+        yield the images in the order of the inputs (default), or as soon as
+        they are rendered
+    max_pending : int, optional
+        maximum number of inputs in flight (default: twice the number of
+        ds9 instances)
+    pool : :class:`DS9Pool`, optional
+        pool of ds9 instances to use (default: a pool of ``workers``
+        instances, started by the first iteration and stopped by the last)
+    kwargs
+        other arguments of the :class:`DS9Pool` started
+
+    Yields
+    ------
+    (int, bytes or numpy.ndarray)
+        index of the input, and its rendered image
+
+    Raises
+    ------
+    ValueError
+        if ``output`` is unknown, or if an input cannot be rendered (when its
+        image is due)
+    """
+    if output not in ('bytes', 'rgb'):
+        raise ValueError('unknown output: %s' % output)
+    if output == 'rgb':
+        try:
+            import PIL.Image  # noqa: F401
+        except ImportError:
+            raise ValueError("output='rgb' needs Pillow")
+    settings = dict(settings or {})
+    return _render_many(inputs, settings, workers, format, output, ordered,
+                        max_pending, pool, kwargs)
+
+
+def _render_many(inputs, settings, workers, format, output, ordered,
+                 max_pending, pool, kwargs):
+    own_pool = pool is None
+    if own_pool:
+        pool = DS9Pool(workers, **kwargs)
+    max_pending = max_pending or 2 * pool.size
+
+    def render(item):
+        with pool.lease() as d:
+            image = _render(d, item, settings, format)
+        return _to_rgb(image) if output == 'rgb' else image
+
+    # (index, future), in the order of the inputs
+    pending = deque()
+
+    def done():
+        """Remove and return some of the rendered images"""
+        if ordered:
+            index, future = pending.popleft()
+            return [(index, future.result())]
+        wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+        finished = [(index, future) for index, future in pending
+                    if future.done()]
+        for item in finished:
+            pending.remove(item)
+        return [(index, future.result()) for index, future in finished]
+
+    executor = ThreadPoolExecutor(pool.size)
+    try:
+        for index, item in enumerate(inputs):
+            while len(pending) >= max_pending:
+                for result in done():
+                    yield result
+            pending.append((index, executor.submit(render, item)))
+        while pending:
+            for result in done():
+                yield result
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if own_pool:
+            pool.close()
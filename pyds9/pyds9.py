@@ -11,40 +11,76 @@ ds9.py connects python and ds9 via the xpa messaging system:
 from __future__ import (print_function, absolute_import, division,
                         unicode_literals)
 
+import asyncio
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 import contextlib
+import fnmatch
+import functools
 import sys
 import subprocess
 import shlex
+import socket
 import os
+import tempfile
+import threading
 import time
-import array
 import platform
+import re
 import warnings
+import weakref
 try:
     from shutil import which
 except ImportError:
     from distutils.spawn import find_executable as which
 
-from . import xpa
+from . import aioxpa as _aioxpa
+from . import transport as _transport
+try:
+    from . import xpa as _libxpa
+except ImportError:
+    # the pure-Python client is used instead: see set_xpa_backend
+    _libxpa = None
 
 from io import BytesIO
-from astropy.io import fits
 import numpy
 
 
-__all__ = ['DS9', 'ds9', 'ds9_openlist', 'ds9_targets', 'ds9_xpans',
-           'ds9Globals']
+__all__ = ['DS9', 'AsyncDS9', 'DS9Group', 'ds9', 'ds9_broadcast',
+           'ds9_gather', 'ds9_map', 'ds9_openlist', 'ds9_targets',
+           'ds9_xpans', 'ds9Globals', 'set_xpa_backend']
 
 # skip all the doctests in this module
 __doctest_skip__ = ['*']
 
+
+class _Globals(dict):
+    """The global parameters, the costly ones being computed when first
+    used (see ``_lazy_globals``)"""
+
+    def __missing__(self, key):
+        if key not in _lazy_globals:
+            raise KeyError(key)
+        value = self[key] = _lazy_globals[key]()
+        return value
+
+
 # try to be a little bit neat with global parameters
-ds9Globals = {}
+ds9Globals = _Globals()
+# name => function computing the global parameter
+_lazy_globals = {}
 
 # platform-specific parameters
 ds9Globals["ulist"] = platform.uname()
 
+# first and longest delays between the lookups of a ds9 being started, in
+# seconds
+WAIT_MIN_DELAY = 0.01
+WAIT_MAX_DELAY = 0.25
+
+# number of regions formatted at once by DS9.set_regions: more are streamed
+REGIONS_CHUNK = 1 << 16
+
 
 def get_xpans_ds9():
     """Look for xpans and ds9 executable or app
@@ -104,7 +140,129 @@ def get_xpans_ds9():
     return xpans, ds9
 
 
-ds9Globals["progs"] = get_xpans_ds9()
+# the executables are looked for when first needed
+_lazy_globals["progs"] = get_xpans_ds9
+
+# default way of sending data in set_np2arr and set_fits: see pyds9.transport
+ds9Globals['transport'] = 'xpa'
+
+
+def set_xpa_backend(name):
+    """Select the implementation of the xpa client used to talk to ds9
+
+    Parameters
+    ----------
+    name : string
+        ``'libxpa'`` to call the XPA shared library (see :mod:`pyds9.xpa`),
+        or ``'asyncio'`` to use the pure-Python client of
+        :mod:`pyds9.aioxpa`, which does not need the compiled library
+
+    The default is ``'libxpa'`` if the library is available, unless the
+    ``PYDS9_XPA_BACKEND`` environment variable says otherwise. The existing
+    DS9 objects switch to the new backend on their next call.
+
+    With the ``'asyncio'`` backend, a synchronous call (e.g. :meth:`DS9.get`)
+    made from a running event loop, as in Jupyter or an asyncio program,
+    runs its request in a helper thread and blocks that loop until it is
+    done: asyncio programs should use :class:`AsyncDS9` instead.
+    """
+    global xpa
+    backends = {'libxpa': _libxpa, 'asyncio': _aioxpa}
+    if name not in backends:
+        raise ValueError('unknown xpa backend: %s' % name)
+    if backends[name] is None:
+        raise ValueError("can't find XPA shared library")
+    xpa = backends[name]
+    ds9Globals['xpa_backend'] = name
+
+
+set_xpa_backend(os.environ.get('PYDS9_XPA_BACKEND',
+                               'asyncio' if _libxpa is None else 'libxpa'))
+
+# how to reach the ds9 instances running on this host: 'inet' only uses
+# what XPA_METHOD says (tcp sockets by default), 'local' starts them with the
+# xpa local method (unix sockets) and also finds the ones using it without a
+# name server
+ds9Globals['xpa_method'] = 'inet'
+
+
+def _use_local_method():
+    """Whether the ds9 instances using the xpa local method must be looked
+    for directly in the xpa socket directory, i.e. they are not listed by the
+    name server that pyds9 uses"""
+    return (ds9Globals['xpa_method'] == 'local' and
+            hasattr(socket, 'AF_UNIX') and not _aioxpa.unix_method())
+
+
+def _local_targets(target, n=1024):
+    """Lists the ds9 instances using the xpa local method that match the
+    ``target`` template, as ``xpaaccess`` does
+
+    The access points are found from the names of the unix sockets created
+    by xpa, ``<class>_<name>.<pid>``, and checked one by one. The sockets
+    left by processes that are gone are skipped.
+
+    :param target: ds9 target template
+    :param n: maximum number of targets
+
+    :rtypes: list of strings (name and id)
+    """
+    if not _use_local_method():
+        return []
+    if ':' in target:
+        cls, name = target.lower().split(':', 1)
+    else:
+        cls, name = '*', target.lower()
+    tmpdir = _aioxpa.tmpdir()
+    try:
+        files = sorted(os.listdir(tmpdir))
+    except OSError:
+        return []
+    targets = []
+    for f in files:
+        if len(targets) >= n:
+            break
+        base, _, pid = f.rpartition('.')
+        fcls, _, fname = base.lower().partition('_')
+        if not (pid.isdigit() and fnmatch.fnmatchcase(fcls, cls) and
+                fnmatch.fnmatchcase(fname, name) and _pid_exists(int(pid))):
+            continue
+        found = xpa.xpaaccess(string_to_bytes(os.path.join(tmpdir, f)),
+                              None, 1)
+        if found:
+            targets.extend(bytes_to_string(found))
+    return targets
+
+
+def _pid_exists(pid):
+    """Whether a process with this pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. owned by another user
+        pass
+    return True
+
+
+def _xpa_all(func, target, args, n, xpa=None):
+    """Calls the xpa*all routine ``func`` on ``target``, then on each of the
+    matching ds9 instances using the xpa local method (see
+    :func:`_local_targets`)
+
+    :param args: arguments of ``func`` between ``target`` and ``n``
+
+    :rtypes: list of replies, as returned by ``func``
+    """
+    _check_xpans()
+    replies = func(string_to_bytes(target), *(args + (n,)), xpa=xpa)
+    for point in _local_targets(target, n - len(replies)):
+        path = point.split()[1]
+        # the access point is addressed by path, so xpa does not know its name
+        replies.extend((point,) + tuple(reply[1:]) for reply in
+                       func(string_to_bytes(path), *(args + (1,)), xpa=xpa))
+    return replies
 
 # default list of commands that returns binary data that should not be decoded
 ds9Globals['bin_cmd'] = ["array",
@@ -117,6 +275,14 @@ ds9Globals['bin_cmd'] = ["array",
                          "rgbarray", "rgbcube", "rgbimage",
                          "tiff"]
 
+# size of the FITS header and data blocks
+_FITS_BLOCK = 2880
+
+# BZERO of the FITS integers stored with an offset: the unsigned integers,
+# and the signed bytes
+_FITS_OFFSETS = {8: -128, 16: 1 << 15, 32: 1 << 31, 64: 1 << 63}
+
+
 # numpy-dependent routines
 def _bp2np(bitpix):
     """Convert FITS bitpix to numpy datatype
@@ -195,6 +361,105 @@ def _np2bp(dtype):
     raise ValueError('unsupported dtype: %s' % dtype)
 
 
+def _fits_image(raw):
+    """Locate the first image in a FITS file
+
+    Parameters
+    ----------
+    raw : numpy array of uint8
+        content of the FITS file
+
+    The image is the data of the first HDU with two or more axes, e.g. of
+    an image extension after an empty primary HDU.
+
+    Returns
+    -------
+    offset : int
+        position of the image data in ``raw``
+    shape : tuple
+        shape of the image (NAXISn, ..., NAXIS1), without the degenerate
+        axes beyond the third one
+    cards : dict
+        values of the header cards, keyword => value (bytes)
+
+    Raises
+    ------
+    ValueError
+        if ``raw`` does not contain an image
+    """
+    offset = 0
+    while offset < len(raw):
+        cards = {}
+        pos = offset
+        end = False
+        while not end:
+            block = raw[pos:pos + _FITS_BLOCK].tobytes()
+            if len(block) < _FITS_BLOCK:
+                raise ValueError('truncated FITS header')
+            pos += _FITS_BLOCK
+            for i in range(0, _FITS_BLOCK, 80):
+                key = block[i:i + 8].strip()
+                if key == b'END':
+                    end = True
+                    break
+                if block[i + 8:i + 10] == b'= ':
+                    cards[key] = block[i + 10:i + 80].split(b'/')[0].strip()
+        bitpix = int(cards[b'BITPIX'])
+        naxis = int(cards.get(b'NAXIS', 0))
+        shape = tuple(int(cards[b'NAXIS%d' % i]) for i in range(naxis, 0, -1))
+        if naxis >= 2 and b'TFIELDS' not in cards:
+            while len(shape) > 3 and shape[0] == 1:
+                shape = shape[1:]
+            return pos, shape, cards
+        # skip the data of this HDU
+        nbytes = 0
+        if naxis:
+            nbytes = (abs(bitpix) // 8 * int(cards.get(b'GCOUNT', 1)) *
+                      (int(cards.get(b'PCOUNT', 0)) +
+                       int(numpy.prod(shape))))
+        offset = pos + -(-nbytes // _FITS_BLOCK) * _FITS_BLOCK
+    raise ValueError('no image found in FITS data')
+
+
+def _fits_to_array(raw):
+    """Return the first image of the FITS file ``raw`` as an array in native
+    byte order, sharing (and modifying) the memory of ``raw``
+
+    Unsigned integers (and signed bytes) stored with an offset are returned
+    as such. Other scaled data (BSCALE/BZERO) are returned, in a new array,
+    as floating point values, with NaN for the BLANK integers, as astropy
+    does.
+    """
+    offset, shape, cards = _fits_image(raw)
+    bitpix = int(cards[b'BITPIX'])
+    bscale = float(cards.get(b'BSCALE', 1))
+    bzero = float(cards.get(b'BZERO', 0))
+    dtype = numpy.dtype(_bp2np(bitpix))
+    nbytes = dtype.itemsize * int(numpy.prod(shape))
+    if len(raw) < offset + nbytes:
+        raise ValueError('truncated FITS data')
+    arr = raw[offset:offset + nbytes].view(dtype.newbyteorder('>'))
+    if not arr.dtype.isnative:
+        arr.byteswap(True)
+        arr = arr.view(arr.dtype.newbyteorder('='))
+    arr = arr.reshape(shape)
+    if bscale == 1 and bzero == _FITS_OFFSETS.get(bitpix):
+        # flipping the sign bit removes the offset
+        arr = arr.view('u%d' % dtype.itemsize)
+        arr ^= arr.dtype.type(1 << (8 * dtype.itemsize - 1))
+        if bitpix == 8:
+            arr = arr.view(numpy.int8)
+    elif bscale != 1 or bzero != 0:
+        scaled = arr.astype(numpy.float32 if bitpix in (8, 16, -32)
+                            else numpy.float64)
+        scaled *= bscale
+        scaled += bzero
+        if bitpix > 0 and b'BLANK' in cards:
+            scaled[arr == int(cards[b'BLANK'])] = numpy.nan
+        arr = scaled
+    return arr
+
+
 def string_to_bytes(string):
     """Converts the input (list of) string(s) into (a list of) bytes
 
@@ -245,6 +510,93 @@ def bytes_to_string(byte):
             return byte
 
 
+def _copy_to(arr, out):
+    """Copy ``arr`` into the ``out`` array (if not None) and return it, as in
+    :meth:`DS9.get_arr2np`"""
+    if out is None:
+        return arr
+    if (out.shape != arr.shape or out.dtype != arr.dtype or
+            not out.flags['C_CONTIGUOUS']):
+        raise ValueError('out must be a C-contiguous array with shape'
+                         ' %s and dtype %s' % (arr.shape, arr.dtype))
+    out[...] = arr
+    return out
+
+
+def _np2arr(arr, dtype=None):
+    """Return the array to send to ds9 for ``arr`` (converted to ``dtype``
+    and C-contiguous), and its ``array [xdim=...]`` command, as in
+    :meth:`DS9.set_np2arr`"""
+    if not isinstance(arr, numpy.ndarray):
+        raise ValueError('requires numpy.ndarray as input')
+    if dtype and dtype != arr.dtype:
+        narr = arr.astype(dtype)
+    else:
+        if arr.dtype == numpy.int8:
+            narr = arr.astype(numpy.int16)
+        elif arr.dtype == numpy.uint32:
+            narr = arr.astype(numpy.int64)
+        elif hasattr(numpy, "float16") and arr.dtype == numpy.float16:
+            narr = arr.astype(numpy.float32)
+        else:
+            narr = arr
+    if not narr.flags['C_CONTIGUOUS']:
+        narr = numpy.ascontiguousarray(narr)
+    bp = _np2bp(narr.dtype)
+
+    # note that this needs the "endian=" part because sometimes it's
+    # left out completely
+    endianness = ''
+    if narr.dtype.byteorder == '=':
+        endianness = ',endian=' + sys.byteorder
+    elif narr.dtype.byteorder == '<':
+        endianness = ',endian=little'
+    elif narr.dtype.byteorder == '>':
+        endianness = ',endian=big'
+
+    paramlist = 'array '
+    if narr.ndim == 2:
+        paramlist += '[xdim={shape[1]},ydim={shape[0]}'
+    elif narr.ndim == 3:
+        paramlist += '[xdim={shape[2]},ydim={shape[1]},zdim={shape[0]}'
+    else:
+        raise ValueError('The input numpy array must have 2 or 3'
+                         ' dimensions, not {}'.format(narr.ndim))
+    paramlist += ',bitpix={bp}{endian}]'
+    return narr, paramlist.format(shape=narr.shape, bp=bp, endian=endianness)
+
+
+def _to_buffer(buf):
+    """Converts the data to send to ds9 into a contiguous buffer
+
+    :param buf: string or object supporting the buffer protocol
+
+    :rtypes: object supporting the buffer protocol
+    """
+    if isinstance(buf, str):
+        return string_to_bytes(buf)
+    elif isinstance(buf, numpy.ndarray) and not buf.flags['C_CONTIGUOUS']:
+        return numpy.ascontiguousarray(buf)
+    return buf
+
+
+def _reply_keys(names):
+    """Converts the "class:name method" of the replying access points into
+    keys: the name if it is unique, otherwise the method (i.e. the id), as in
+    :func:`ds9_openlist`
+
+    :param names: list of "class:name method" strings
+
+    :rtypes: list of strings
+    """
+    split = [name.split(None, 1) for name in names]
+    counts = defaultdict(int)
+    for name_id in split:
+        counts[name_id[0]] += 1
+    return [name_id[0] if counts[name_id[0]] == 1 else name_id[-1]
+            for name_id in split]
+
+
 DS9_ALREADY_STARTED = """
 An instance of ds9 was found to be running before we could
 start the 'xpans' name server. You will need to perform a
@@ -280,6 +632,9 @@ def ds9_xpans():
     If xpans was not running (and so was started by this routine) while ds9
     was already running, an explanation on how to connect to that instance
     of ds9 is displayed.
+
+    It is called before the first lookup of ds9 instances, unless the
+    PYDS9_NOXPANS environment variable is set.
     """
 
     if xpa.xpaaccess(b"xpans", None, 1) is not None:
@@ -293,15 +648,66 @@ def ds9_xpans():
     # start up xpans
     subprocess.Popen([_fname, "-e"])
 
-    # if ds9 is already running, issue a warning; the tricky part is
-    # in determining what constitutes a DS9 process - e.g. see
-    # https://github.com/ericmandel/pyds9/issues/96
+    # if ds9 is already running, issue a warning
+    if _ds9_running():
+        print(DS9_ALREADY_STARTED)
+
+    return 1
+
+
+def _proc_command(proc_fd, path):
+    """Return the base name of the command in the ``comm`` or ``cmdline``
+    file ``path`` of the /proc directory ``proc_fd``, or b'' if the process
+    is gone"""
+    try:
+        fd = os.open(path, os.O_RDONLY, dir_fd=proc_fd)
+    except OSError:
+        return b''
+    try:
+        data = os.read(fd, 4096)
+    except OSError:
+        return b''
+    finally:
+        os.close(fd)
+    # comm ends with a newline, and the arguments in cmdline with a null byte
+    return os.path.basename(data.split(b'\0', 1)[0].rstrip(b'\n'))
+
+
+def _ds9_running(proc='/proc'):
+    """Whether a ds9 process is running, judging from the command names of
+    the processes
+
+    On Linux, the names are read from ``proc``: this takes a few
+    milliseconds, even with thousands of processes. A process is taken for
+    ds9 if its command name, or the base name of its ``argv[0]`` (e.g. for
+    ds9 started through a link or a wrapper with another name), starts with
+    ``ds9``, like ``ds9-8.5``. Elsewhere the output of ``ps -A`` is parsed.
+    """
+    try:
+        proc_fd = os.open(proc, os.O_RDONLY)
+    except OSError:
+        proc_fd = None
+    if proc_fd is not None:
+        try:
+            for pid in os.listdir(proc_fd):
+                if not pid.isdigit():
+                    continue
+                for name in ('comm', 'cmdline'):
+                    command = _proc_command(proc_fd, pid + '/' + name)
+                    if command.startswith(b'ds9'):
+                        return True
+        finally:
+            os.close(proc_fd)
+        return False
+
+    # the tricky part is in determining what constitutes a DS9 process -
+    # e.g. see https://github.com/ericmandel/pyds9/issues/96
     #
     p = subprocess.Popen(['ps', '-A'], stdout=subprocess.PIPE,
                          universal_newlines=True)
     pslist = p.communicate()[0]
 
-    # Simple approach (assuming this is not time critical):
+    # Simple approach:
     #  - break up by line
     #  - look for 'ds9'
     #  - exclude known false hits
@@ -325,10 +731,22 @@ def ds9_xpans():
         #
         prest = pline[idx + 3:]
         if prest == '' or prest[0] == ' ':
-            print(DS9_ALREADY_STARTED)
-            break
+            return True
+    return False
 
-    return 1
+
+# whether xpans is known to be running (or not wanted)
+_xpans_checked = False
+
+
+def _check_xpans():
+    """Start xpans if necessary, before the first lookup of ds9 instances
+    (rather than when pyds9 is imported), unless PYDS9_NOXPANS is set"""
+    global _xpans_checked
+    if not _xpans_checked:
+        if "PYDS9_NOXPANS" not in os.environ:
+            ds9_xpans()
+        _xpans_checked = True
 
 
 def ds9_targets(target='DS9:*', n=1024):
@@ -341,6 +759,13 @@ def ds9_targets(target='DS9:*', n=1024):
     You then can pass one of the ids (or names) to the :class:`DS9`
     constructor.
 
+    With ``ds9Globals['xpa_method'] = 'local'``, the ds9 instances using
+    the xpa local method are listed too, even if they are not registered
+    with a name server: their id is the path of their unix socket::
+
+        >>> ds9_targets()
+        ['DS9:foo1 838e29d4:42873', 'DS9:foo3 /tmp/.xpa/DS9_foo3.8123']
+
     Parameters
     ----------
     target : string, optional
@@ -353,8 +778,60 @@ def ds9_targets(target='DS9:*', n=1024):
     list of strings
         list of available targets matching template (name and id)
     """
-    targets = xpa.xpaaccess(string_to_bytes(target), None, n)
-    return bytes_to_string(targets)
+    _check_xpans()
+    targets = bytes_to_string(xpa.xpaaccess(string_to_bytes(target), None,
+                                            n)) or []
+    targets += _local_targets(target, n - len(targets))
+    return targets or None
+
+
+def _start_ds9(target, start=True, env=None):
+    """Start a ds9 titled ``target``, and return its :class:`subprocess.Popen`
+
+    ``start`` is as in the :class:`DS9` constructor: True, or the extra
+    command line arguments, as a string or a list. ``env`` holds extra
+    environment variables.
+    """
+    try:
+        args = shlex.split(start)
+    except AttributeError:      # Not a parsable string-like object
+        try:
+            args = list(start)
+        except TypeError:       # Not an iterable object
+            args = []
+    env = dict(os.environ, **(env or {}))
+    if _use_local_method() and 'XPA_METHOD' not in env:
+        # ds9 is on this host: talk to it through unix sockets
+        env['XPA_METHOD'] = 'local'
+        nsunix = env.get('XPA_NSUNIX', os.path.join(_aioxpa.tmpdir(),
+                                                     'xpans_unix'))
+        if not os.path.exists(nsunix):
+            # no need for ds9 to complain about the missing xpans
+            env['XPA_NSREGISTER'] = 'false'
+    return subprocess.Popen(ds9Globals["progs"][1] + ['-title', target] +
+                            args, env=env)
+
+
+def _wait_targets(target, wait, process=None):
+    """Look up the ds9 instances matching ``target`` until one of them
+    answers, or ``wait`` seconds have passed
+
+    The lookups start a few milliseconds apart, and back off up to
+    ``WAIT_MAX_DELAY``, so that a ds9 is found soon after it is ready. The
+    wait stops early if ``process``, the ds9 just started, exited with an
+    error.
+    """
+    deadline = time.monotonic() + wait
+    delay = WAIT_MIN_DELAY
+    while True:
+        tlist = ds9_targets(target)
+        remaining = deadline - time.monotonic()
+        if tlist or remaining <= 0:
+            return tlist
+        if process is not None and process.poll():
+            return tlist
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, WAIT_MAX_DELAY)
 
 
 def ds9_openlist(target='DS9:*', n=1024):
@@ -414,6 +891,299 @@ def ds9_openlist(target='DS9:*', n=1024):
         return ds9list
 
 
+def ds9_broadcast(target, paramlist, buf=None, blen=-1, n=1024):
+    """Send the same command and data to all the ds9 instances matching a
+    target template at once. For example, assuming 3 instances of ds9 are
+    running with names foo1, foo2, foo3::
+
+        >>> ds9_broadcast("foo*", "zoom to 4")
+        {'DS9:foo1': None, 'DS9:foo2': None, 'DS9:foo3': None}
+        >>> ds9_broadcast("foo*", "array [xdim=512 ydim=512 bitpix=-32]", arr)
+
+    The data are sent in a single xpa call, without being copied or
+    re-serialized for each target.
+
+    Parameters
+    ----------
+    target : string
+        ds9 target template
+    paramlist : string
+        command parameters (documented in the ds9 ref manual)
+    buf : string or buffer, optional
+        data to send, as in :meth:`DS9.set`
+    blen : int, optional
+        maximum number of bytes of ``buf`` to send (default: all)
+    n : int, optional
+        maximum number of targets to send to (default: 1024)
+
+    Returns
+    -------
+    dict
+        for each target, keyed by name (or by id if more ds9 instances share
+        the same name, as in :func:`ds9_openlist`), None on success or the
+        error message returned by the target
+
+    Raises
+    ------
+    ValueError
+        if no ds9 matches the template
+    """
+    replies = _xpa_all(xpa.xpasetall, target,
+                       (string_to_bytes(paramlist), _to_buffer(buf), blen), n)
+    return _replies_by_key(target, replies)
+
+
+def ds9_gather(target, paramlist=None, decode=None, n=1024):
+    """Get data or info from all the ds9 instances matching a target
+    template at once. For example, assuming 3 instances of ds9 are running
+    with names foo1, foo2, foo3::
+
+        >>> ds9_gather("foo*", "frame")
+        {'DS9:foo1': '1', 'DS9:foo2': '3', 'DS9:foo3': '1'}
+
+    All the instances are queried in a single xpa round trip.
+
+    Parameters
+    ----------
+    target : string
+        ds9 target template
+    paramlist : string, optional
+        command parameters (documented in the ds9 ref manual)
+    decode : bool, optional
+        decode the output, as in :meth:`DS9.get`
+    n : int, optional
+        maximum number of targets to query (default: 1024)
+
+    Returns
+    -------
+    dict
+        for each target, keyed by name (or by id if more ds9 instances share
+        the same name, as in :func:`ds9_openlist`), the returned data or
+        info, or None if the target returned an error
+
+    Raises
+    ------
+    ValueError
+        if no ds9 matches the template
+    """
+    replies = _xpa_all(xpa.xpagetall, target, (string_to_bytes(paramlist),),
+                       n)
+    return _gathered(target, paramlist, replies, decode)
+
+
+def ds9_map(instances, fn, max_workers=None):
+    """Call ``fn`` on each ds9 instance in a pool of threads, e.g. to send a
+    different image to each of them::
+
+        >>> ds9list = ds9_openlist("foo*")
+        >>> ds9_map(ds9list, lambda d: d.set_np2arr(images[d.target]))
+        [1, 1, 1]
+        >>> ds9_map("foo*", lambda d: d.get("frame"))
+        ['1', '1', '3']
+
+    The xpa connections of the DS9 objects are per thread, so ``fn`` can use
+    them freely, and the data are sent to the instances concurrently: each
+    connection has a copy of the XPA library of its own (see
+    :mod:`pyds9.xpa`), so the transfers to different instances overlap.
+
+    Parameters
+    ----------
+    instances : iterable of :class:`DS9`, or string
+        ds9 instances, or target template of the instances (see
+        :func:`ds9_openlist`)
+    fn : callable
+        function called with each :class:`DS9` object
+    max_workers : int, optional
+        maximum number of threads (default: one per instance)
+
+    Returns
+    -------
+    list
+        the values returned by ``fn``, in the order of the instances
+
+    Raises
+    ------
+    Exception
+        the first exception raised by ``fn``, once all the calls are done
+    """
+    if isinstance(instances, str):
+        instances = ds9_openlist(instances)
+    instances = list(instances)
+    if not instances:
+        return []
+    with ThreadPoolExecutor(max_workers or len(instances)) as executor:
+        futures = [executor.submit(fn, d) for d in instances]
+    return [future.result() for future in futures]
+
+
+def _gathered(target, paramlist, replies, decode):
+    """Decodes and strips the data returned by xpagetall as :meth:`DS9.get`
+    does, and keys them as described in :func:`_reply_keys`"""
+    if decode is None:
+        decode = paramlist not in ds9Globals['bin_cmd']
+    strip = paramlist not in DS9._nostrip
+    replies = [(name, data) for name, data, _ in replies]
+    gathered = _replies_by_key(target, replies)
+    for key, data in gathered.items():
+        if data is not None:
+            if decode:
+                data = bytes_to_string(data)
+            if strip:
+                data = data.strip()
+            gathered[key] = data
+    return gathered
+
+
+def _replies_by_key(target, replies):
+    """Converts the list of ``(name, reply)`` returned by the xpa*all
+    functions into a dictionary keyed as described in :func:`_reply_keys`"""
+    if not replies:
+        raise ValueError('no active ds9 found for target: %s' % target)
+    keys = _reply_keys([reply[0] for reply in replies])
+    return {key: reply[1] for key, reply in zip(keys, replies)}
+
+
+# parameters of the shapes drawn by DS9.set_regions, in ds9 order
+_REGION_SHAPES = {'circle': ('x', 'y', 'r'),
+                  'ellipse': ('x', 'y', 'a', 'b', 'angle'),
+                  'box': ('x', 'y', 'width', 'height', 'angle'),
+                  'point': ('x', 'y')}
+
+# coordinate systems in pixels, where 3 decimals are enough
+_PIXEL_COORDSYS = ('image', 'physical', 'detector', 'amplifier')
+
+
+def _ascii_numbers(values, decimals):
+    """Format ``values`` in fixed point, with at most ``decimals`` decimals
+
+    Returns
+    -------
+    list of numpy.ndarray
+        the successive characters of the numbers, as uint8 arrays, where the
+        padding (the leading zeros, and the trailing zeros of the decimals)
+        is 0
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    scaled = numpy.rint(numpy.abs(values) * 10. ** decimals)
+    if not numpy.all(scaled < 2 ** 62):
+        raise ValueError('region parameters must be finite and less than '
+                         '%g' % (2 ** 62 / 10. ** decimals))
+    largest = scaled.max(initial=0)
+    # divisions by a constant are much faster with 32 bits integers
+    remaining = scaled.astype(numpy.int32 if largest < 2 ** 31 else
+                              numpy.int64)
+    chars = []
+    # from the units of the last decimal up
+    trailing = numpy.ones(len(remaining), dtype=bool)
+    for position in range(max(len('%d' % largest), decimals + 1)):
+        quotient = remaining // 10
+        digit = (remaining - quotient * 10).astype(numpy.uint8) + ord('0')
+        if position < decimals:
+            trailing &= digit == ord('0')
+            digit[trailing] = 0
+        elif position > decimals:
+            digit[remaining == 0] = 0
+        chars.append(digit)
+        if position == decimals - 1:
+            chars.append(numpy.where(trailing, 0, ord('.')).astype(
+                numpy.uint8))
+        remaining = quotient
+    sign = (values < 0) & (scaled > 0)
+    chars.append(sign.astype(numpy.uint8) * ord('-'))
+    return chars[::-1]
+
+
+def _region_lines(shape, columns, props, decimals):
+    """Format one region per line, e.g. ``circle(100,200.5,3)\\n``
+
+    :param shape: region shape
+    :param columns: arrays of the parameters of the regions
+    :param props: None, or ``S`` array of the properties of each region
+    :param decimals: maximum number of decimals of the parameters
+
+    :rtype: bytes
+    """
+    chars = list(string_to_bytes(shape))
+    for i, column in enumerate(columns):
+        chars.append(ord(',' if i else '('))
+        chars += _ascii_numbers(column, decimals)
+    chars.append(ord(')'))
+    if props is not None:
+        chars += list(b' # ')
+    lines = numpy.empty((len(columns[0]), len(chars)), dtype=numpy.uint8)
+    for i, char in enumerate(chars):
+        lines[:, i] = char
+    if props is not None:
+        lines = numpy.hstack([lines, props.view(numpy.uint8).reshape(
+            len(props), -1)])
+    lines = numpy.hstack([lines, numpy.full((len(lines), 1), ord('\n'),
+                                            dtype=numpy.uint8)])
+    return lines.tobytes().translate(None, b'\0')
+
+
+# Tcl script running the commands recorded by DS9.batch: each command goes
+# through CommSet, which serves the xpa and SAMP set requests in ds9, and
+# its errors are written, with the index of the command, to a file read
+# back by pyds9
+_BATCH_PROLOGUE = r"""proc pyds9_set {i fn paramlist} {
+    global ds9 pyds9_errors
+    set ds9(msg) {}
+    if {[catch {CommSet $fn $paramlist} err]} {
+        lappend pyds9_errors "$i [string map {\n { }} $err]"
+    } elseif {[info exists ds9(msg,level)] && $ds9(msg,level) == {error}
+              && $ds9(msg) != {}} {
+        lappend pyds9_errors "$i [string map {\n { }} $ds9(msg)]"
+    }
+}
+set pyds9_errors {}"""
+
+_BATCH_EPILOGUE = """set pyds9_out [open %s w]
+puts $pyds9_out done
+puts -nonewline $pyds9_out [join $pyds9_errors \\n]
+close $pyds9_out"""
+
+_TCL_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+
+def _tcl_word(string):
+    """Quote ``string`` as a single Tcl word"""
+    if not string:
+        return '{}'
+    return re.sub(r'[^\w./:+-]',
+                  lambda m: _TCL_ESCAPES.get(m.group(), '\\' + m.group()),
+                  string)
+
+
+class _Batch(object):
+    """The set commands recorded by :meth:`DS9.batch`"""
+
+    def __init__(self):
+        # (paramlist, data or None)
+        self.commands = []
+        # (paramlist, error message)
+        self.errors = []
+        # shared memory segments and files used by the commands
+        self.resources = []
+
+    def add(self, paramlist, buf=None, blen=-1):
+        """Record a set command, with a copy of its data"""
+        data = None
+        if buf is not None:
+            data = memoryview(_to_buffer(buf)).cast('B')
+            data = bytes(data if blen < 0 else data[:blen])
+        self.commands.append((paramlist, data))
+
+    def keep(self, resource):
+        """Keep ``resource`` (with a ``close`` method) until the batch has
+        run"""
+        self.resources.append(resource)
+
+    def close(self):
+        """Release the resources kept for the commands"""
+        while self.resources:
+            self.resources.pop().close()
+
+
 class DS9(object):
     """
     The DS9 class supports communication with a running ds9 program via the xpa
@@ -446,13 +1216,17 @@ class DS9(object):
     # ds9 constructor args:
     # target => XPA template (only one target per object is allowed)
     # verify => use xpaaccess to check target before each method call
-    def __init__(self, target='DS9:*', start=True, wait=10, verify=True):
+    # verify_ttl => skip the check for that many seconds after a call
+    def __init__(self, target='DS9:*', start=True, wait=10, verify=True,
+                 verify_ttl=None):
         """
         :param target: the ds9 target name or id (default is all ds9 instances)
         :param start:  start ds9 if its not already running (optional: instead
          of True, you can specify a string or a list of ds9 command line args)
         :param wait: seconds to wait for ds9 to start
         :param verify: perform xpaaccess check before each set or get?
+        :param verify_ttl: if verify is on, skip the check for that many
+         seconds after a successful call (default: never skip it)
 
         :rtype: DS9 object connected to a single instance of ds9
 
@@ -494,29 +1268,51 @@ class DS9(object):
         not the case. Otherwise, the method return value can be used to detect
         failure.  Using verification allows ds9 methods to used in try/except
         constructs, at the expense of a slight decrease in performance.
+
+        If verify_ttl is a number of seconds, the check is skipped as long as
+        the last successful call to ds9 is more recent than that: a ds9 that
+        is no longer running is then detected by the failure of the method
+        call itself, which throws the same exception::
+
+            >>> d = DS9('foo1', verify_ttl=5)
+
+        The DS9 object keeps a persistent xpa connection to ds9, which is
+        reused by all the method calls. Use :meth:`close` (or the object as a
+        context manager) to release it::
+
+            >>> with DS9('foo1') as d:
+            ...     d.set('zoom to fit')
+
+        The object can be shared by several threads: each of them gets its
+        own connection, all released by :meth:`close`. See :func:`ds9_map`
+        to drive many ds9 instances from a pool of threads.
+
+        With ``ds9Globals['xpa_method'] = 'local'``, and unless the
+        XPA_METHOD environment variable is set, the ds9 started by the
+        constructor uses the xpa local method: the commands and data go
+        through unix sockets rather than tcp, which is faster. Such a ds9 is
+        not registered with the inet name server, so other xpa clients (e.g.
+        the xpaget and xpaset commands) only reach it with
+        ``XPA_METHOD=local``, or through the socket path returned by
+        :func:`ds9_targets`. The default, ``'inet'``, starts ds9 with the
+        method given by XPA_METHOD (tcp sockets if unset).
+
+        DS9 objects can be pickled, e.g. to be passed to the workers of a
+        :class:`concurrent.futures.ProcessPoolExecutor`: the unpickled
+        object talks to the same ds9 (by id) without any lookup. They can
+        also be used after a ``fork``: the child process opens its own
+        connections.
         """
-        tlist = xpa.xpaaccess(string_to_bytes(target), None, 1024)
-        # no need to convert, as tlist content is not used
+        self._reset()
+        tlist = ds9_targets(target)
         if not tlist and start:
             if '?' in target or '*' in target:
                 target = "ds9"
-            try:
-                args = shlex.split(start)
-            except AttributeError:      # Not a parsable string-like object
-                try:
-                    args = list(start)
-                except TypeError:       # Not an iterable object
-                    args = []
-            self.pid = subprocess.Popen(ds9Globals["progs"][1] +
-                                        ['-title', target] + args)
-
-            for i in range(wait):
-                tlist = xpa.xpaaccess(string_to_bytes(target), None, 1024)
-                if tlist:
-                    break
-                time.sleep(1)
+            self.pid = _start_ds9(target, start)
 
-        tlist = bytes_to_string(tlist)
+            # the inet name server is still polled, in case ds9 ignored the
+            # environment (e.g. when started by the mac OSX ``open``)
+            tlist = _wait_targets(target, wait, self.pid)
 
         if 'XPA_METHOD' in os.environ.keys():
             method = os.environ['XPA_METHOD']
@@ -545,8 +1341,42 @@ class DS9(object):
             a = tlist[0].split()
             self._target = target
             self._id = a[1]
+            if os.path.isabs(a[1]) and method not in ('local', 'unix'):
+                # found by _local_targets
+                method = 'local'
             self._method = method
             self.verify = verify
+            self.verify_ttl = verify_ttl
+
+    @classmethod
+    def launch(cls, target='DS9:*', start=True, wait=10, verify=True,
+               verify_ttl=None):
+        """Connect to ds9, starting it if necessary, without waiting for it
+
+        The arguments are those of the constructor, which runs in a separate
+        thread. Several ds9 instances can thus start at the same time::
+
+            >>> futures = [DS9.launch('foo%d' % i) for i in range(4)]
+            >>> ds9list = [f.result() for f in futures]
+
+        :rtype: :class:`concurrent.futures.Future` of the DS9 object (or of
+         the exception raised by the constructor)
+        """
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(cls(target, start, wait, verify,
+                                      verify_ttl))
+            except BaseException as e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
 
     @property
     def target(self):
@@ -563,13 +1393,134 @@ class DS9(object):
         '''Name of the xpa method used (read-only)'''
         return self._method
 
+    def _reset(self):
+        """Start with no connection to ds9 and no resource to send data,
+        e.g. after unpickling or forking"""
+        self._handles = {}
+        self._transport_data = {}
+        self._transport_lock = threading.Lock()
+        self._alive = None
+        # thread ident => _Batch being recorded
+        self._batches = {}
+        _instances.add(self)
+
+    def __getstate__(self):
+        return {'_target': self._target, '_id': self._id,
+                '_method': self._method, 'verify': self.verify,
+                'verify_ttl': self.verify_ttl}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # the xpa module might already be gone at interpreter exit
+            pass
+
+    def close(self):
+        """Close the persistent xpa connection to ds9, and release the shared
+        memory segments and temporary files used to send data, if any.
+
+        It is safe to call this method more than once, and to keep using the
+        object afterwards: a new connection is opened by the next call.
+        """
+        self._close_handles()
+        transport_data = getattr(self, '_transport_data', {})
+        while transport_data:
+            transport_data.popitem()[1].close()
+
+    def _xpacall(self, func, *args):
+        """Call the xpa routine ``func`` through the persistent connection.
+
+        If no access point answers, the connection of the calling thread is
+        assumed to be stale: it is closed and the call is retried once on a
+        fresh connection. If the
+        call still fails because ds9 is no longer running, a ValueError is
+        raised if ``verify`` is on.
+        """
+        try:
+            got = func(*args, xpa=self._handle())
+            if got is None or got == 0:
+                self._drop_handle()
+                got = func(*args, xpa=self._handle())
+        except ValueError:
+            # xpa errors are also what a ds9 that just went away looks like
+            if self.verify and not self._running():
+                raise ValueError('ds9 is no longer running (%s)' % self.id)
+            raise
+        if got is None or got == 0:
+            if self.verify:
+                raise ValueError('ds9 is no longer running (%s)' % self.id)
+        else:
+            self._alive = time.monotonic()
+        return got
+
+    def _handle(self):
+        """Return the persistent xpa connection of the calling thread,
+        opened by the current xpa backend (see :func:`set_xpa_backend`)
+
+        Each thread gets its own connection, so that the object can be used
+        from several threads at once.
+        """
+        thread = threading.get_ident()
+        backend, handle = self._handles.get(thread, (None, None))
+        if backend is not xpa:
+            if handle is not None:
+                backend.XPAClose(handle)
+            handle = xpa.XPAOpen(None)
+            self._handles[thread] = (xpa, handle)
+        return handle
+
+    @property
+    def _xpa(self):
+        """The persistent xpa connection of the calling thread, if any"""
+        return self._handles.get(threading.get_ident(), (None, None))[1]
+
+    def _drop_handle(self):
+        """Close the persistent xpa connection of the calling thread, leaving
+        those of the other threads alone"""
+        backend, handle = self._handles.pop(threading.get_ident(),
+                                            (None, None))
+        if handle is not None:
+            backend.XPAClose(handle)
+
+    def _close_handles(self):
+        """Close the persistent xpa connections of all the threads"""
+        handles = getattr(self, '_handles', {})
+        while handles:
+            backend, handle = handles.popitem()[1]
+            backend.XPAClose(handle)
+
+    def _running(self):
+        """Check if the access point of ds9 is still registered and alive"""
+        try:
+            return bool(xpa.xpaaccess(string_to_bytes(self.id), None, 1,
+                                      xpa=self._xpa))
+        except ValueError:
+            return False
+
     def _selftest(self):
         """
         An internal test to make sure that ds9 is still running."
+
+        If ``verify_ttl`` is a number of seconds, the test is skipped if ds9
+        answered more recently than that.
         """
-        if self.verify and not xpa.xpaaccess(string_to_bytes(self.id), None,
-                                             1):
-            raise ValueError('ds9 is no longer running (%s)' % self.id)
+        if not self.verify:
+            return
+        if (self.verify_ttl is not None and self._alive is not None and
+                time.monotonic() - self._alive < self.verify_ttl):
+            return
+        self._xpacall(xpa.xpaaccess, string_to_bytes(self.id), None, 1)
 
     def get(self, paramlist=None, decode=None):
         """
@@ -595,7 +1546,13 @@ class DS9(object):
         """
         self._selftest()
         # convert to byte string in python3
-        x = xpa.xpaget(string_to_bytes(self.id), string_to_bytes(paramlist), 1)
+        x = self._xpacall(xpa.xpaget, string_to_bytes(self.id),
+                          string_to_bytes(paramlist), 1)
+        return self._get_result(paramlist, x, decode)
+
+    def _get_result(self, paramlist, x, decode):
+        """Return the result of :meth:`get`, from the list of the buffers
+        returned by ds9"""
         if decode is None:
             decode = paramlist not in ds9Globals['bin_cmd']
         if decode:
@@ -623,11 +1580,16 @@ class DS9(object):
         while a return value of 0 indicates a failure.
 
         To send data (as well as the paramlist) to ds9, specify the data buffer
-        in the argument list. The data buffer must either be a string, a
-        numpy.ndarray,  or an array.array::
+        in the argument list. The data buffer must either be a string or an
+        object supporting the buffer protocol, like bytes, numpy.ndarray,
+        array.array, memoryview or mmap::
 
             >>> d.set("array [xdim=1024 ydim=1024 bitpix=-32]", arr)
 
+        Buffers are sent to ds9 straight from their own memory, without
+        intermediate copies. An optional ``blen`` limits the number of bytes
+        to send.
+
         Sending both a paramlist and data is the canonical way to send a region
         to ds9::
 
@@ -642,20 +1604,201 @@ class DS9(object):
         often is helpful to try the equivalent command using the Unix xpaset
         and xpaget programs.
 
+        Inside a :meth:`batch` block, the command is recorded rather than
+        sent, and 1 is returned.
         """
+        batch = self._current_batch()
+        if batch is not None:
+            batch.add(paramlist, buf, blen)
+            return 1
         self._selftest()
-        if type(buf) == numpy.ndarray:
-                s = buf.tostring()
-        elif type(buf) == array.array:
-            try:  # Python >= 3.2
-                s = buf.tobytes()
-            except AttributeError:
-                s = buf.tostring()
-        else:
-            s = string_to_bytes(buf)
+        return self._xpacall(xpa.xpaset, string_to_bytes(self.id),
+                             string_to_bytes(paramlist), _to_buffer(buf),
+                             blen, 1)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Record the :meth:`set` calls of a ``with`` block, and send them
+        all to ds9 at the end of the block, in a single round trip::
+
+            >>> with d.batch():
+            ...     d.set('scale zscale')
+            ...     d.set('cmap heat')
+            ...     d.set('regions', 'circle(100,100,20)')
+
+        The commands, and their data, go into a Tcl script that ds9 runs
+        with its ``source`` command: ds9 must run on this host. Otherwise,
+        or if ds9 cannot run the script, the commands are sent one by one.
+        All the commands are run, even if some of them fail; the failures
+        are reported at the end, by a single ValueError. The commands are
+        dropped if the block raises an exception.
+
+        Only the :meth:`set` calls of the thread running the block are
+        recorded, including those made by other methods (e.g.
+        :meth:`set_np2arr`); the other calls go to ds9 right away. Nested
+        blocks add their commands to the outermost one.
+
+        The data of the commands are copied when they are recorded, and the
+        shared memory segments and temporary files of the ``'shm'`` and
+        ``'file'`` transports are kept until the batch has run. Streamed
+        data cannot be batched: :meth:`set_from_fd`, ``set_fits(...,
+        stream=True)`` and arrays of 2 GiB or more sent through the xpa
+        socket raise a ValueError inside the block.
+
+        :rtype: the recorded batch, whose ``commands`` attribute lists the
+         (paramlist, data) of the commands, and ``errors`` attribute the
+         (paramlist, error message) of the failed ones, once sent
+        """
+        thread = threading.get_ident()
+        if thread in self._batches:
+            yield self._batches[thread]
+            return
+        batch = self._batches[thread] = _Batch()
+        try:
+            try:
+                yield batch
+            finally:
+                del self._batches[thread]
+            self._run_batch(batch)
+        finally:
+            batch.close()
+
+    def _current_batch(self):
+        """The batch recorded by the calling thread, or None"""
+        return self._batches.get(threading.get_ident())
+
+    def _run_batch(self, batch):
+        """Send the commands of ``batch``, and raise a ValueError listing the
+        failed ones, if any"""
+        errors = None
+        if len(batch.commands) > 1 and _transport.is_local(self):
+            errors = self._source_batch(batch.commands)
+        if errors is None:
+            errors = []
+            for paramlist, data in batch.commands:
+                try:
+                    self.set(paramlist, data)
+                except ValueError as e:
+                    errors.append((paramlist, str(e)))
+        batch.errors = errors
+        if errors:
+            raise ValueError('%d of %d batched commands failed:\n%s' % (
+                len(errors), len(batch.commands),
+                '\n'.join('  %s: %s' % error for error in errors)))
+
+    def _source_batch(self, commands):
+        """Have ds9 run ``commands`` from a Tcl script
+
+        :rtype: list of the (paramlist, error message) of the failed
+         commands, or None if ds9 could not run the script
+        """
+        tmpdir = _transport.transports['file'].dir
+        tmpfiles = []
+
+        def tmpfile(suffix, data):
+            tmp = _transport.TempFile(suffix=suffix, dir=tmpdir)
+            tmpfiles.append(tmp)
+            with open(tmp.path, 'wb') as f:
+                f.write(data)
+            return tmp.path
+
+        try:
+            script = [_BATCH_PROLOGUE]
+            for i, (paramlist, data) in enumerate(commands):
+                path = '' if data is None else tmpfile('.dat', data)
+                script.append('pyds9_set %d %s %s' % (i, _tcl_word(path),
+                                                      _tcl_word(paramlist)))
+            out = tmpfile('.out', b'')
+            script.append(_BATCH_EPILOGUE % _tcl_word(out))
+            path = tmpfile('.tcl', string_to_bytes('\n'.join(script)))
+            try:
+                self.set('source ' + path)
+            except ValueError:
+                return None
+            with open(out) as f:
+                lines = f.read().split('\n')
+        finally:
+            for tmp in tmpfiles:
+                tmp.decref()
+
+        if lines[0] != 'done':
+            return None
+        errors = []
+        for line in filter(None, lines[1:]):
+            i, message = line.split(' ', 1)
+            errors.append((commands[int(i)][0], message))
+        if len(errors) == len(commands) and all(
+                'CommSet' in message for _, message in errors):
+            # a ds9 that runs the xpa commands differently
+            return None
+        return errors
+
+    def set_from_fd(self, paramlist, fd):
+        """Send to ds9 the data read from a file descriptor.
+
+        The data are read and sent in small chunks until the end of file, so
+        that e.g. large files or pipes can be sent with constant memory use::
+
+            >>> with open('/scratch/image.fits', 'rb') as f:
+            ...     d.set_from_fd('fits', f)
+            1
 
-        return xpa.xpaset(string_to_bytes(self.id), string_to_bytes(paramlist),
-                          s, blen, 1)
+        Parameters
+        ----------
+        paramlist : string
+            command parameters (documented in the ds9 ref manual)
+        fd : int or file object
+            file descriptor, or file object, open for reading
+
+        Returns
+        -------
+        int
+            1 for success, 0 for failure
+
+        Raises
+        ------
+        ValueError
+            inside a :meth:`batch` block, which cannot record streamed data
+        """
+        if self._current_batch() is not None:
+            raise ValueError('streamed data cannot be sent in a batch')
+        self._selftest()
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        return self._xpacall(xpa.xpasetfd, string_to_bytes(self.id),
+                             string_to_bytes(paramlist), fd, 1)
+
+    def _set_from_writer(self, paramlist, writer):
+        """Send to ds9 the data that ``writer(fileobj)`` writes to a pipe
+
+        ``writer`` is run in a separate thread, while the data are sent.
+        """
+        if self._current_batch() is not None:
+            raise ValueError('streamed data cannot be sent in a batch')
+        rfd, wfd = os.pipe()
+        errors = []
+
+        def run():
+            try:
+                with os.fdopen(wfd, 'wb') as f:
+                    writer(f)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            success = self.set_from_fd(paramlist, rfd)
+        finally:
+            # a writer blocked on a full pipe gets a BrokenPipeError
+            os.close(rfd)
+            thread.join()
+        # a broken pipe means that ds9 stopped reading: its error, if any,
+        # has already been reported
+        if errors and not isinstance(errors[0], BrokenPipeError):
+            raise errors[0]
+        return success
 
     def info(self, paramlist):
         """
@@ -665,8 +1808,8 @@ class DS9(object):
         messages to ds9. (NB: ds9 currently does not support info messages.)
         """
         self._selftest()
-        return xpa.xpainfo(string_to_bytes(self.id),
-                           string_to_bytes(paramlist), 1)
+        return self._xpacall(xpa.xpainfo, string_to_bytes(self.id),
+                             string_to_bytes(paramlist), 1)
 
     def access(self):
         """
@@ -676,9 +1819,43 @@ class DS9(object):
         by making a direct contact with ds9 itself.
         """
         self._selftest()
-        x = xpa.xpaaccess(string_to_bytes(self.id), None, 1)
+        x = self._xpacall(xpa.xpaaccess, string_to_bytes(self.id), None, 1)
         return bytes_to_string(x[0])
 
+    def get_to_file(self, paramlist, path_or_fd):
+        """Stream the data returned by ds9 to a file.
+
+        The data are written while they are received, so that e.g. images
+        larger than the available memory can be saved::
+
+            >>> d.get_to_file('fits', '/scratch/image.fits')
+            1
+
+        Parameters
+        ----------
+        paramlist : string
+            command parameters (documented in the ds9 ref manual)
+        path_or_fd : string, int or file object
+            name of the file to (over)write, or file descriptor or file object
+            open for writing
+
+        Returns
+        -------
+        int
+            1 for success, 0 for failure
+        """
+        self._selftest()
+        if isinstance(path_or_fd, int):
+            fd = path_or_fd
+        elif hasattr(path_or_fd, 'fileno'):
+            path_or_fd.flush()
+            fd = path_or_fd.fileno()
+        else:
+            with open(path_or_fd, 'wb') as f:
+                return self.get_to_file(paramlist, f)
+        return self._xpacall(xpa.xpagetfd, string_to_bytes(self.id),
+                             string_to_bytes(paramlist), [fd], 1)
+
     def _ds9_fits_to_bytes(self):
         '''Returns a ds9 FITS as a byte stream
 
@@ -742,12 +1919,13 @@ class DS9(object):
         Prior to pyds9 1.9 the behavior when there was no file
         was not specified.
         """
+        from astropy.io import fits
         idata = self._ds9_fits_to_bytes()
         if idata is None:
             return None
         return fits.open(idata)
 
-    def set_fits(self, hdul):
+    def set_fits(self, hdul, stream=False, transport=None):
         """Display an astropy FITS in ds9.
 
         Examples
@@ -756,10 +1934,25 @@ class DS9(object):
         >>> d.set_fits(nhdul)
         1
 
+        Use ``stream=True`` for large FITS: the serialized FITS is sent to
+        ds9 in small chunks while it is being written, instead of being built
+        in memory first::
+
+        >>> d.set_fits(nhdul, stream=True)
+        1
+
+        If ds9 runs on the same host, the FITS can be passed through a
+        shared memory segment or a temporary file instead of the xpa socket
+        (see :meth:`set_np2arr`). Streaming always uses the xpa socket.
+
         Parameters
         ----------
         hdul : :class:`astropy.io.fits.HDUList`
             FITS object to display
+        stream : bool, optional
+            stream the FITS to ds9
+        transport : {'xpa', 'shm', 'file', 'auto'}, optional
+            how to send the data to ds9 (default: ``ds9Globals['transport']``)
 
         Returns
         -------
@@ -772,11 +1965,23 @@ class DS9(object):
         ValueError
             if the input is not an astropy HDUList
         """
+        from astropy.io import fits
         if not isinstance(hdul, fits.HDUList):
             raise ValueError('The input must be an astropy HDUList')
-        return self._hdulist_to_ds9_fits(hdul)
-
-    def get_arr2np(self):
+        self._selftest()
+        if stream:
+            return self._set_from_writer('fits', hdul.writeto)
+        if transport is None:
+            transport = ds9Globals['transport']
+        nbytes = 0
+        if transport == 'auto':
+            nbytes = sum(hdu.filebytes() for hdu in hdul)
+        # the shared memory segment or file kept by the transport is reused
+        with self._transport_lock:
+            sender = _transport.select(self, transport, nbytes)
+            return sender.send_fits(self, hdul)
+
+    def get_arr2np(self, out=None, path=None):
         """Convert a FITS file or an array from ds9 into a numpy array.
 
         Examples
@@ -792,25 +1997,72 @@ class DS9(object):
         >>> arr.max()
         51.0
 
+        The data, together with their shape and type, are received from ds9
+        in a single transfer of the image as a FITS file. The returned array
+        is writable and uses directly the memory where the data have been
+        received, unless they are scaled: like astropy, get_arr2np returns
+        the values of scaled data (BSCALE/BZERO) as floating point numbers.
+        Alternatively the data can be copied into a preallocated
+        array::
+
+        >>> arr = numpy.empty((1024, 1024), dtype=numpy.float32)
+        >>> d.get_arr2np(out=arr)
+
+        or streamed to a file, with constant memory use, and returned as a
+        :class:`numpy.memmap`::
+
+        >>> arr = d.get_arr2np(out='memmap', path='/scratch/cube.arr')
+
+        Parameters
+        ----------
+        out : numpy array or 'memmap', optional
+            C-contiguous array, with the shape and dtype of the ds9 data,
+            where the data are stored; if ``'memmap'`` the data are written to
+            ``path`` and memory-mapped
+        path : string, optional
+            file where to store the data if ``out='memmap'``; by default an
+            anonymous temporary file is used. The file holds the FITS header
+            received from ds9, followed by the data in native byte order.
+            Scaled data (BSCALE/BZERO) are returned as floating point
+            values, in memory rather than memory-mapped
+
         Returns
         -------
         numpy array
+            the data, or ``out`` if given
 
+        Raises
+        ------
+        ValueError
+            if ``out`` does not match the ds9 data
         """
         self._selftest()
-        w = int(self.get('fits width'))
-        h = int(self.get('fits height'))
-        d = int(self.get('fits depth'))
-        bp = int(self.get('fits bitpix'))
-        s = self.get('array')
-        if d > 1:
-            arr = numpy.frombuffer(s, dtype=_bp2np(bp)).reshape((d, h, w))
+        if isinstance(out, str):
+            if out != 'memmap':
+                raise ValueError("out must be an array or 'memmap'")
+            return self._get_arr2memmap(path)
+
+        bufs = self._xpacall(xpa.xpagetbuf, string_to_bytes(self.id),
+                             b'fits', 1)
+        if not bufs:
+            raise ValueError('no data available in ds9 (%s)' % self.id)
+        # the array takes ownership of the xpa buffer
+        return _copy_to(_fits_to_array(numpy.asarray(bufs[0])), out)
+
+    def _get_arr2memmap(self, path=None):
+        """Stream the ds9 FITS image to ``path`` and memory-map its data"""
+        if path is None:
+            f = tempfile.TemporaryFile()
         else:
-            arr = numpy.frombuffer(s, dtype=_bp2np(bp)).reshape((h, w))
-        # if sys.byteorder != 'big': arr.byteswap(True)
-        return arr
-
-    def set_np2arr(self, arr, dtype=None):
+            f = open(path, 'w+b')
+        with f:
+            self.get_to_file('fits', f)
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError('no data available in ds9 (%s)' % self.id)
+            return _fits_to_array(numpy.memmap(f, dtype=numpy.uint8,
+                                               mode='r+'))
+
+    def set_np2arr(self, arr, dtype=None, transport=None):
         """After manipulating or otherwise modifying a numpy array (or making a
         new one), you can display it in ds9 using this method, which takes the
         array as its first argument::
@@ -836,12 +2088,35 @@ class DS9(object):
         ``np.uint32`` is sent as ``int64`` data, and ``np.float16`` is sent as
         ``float32`` data.
 
+        C-contiguous arrays that need no conversion, including
+        ``numpy.memmap`` arrays, are sent to ds9 without being copied.
+
+        If ds9 runs on the same host, the array can be passed through a
+        shared memory segment (``transport='shm'``) or a temporary file,
+        in ``/dev/shm`` if available (``transport='file'``), instead of the xpa
+        socket. This is much faster for large arrays or for a stream of
+        frames (e.g. from a camera)::
+
+            >>> for frame in frames:
+            ...     d.set_np2arr(frame, transport='shm')
+
+        The segment is reused as long as the arrays have the same size. The
+        segment and the temporary file are released by :meth:`close`.
+
+        With ``transport='auto'``, the transport is chosen from the size of
+        the array, whether ds9 runs on the same host and a measurement of the
+        speed of each transport, made (in a new, temporary ds9 frame) the
+        first time it is needed: see :mod:`pyds9.transport`. The default
+        transport is ``ds9Globals['transport']``.
+
         Parameters
         ----------
         arr : numpy array
             array to send to ds9
         dtype: data type, optional
             convert array to ``dtype`` before sending
+        transport : {'xpa', 'shm', 'file', 'auto'}, optional
+            how to send the data to ds9
 
         Returns
         -------
@@ -854,46 +2129,385 @@ class DS9(object):
             if the input is not a numpy array
         """
         self._selftest()
-        if type(arr) != numpy.ndarray:
-            raise ValueError('requires numpy.ndarray as input')
-        if dtype and dtype != arr.dtype:
-            narr = arr.astype(dtype)
-        else:
-            if arr.dtype == numpy.int8:
-                narr = arr.astype(numpy.int16)
-            elif arr.dtype == numpy.uint32:
-                narr = arr.astype(numpy.int64)
-            elif hasattr(numpy, "float16") and arr.dtype == numpy.float16:
-                narr = arr.astype(numpy.float32)
-            else:
-                narr = arr
-        if not narr.flags['C_CONTIGUOUS']:
-            narr = numpy.ascontiguousarray(narr)
-        bp = _np2bp(narr.dtype)
-        buf = narr.tostring('C')
-        blen = len(buf)
-
-        # note that this needs the "endian=" part because sometimes it's
-        # left out completely
-        endianness = ''
-        if narr.dtype.byteorder == '=':
-            endianness = ',endian=' + sys.byteorder
-        elif narr.dtype.byteorder == '<':
-            endianness = ',endian=little'
-        elif narr.dtype.byteorder == '>':
-            endianness = ',endian=big'
-
-        paramlist = 'array '
-        if narr.ndim == 2:
-            paramlist += '[xdim={shape[1]},ydim={shape[0]}'
-        elif narr.ndim == 3:
-            paramlist += '[xdim={shape[2]},ydim={shape[1]},zdim={shape[0]}'
-        else:
-            raise ValueError('The input numpy array must have 2 or 3'
-                             ' dimensions, not {}'.format(narr.ndim))
-        paramlist += ',bitpix={bp}{endian}]'
-        return self.set(paramlist.format(shape=narr.shape, bp=bp,
-                                         endian=endianness), buf, blen+1)
+        narr, paramlist = _np2arr(arr, dtype)
+        if transport is None:
+            transport = ds9Globals['transport']
+        # the shared memory segment or file kept by the transport is reused
+        with self._transport_lock:
+            sender = _transport.select(self, transport, narr.nbytes)
+            return sender.send_array(self, narr, paramlist)
+
+    def set_regions(self, shape='circle', coordsys='image', props=None,
+                    decimals=None, **params):
+        """Draw many regions of the same shape, from arrays of their
+        parameters::
+
+            >>> d.set_regions('circle', x=cat['x'], y=cat['y'], r=3,
+            ...               props={'color': 'red'})
+            1
+
+        The parameters of each shape are:
+
+        - circle: x, y, r
+        - ellipse: x, y, a, b, angle
+        - box: x, y, width, height, angle
+        - point: x, y
+
+        where angle is optional (default: 0). They are numbers or arrays,
+        broadcast against each other. The sizes are in the units of
+        ``coordsys``: pixels, or degrees for the sky coordinates.
+
+        The regions are formatted with array operations rather than Python
+        loops: the coordinate system and the common properties are given
+        once, followed by one line per region, e.g. ``circle(100,200.5,3)``.
+        Large sets of regions are formatted and streamed to ds9 in chunks of
+        ``REGIONS_CHUNK`` regions.
+
+        Parameters
+        ----------
+        shape : string, optional
+            region shape (default: ``'circle'``)
+        coordsys : string, optional
+            coordinate system of the parameters, e.g. ``'image'``
+            (default), ``'physical'`` or ``'fk5'``
+        props : dict, string, or array of strings, optional
+            region properties, e.g. ``{'color': 'red', 'width': 2}`` or
+            ``'color=red width=2'`` for all the regions, or one string per
+            region
+        decimals : int, optional
+            maximum number of decimals of the parameters (default: 3 for
+            the pixel coordinates, 7 for the sky coordinates)
+        params : numbers or arrays
+            parameters of the shape
+
+        Returns
+        -------
+        int
+            1 for success, 0 for failure
+        """
+        try:
+            names = _REGION_SHAPES[shape]
+        except KeyError:
+            raise ValueError('unknown region shape: %s' % shape)
+        unknown = sorted(set(params) - set(names))
+        if unknown:
+            raise ValueError('unknown %s parameters: %s' %
+                             (shape, ', '.join(unknown)))
+        if 'angle' in names:
+            params.setdefault('angle', 0)
+        missing = [name for name in names if name not in params]
+        if missing:
+            raise ValueError('missing %s parameters: %s' %
+                             (shape, ', '.join(missing)))
+        columns = [column.ravel() for column in numpy.broadcast_arrays(
+            *[numpy.asarray(params[name], dtype=numpy.float64)
+              for name in names])]
+        if decimals is None:
+            decimals = 3 if coordsys in _PIXEL_COORDSYS else 7
+
+        header = ''
+        if isinstance(props, dict):
+            props = ' '.join('%s=%s' % item for item in props.items())
+        if isinstance(props, str):
+            header = 'global %s\n' % props
+            props = None
+        elif props is not None:
+            props = numpy.char.encode(numpy.broadcast_to(
+                numpy.asarray(props, dtype=str), columns[0].shape), 'utf-8')
+        header = string_to_bytes(header + coordsys + '\n')
+
+        def chunks():
+            yield header
+            for start in range(0, len(columns[0]), REGIONS_CHUNK):
+                stop = start + REGIONS_CHUNK
+                yield _region_lines(
+                    shape, [column[start:stop] for column in columns],
+                    None if props is None else props[start:stop], decimals)
+
+        if (len(columns[0]) <= REGIONS_CHUNK or
+                self._current_batch() is not None):
+            return self.set('regions', b''.join(chunks()))
+
+        def write(f):
+            for chunk in chunks():
+                f.write(chunk)
+
+        return self._set_from_writer('regions', write)
+
+
+class AsyncDS9(object):
+    """
+    The AsyncDS9 class gives asyncio programs access to a ds9 instance: it
+    accepts the same arguments as :class:`DS9` and provides awaitable
+    versions of its methods::
+
+        >>> async with AsyncDS9('foo1') as d:
+        ...     await d.set('file casa.fits')
+        ...     arr = await d.get_arr2np()
+
+    The commands and the data sent or received through the xpa socket go
+    through the coroutines of the pure-Python xpa client,
+    :mod:`pyds9.aioxpa`, on connections kept by the object: they never block
+    the event loop, overlap with each other (e.g. with
+    :func:`asyncio.gather`, on one or many ds9 instances) and can be
+    cancelled.
+
+    The lookup of ds9 (and its startup, if requested) is done by a
+    :class:`DS9` object, in a worker thread, on the first awaited call or in
+    :meth:`connect`. The worker thread also runs the transfers that use the
+    resources kept by that object: the ``'shm'``, ``'file'`` and ``'auto'``
+    transports, the streaming of FITS files and the memory-mapped arrays.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._ds9 = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._client = _aioxpa.Client()
+
+    @property
+    def ds9(self):
+        '''The underlying :class:`DS9` object, or None if not connected yet
+        (read-only)'''
+        return self._ds9
+
+    def _sync_call(self, name, *args, **kwargs):
+        """Call the ``name`` method of the DS9 object (in the worker thread)"""
+        if self._ds9 is None:
+            self._ds9 = DS9(*self._args, **self._kwargs)
+        if name is not None:
+            return getattr(self._ds9, name)(*args, **kwargs)
+
+    async def _call(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        func = functools.partial(self._sync_call, name, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, func)
+
+    async def _request(self, coroutine, paramlist, *args):
+        """Await the aioxpa ``coroutine`` (e.g. :func:`pyds9.aioxpa.get`) on
+        the ds9 instance, and return its replies
+
+        A ValueError is raised with the error message of ds9, or if ds9 does
+        not answer and ``verify`` is on, as in :meth:`DS9._xpacall`.
+        """
+        if self._ds9 is None:
+            await self.connect()
+        replies = await coroutine(string_to_bytes(self._ds9.id),
+                                  string_to_bytes(paramlist), *args, n=1,
+                                  client=self._client)
+        errmsg = ''.join(reply[-1] + '\n' for reply in replies if reply[-1])
+        if errmsg:
+            raise ValueError(errmsg)
+        if not replies and self._ds9.verify:
+            raise ValueError('ds9 is no longer running (%s)' % self._ds9.id)
+        return replies
+
+    async def _get_data(self, paramlist):
+        """Return the data returned by ds9 for ``paramlist`` (bytearray),
+        or None if there are none"""
+        replies = await self._request(_aioxpa.get, paramlist)
+        return replies[0][1] if replies and replies[0][1] else None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Connect to ds9, starting it if necessary"""
+        await self._call(None)
+
+    async def close(self):
+        """Close the connections to ds9 and stop the worker thread"""
+        self._client.close()
+        if self._ds9 is not None:
+            await self._call('close')
+        self._executor.shutdown(wait=False)
+
+    async def get(self, paramlist=None, decode=None):
+        """Awaitable :meth:`DS9.get`"""
+        data = await self._get_data(paramlist)
+        return self._ds9._get_result(paramlist,
+                                     [] if data is None else [bytes(data)],
+                                     decode)
+
+    async def set(self, paramlist, buf=None, blen=-1):
+        """Awaitable :meth:`DS9.set`"""
+        buf = _to_buffer(buf)
+        if buf is not None and blen >= 0:
+            buf = memoryview(buf).cast('B')[:blen]
+        return len(await self._request(_aioxpa.set, paramlist, buf))
+
+    async def info(self, paramlist):
+        """Awaitable :meth:`DS9.info`"""
+        return len(await self._request(_aioxpa.info, paramlist))
+
+    async def access(self):
+        """Awaitable :meth:`DS9.access`"""
+        return (await self._request(_aioxpa.access, None))[0][0]
+
+    async def get_arr2np(self, out=None, path=None):
+        """Awaitable :meth:`DS9.get_arr2np`"""
+        if isinstance(out, str):
+            return await self._call('get_arr2np', out=out, path=path)
+        data = await self._get_data('fits')
+        if data is None:
+            raise ValueError('no data available in ds9 (%s)' % self._ds9.id)
+        return _copy_to(_fits_to_array(numpy.frombuffer(data, numpy.uint8)),
+                        out)
+
+    async def set_np2arr(self, arr, dtype=None, transport=None):
+        """Awaitable :meth:`DS9.set_np2arr`"""
+        if (transport or ds9Globals['transport']) != 'xpa':
+            return await self._call('set_np2arr', arr, dtype=dtype,
+                                    transport=transport)
+        narr, paramlist = _np2arr(arr, dtype)
+        return await self.set(paramlist, narr)
+
+    async def get_fits(self):
+        """Awaitable :meth:`DS9.get_fits`"""
+        from astropy.io import fits
+        data = await self._get_data('fits')
+        return None if data is None else fits.open(BytesIO(data))
+
+    async def set_fits(self, hdul, stream=False, transport=None):
+        """Awaitable :meth:`DS9.set_fits`"""
+        from astropy.io import fits
+        if stream or (transport or ds9Globals['transport']) != 'xpa':
+            return await self._call('set_fits', hdul, stream=stream,
+                                    transport=transport)
+        if not isinstance(hdul, fits.HDUList):
+            raise ValueError('The input must be an astropy HDUList')
+        with contextlib.closing(BytesIO()) as f:
+            # serialized in the worker thread, not to block the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, hdul.writeto, f)
+            return await self.set('fits', f.getvalue())
+
+
+class DS9Group(object):
+    """
+    The DS9Group class addresses all the ds9 instances matching a target
+    template as a whole, e.g. to drive a wall of displays::
+
+        >>> wall = DS9Group('wall*')
+        >>> wall.set('file /home/eric/data/casa.fits')
+        {'DS9:wall1': None, 'DS9:wall2': None}
+        >>> wall.set('pan to 345.29 58.87 wcs fk5')
+        >>> wall.get('pan wcs fk5')
+        {'DS9:wall1': '345.29 58.87', 'DS9:wall2': '345.29 58.87'}
+
+    Each command is sent once to all the instances (see
+    :func:`ds9_broadcast`), through a persistent xpa connection (one per
+    thread, as in :class:`DS9`) that is released with :meth:`close` or by
+    using the group as a context manager.
+    Instances started or stopped after the creation of the group are picked
+    up by the next call.
+    """
+
+    def __init__(self, target='DS9:*', n=1024):
+        """
+        :param target: the ds9 target template (default is all ds9 instances)
+        :param n: maximum number of targets to address
+        """
+        self._reset()
+        self._target = target
+        self.n = n
+
+    def _reset(self):
+        """Start with no connection, e.g. after unpickling or forking"""
+        self._handles = {}
+        _instances.add(self)
+
+    def __getstate__(self):
+        return {'_target': self._target, 'n': self.n}
+
+    __setstate__ = DS9.__setstate__
+
+    @property
+    def target(self):
+        '''Target template of the ds9 instances (read-only)'''
+        return self._target
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # the xpa module might already be gone at interpreter exit
+            pass
+
+    def close(self):
+        """Close the persistent xpa connections"""
+        self._close_handles()
+
+    # the persistent connections are handled as in DS9
+    _handle = DS9._handle
+    _xpa = DS9._xpa
+    _drop_handle = DS9._drop_handle
+    _close_handles = DS9._close_handles
+
+    def _xpacall(self, func, *args):
+        """Call the xpa routine ``func`` through the persistent connection,
+        retrying once on a fresh connection if no access point answers (see
+        :meth:`DS9._xpacall`)"""
+        got = func(*args, xpa=self._handle())
+        if not got:
+            self._drop_handle()
+            got = func(*args, xpa=self._handle())
+        return got
+
+    def targets(self):
+        """
+        :rtype: list of the targets in the group (name and id)
+        """
+        return ds9_targets(self.target, self.n)
+
+    def get(self, paramlist=None, decode=None):
+        """
+        :param paramlist: command parameters (documented in the ds9 ref manual)
+        :param decode: decode the output, as in :meth:`DS9.get`
+
+        :rtype: for each target, the returned data or info (see
+            :func:`ds9_gather`)
+        """
+        replies = self._xpacall(_xpa_all, xpa.xpagetall, self.target,
+                                (string_to_bytes(paramlist),), self.n)
+        return _gathered(self.target, paramlist, replies, decode)
+
+    def set(self, paramlist, buf=None, blen=-1):
+        """
+        :param paramlist: command parameters (documented in the ds9 ref manual)
+
+        :rtype: for each target, None on success or the error message (see
+            :func:`ds9_broadcast`)
+        """
+        replies = self._xpacall(_xpa_all, xpa.xpasetall, self.target,
+                                (string_to_bytes(paramlist), _to_buffer(buf),
+                                 blen), self.n)
+        return _replies_by_key(self.target, replies)
+
+
+# the DS9 and DS9Group objects, reset in forked child processes: their
+# connections and shared memory segments are left to the parent
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    for obj in list(_instances):
+        obj._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
 
 
 class ds9(DS9):
@@ -911,29 +2525,17 @@ class ds9(DS9):
         super(ds9, self).__init__(*args, **kwargs)
 
 
-# start xpans, if necessary
-# it seems that this must be done at import time, so that we can sense the
-# case where xpa is not installed, and ds9 is started before python
-if "PYDS9_NOXPANS" not in os.environ.keys():
-    ds9_xpans()
-
-
 def test():
     print("starting quick test for pyds9 version " + __version__)
 
     # start ds9 if necessary
-    tries = 0
     print("looking for our 'pytest' ds9 ...")
-    while ds9_targets("pytest") is None:
-        if tries == 0:
-            print("starting ds9 ...")
-            subprocess.Popen(ds9Globals["progs"][1] + ['-title', 'pytest'])
-            print("\nwaiting for ds9 to be available ",)
-        elif tries == 10:
+    if ds9_targets("pytest") is None:
+        print("starting ds9 ...")
+        p = subprocess.Popen(ds9Globals["progs"][1] + ['-title', 'pytest'])
+        print("\nwaiting for ds9 to be available ...")
+        if _wait_targets("pytest", 10, p) is None:
             raise ValueError("tired of waiting for ds9!")
-        print(".",)
-        time.sleep(1)
-        tries += 1
     print(" ds9 is running!")
 
     print("\ntesting ds9 support ...")
@@ -0,0 +1,102 @@
+"""
+System V shared memory segments, used to pass data to a ds9 running on the
+same host
+"""
+
+import ctypes
+import os
+
+import numpy
+
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.shmget
+except (OSError, AttributeError):
+    # e.g. on Windows
+    libc = None
+else:
+    ## int shmget(key_t key, size_t size, int shmflg);
+    libc.shmget.restype = ctypes.c_int
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    ## void *shmat(int shmid, const void *shmaddr, int shmflg);
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    ## int shmdt(const void *shmaddr);
+    libc.shmdt.restype = ctypes.c_int
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    ## int shmctl(int shmid, int cmd, struct shmid_ds *buf);
+    libc.shmctl.restype = ctypes.c_int
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+# returned by shmat on failure
+_SHMAT_FAILED = ctypes.c_void_p(-1).value
+
+
+def _oserror():
+    errno = ctypes.get_errno()
+    return OSError(errno, os.strerror(errno))
+
+
+class SharedMemory(object):
+    """A private shared memory segment of ``size`` bytes, attached to this
+    process
+
+    The segment is identified by its :attr:`shmid`, which can be passed to
+    ds9 (e.g. ``shm array shmid <shmid> [...]``). It is removed when closed
+    or garbage collected: processes still attached to it, like ds9, keep
+    their mapping until they detach. A forked child process only detaches
+    from the segments inherited from its parent.
+    """
+
+    def __init__(self, size):
+        if libc is None:
+            raise OSError('shared memory is not supported on this platform')
+        self._addr = None
+        self._pid = os.getpid()
+        self.size = size
+        self.shmid = libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if self.shmid == -1:
+            raise _oserror()
+        addr = libc.shmat(self.shmid, None, 0)
+        if addr == _SHMAT_FAILED:
+            err = _oserror()
+            libc.shmctl(self.shmid, IPC_RMID, None)
+            raise err
+        self._addr = addr
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Detach and remove the segment"""
+        if self._addr is not None:
+            libc.shmdt(self._addr)
+            if self._pid == os.getpid():
+                libc.shmctl(self.shmid, IPC_RMID, None)
+            self._addr = None
+
+    @property
+    def closed(self):
+        return self._addr is None
+
+    def asarray(self, dtype=numpy.uint8, shape=None):
+        """Return a numpy array using the memory of the segment
+
+        The array must not be used after the segment is closed.
+        """
+        if self._addr is None:
+            raise ValueError('shared memory segment is closed')
+        buf = (ctypes.c_char * self.size).from_address(self._addr)
+        dtype = numpy.dtype(dtype)
+        if shape is None:
+            count = self.size // dtype.itemsize
+        else:
+            count = int(numpy.prod(shape))
+        arr = numpy.frombuffer(buf, dtype=dtype, count=count)
+        if shape is not None:
+            arr = arr.reshape(shape)
+        return arr
@@ -1,14 +1,25 @@
+import asyncio
+import array
 from collections import Counter
 import contextlib
+import getpass
+from io import BytesIO
+import os
+import pickle
 import random
+import re
+import struct
 import subprocess as sp
+import sys
+import threading
 import time
+import tracemalloc
 
 from astropy.io import fits
 import numpy as np
 import pytest
 
-from pyds9 import pyds9
+from pyds9 import aioxpa, pool, pyds9, transport, xpa
 
 parametrize = pytest.mark.parametrize
 
@@ -110,6 +121,23 @@ def test_np2bp_fail():
         pyds9._np2bp(np.dtype(str))
 
 
+@parametrize('obj', [b'abcd', bytearray(b'abcd'), memoryview(b'abcd'),
+                     array.array('h', [1, 2]), np.arange(4, dtype=np.uint8)])
+def test_buffer(obj):
+    """The buffer memory is exposed without copies"""
+    with xpa._buffer(obj) as (ptr, size):
+        assert size == 4
+        assert (xpa.ctypes.string_at(ptr, size) ==
+                memoryview(obj).cast('B').tobytes())
+
+
+def test_buffer_fail():
+    """Non contiguous buffers are rejected"""
+    with pytest.raises((BufferError, ValueError)):
+        with xpa._buffer(np.zeros((4, 4))[:, 1]):
+            pass
+
+
 def test_ds9_targets_empty():
     '''If no ds9 instance is running, ds9_targets returns None'''
     targets = pyds9.ds9_targets()
@@ -207,6 +235,37 @@ def test_ds9_set_fits(tmpdir, ds9_obj, test_fits):
     assert diff.identical
 
 
+def test_ds9_set_fits_stream(ds9_obj, test_data_dir):
+    '''Stream the astropy fits to ds9'''
+    fits_file = test_data_dir.join('test_3D.fits')
+
+    with fits.open(fits_file.strpath) as hdul:
+        success = ds9_obj.set_fits(hdul, stream=True)
+
+    assert success == 1
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(),
+                                  fits.getdata(fits_file.strpath))
+
+
+def test_ds9_set_from_fd(ds9_obj, test_fits):
+    '''Send a fits file from a file object'''
+    with test_fits.open('rb') as f:
+        assert ds9_obj.set_from_fd('fits', f) == 1
+
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(),
+                                  fits.getdata(test_fits.strpath))
+
+
+def test_ds9_set_from_fd_after_set(ds9_obj, test_fits):
+    '''set_from_fd sends the file, not the buffer of a previous set'''
+    ds9_obj.set_np2arr(np.zeros((4, 5), dtype=np.int16), transport='xpa')
+    with test_fits.open('rb') as f:
+        assert ds9_obj.set_from_fd('fits', f) == 1
+
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(),
+                                  fits.getdata(test_fits.strpath))
+
+
 fits_names = parametrize('fits_name', ['test.fits', 'test_3D.fits'])
 
 
@@ -226,6 +285,116 @@ def test_get_arr2np(ds9_obj, test_data_dir, fits_name):
     np.testing.assert_array_equal(arr, fits_data)
 
 
+@type_mapping
+def test_get_arr2np_roundtrip(ds9_obj, monkeypatch, dtype, bitpix):
+    '''get_arr2np gets shape, type and data of any image in one transfer'''
+    data = np.arange(-6, 6).astype(dtype).reshape(3, 4)
+    ds9_obj.set_np2arr(data)
+
+    calls = []
+    xpagetbuf = xpa.xpagetbuf
+
+    def counting_xpagetbuf(*args, **kwargs):
+        calls.append(args)
+        return xpagetbuf(*args, **kwargs)
+
+    monkeypatch.setattr(xpa, 'xpagetbuf', counting_xpagetbuf)
+    arr = ds9_obj.get_arr2np()
+
+    assert len(calls) == 1
+    assert arr.dtype == dtype and arr.dtype.isnative
+    np.testing.assert_array_equal(arr, data)
+
+
+def test_get_arr2np_out(ds9_obj, test_data_dir):
+    '''Get the data on ds9 into a preallocated numpy array'''
+    fits_file = test_data_dir.join('test_3D.fits')
+    ds9_obj.set('file {}'.format(fits_file))
+    fits_data = fits.getdata(fits_file.strpath)
+
+    arr = ds9_obj.get_arr2np()
+    assert arr.flags['WRITEABLE']
+
+    out = np.empty_like(arr)
+    assert ds9_obj.get_arr2np(out=out) is out
+    np.testing.assert_array_equal(out, fits_data)
+
+    with pytest.raises(ValueError, match='out must be'):
+        ds9_obj.get_arr2np(out=out[0])
+
+
+def _scaled_hdu(dtype, bscale, bzero, blank=None):
+    data = np.arange(-12, 12).astype(dtype).reshape(4, 6)
+    hdu = fits.PrimaryHDU(data)
+    hdu.header['BSCALE'] = bscale
+    hdu.header['BZERO'] = bzero
+    if blank is not None:
+        hdu.header['BLANK'] = blank
+    return fits.HDUList([hdu])
+
+
+@parametrize('hdul', [
+    # integers stored with an offset
+    fits.HDUList([fits.PrimaryHDU(np.arange(24, dtype=dtype).reshape(4, 6) *
+                                  np.iinfo(dtype).max // 23)])
+    for dtype in (np.int8, np.uint16, np.uint32, np.uint64)] + [
+    # scaled data
+    _scaled_hdu(np.int16, 0.5, 10, blank=-12),
+    _scaled_hdu(np.int32, 1, 1000),
+    _scaled_hdu(np.uint8, 2, -3),
+    _scaled_hdu(np.float32, 1.5, 0),
+    # cubes with degenerate axes
+    fits.HDUList([fits.PrimaryHDU(np.ones((1, 4, 6), np.float32))]),
+    fits.HDUList([fits.PrimaryHDU(np.ones((1, 1, 4, 6), np.float32))]),
+    # image after an empty primary HDU and a table
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU.from_columns(
+                      [fits.Column('a', 'J', array=np.arange(5))]),
+                  fits.ImageHDU(np.arange(24, dtype='>f8').reshape(4, 6))]),
+])
+def test_fits_to_array(hdul):
+    '''The image received from ds9 as a FITS file is decoded as astropy
+    does'''
+    f = BytesIO()
+    hdul.writeto(f)
+    arr = pyds9._fits_to_array(np.frombuffer(bytearray(f.getvalue()),
+                                             np.uint8))
+    with fits.open(BytesIO(f.getvalue())) as expected:
+        data = next(hdu.data for hdu in expected if hdu.is_image and
+                    hdu.data is not None)
+        while data.ndim > 3 and data.shape[0] == 1:
+            data = data[0]
+        assert arr.dtype == data.dtype.newbyteorder('=')
+        assert arr.shape == data.shape
+        np.testing.assert_array_equal(arr, data)
+
+
+@parametrize('path', [None, 'cube.arr'])
+def test_get_arr2np_memmap(tmpdir, ds9_obj, test_data_dir, path):
+    '''Stream the data on ds9 to a memory mapped file'''
+    fits_file = test_data_dir.join('test_3D.fits')
+    ds9_obj.set('file {}'.format(fits_file))
+
+    if path is not None:
+        path = tmpdir.join(path).strpath
+    arr = ds9_obj.get_arr2np(out='memmap', path=path)
+
+    assert isinstance(arr, np.memmap)
+    np.testing.assert_array_equal(arr, fits.getdata(fits_file.strpath))
+
+
+def test_ds9_get_to_file(tmpdir, ds9_obj, test_fits):
+    '''Stream the ds9 fits to a file'''
+    ds9_obj.set('file {}'.format(test_fits))
+
+    out_fits = tmpdir.join('out.fits')
+    assert ds9_obj.get_to_file('fits', out_fits.strpath) == 1
+
+    diff = fits.FITSDiff(test_fits.strpath, out_fits.strpath,
+                         ignore_comments=['*', ])
+    assert diff.identical
+
+
 @parametrize('input_', ['random_type', np.arange(5)])
 def test_ds9_set_np2arr_fail(tmpdir, ds9_obj, input_):
     '''Set the passing wrong arrays'''
@@ -252,6 +421,134 @@ def test_ds9_set_np2arr(tmpdir, ds9_obj, test_data_dir, fits_name):
     np.testing.assert_array_equal(fits_data, fits.getdata(out_fits.strpath))
 
 
+def test_ds9_set_np2arr_nocopy(ds9_obj):
+    """set_np2arr sends read-only arrays and memmaps without copying them"""
+    data = np.arange(1024 * 1024, dtype=np.float64).reshape(1024, 1024)
+    data.flags.writeable = False
+
+    tracemalloc.start()
+    try:
+        success = ds9_obj.set_np2arr(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert success == 1
+    assert peak < data.nbytes / 10
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), data)
+
+
+def test_ds9_set_np2arr_shm(ds9_obj):
+    '''set_np2arr passes the arrays through a reused shared memory segment'''
+    frames = np.arange(3 * 64 * 32, dtype=np.float32).reshape(3, 64, 32)
+
+    segments = []
+    for frame in frames:
+        assert ds9_obj.set_np2arr(frame, transport='shm') == 1
+        np.testing.assert_array_equal(ds9_obj.get_arr2np(), frame)
+        segments.append(ds9_obj._transport_data['shm'])
+    segment = segments[0]
+    assert segments == [segment] * len(frames)
+
+    assert ds9_obj.set_np2arr(frames, transport='shm') == 1
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), frames)
+    assert segment.closed
+    assert ds9_obj._transport_data['shm'].size == frames.nbytes
+
+    ds9_obj.close()
+    assert not ds9_obj._transport_data
+
+
+@parametrize('transport', ['xpa', 'shm', 'file', 'auto'])
+def test_ds9_set_fits_transport(ds9_obj, test_fits, transport):
+    '''set_fits sends the FITS with any transport'''
+    with fits.open(test_fits.strpath) as hdul:
+        assert ds9_obj.set_fits(hdul, transport=transport) == 1
+
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(),
+                                  fits.getdata(test_fits.strpath))
+
+    with pytest.raises(ValueError, match='unknown transport'):
+        ds9_obj.set_fits(hdul, transport='carrier pigeon')
+
+
+def test_ds9_set_np2arr_file(ds9_obj):
+    '''set_np2arr passes the arrays through temporary files, removed when
+    they are no longer displayed'''
+    data = np.arange(200, dtype=np.int32).reshape(10, 20)
+
+    assert ds9_obj.set_np2arr(data, transport='file') == 1
+    first = ds9_obj._transport_data['file'].path
+    assert os.path.exists(first)
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), data)
+
+    assert ds9_obj.set_np2arr(data * 2, transport='file') == 1
+    second = ds9_obj._transport_data['file'].path
+    assert not os.path.exists(first)
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), data * 2)
+
+    ds9_obj.close()
+    assert not os.path.exists(second)
+
+
+def test_ds9_set_np2arr_stream(ds9_obj, monkeypatch):
+    '''Oversized arrays are streamed to ds9 in chunks'''
+    monkeypatch.setattr(transport.XPATransport, 'stream_bytes', 1000)
+    monkeypatch.setattr(transport.XPATransport, 'chunk_bytes', 4000)
+    writes = []
+    set_from_writer = ds9_obj._set_from_writer
+
+    def counting_set_from_writer(paramlist, writer):
+        def counting_writer(f):
+            write = f.write
+            f.write = lambda data: writes.append(len(data)) or write(data)
+            writer(f)
+        return set_from_writer(paramlist, counting_writer)
+
+    monkeypatch.setattr(ds9_obj, '_set_from_writer', counting_set_from_writer)
+    cube = np.arange(5 * 30 * 20, dtype=np.float64).reshape(5, 30, 20)
+
+    assert ds9_obj.set_np2arr(cube, transport='xpa') == 1
+    assert writes == [4000] * 6
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), cube)
+
+
+def test_temp_file_refcount():
+    '''Temporary files are removed when the last reference is released'''
+    tmp = transport.TempFile()
+    assert tmp.incref() is tmp
+    tmp.decref()
+    assert os.path.exists(tmp.path)
+    tmp.decref()
+    assert not os.path.exists(tmp.path)
+    with pytest.raises(ValueError, match='already been removed'):
+        tmp.incref()
+
+
+def test_transport_auto(ds9_obj, monkeypatch):
+    '''The automatic selection uses the xpa socket for small payloads and
+    remote ds9s, and the calibrated fastest transport otherwise'''
+    assert transport.is_local(ds9_obj)
+    assert transport.select(ds9_obj, 'auto', 1000).name == 'xpa'
+
+    monkeypatch.setattr(transport, '_calibration', {})
+    costs = transport.calibrate(ds9_obj)
+    assert set(costs) == {'xpa', 'shm', 'file'}
+    monkeypatch.setitem(transport._calibration, 'file', (0, 0))
+    assert transport.select(ds9_obj, 'auto', 1 << 24).name == 'file'
+
+    monkeypatch.setitem(transport._local_ids, ds9_obj.id, False)
+    assert transport.select(ds9_obj, 'auto', 1 << 24).name == 'xpa'
+
+
+def test_ds9_set_buffer(ds9_obj):
+    """set accepts any buffer-protocol object"""
+    regions = array.array('b', b'image; circle(10,10,5)')
+
+    assert ds9_obj.set('regions', memoryview(regions)) == 1
+    assert 'circle(10,10,5)' in ds9_obj.get('regions')
+
+
 @parametrize('attr', ['target', 'id', 'method'])
 def test_ds9_readonly_props(ds9_obj, attr):
     '''Make sure that readonly attributes are such'''
@@ -300,3 +597,885 @@ def test_ds9_invalid_xpa_set(ds9_obj):
     with pytest.raises(ValueError,
                        match=r'XPA\$ERROR undefined command for this xpa'):
         ds9_obj.set(INVALID_XPA_METHOD)
+
+
+def test_ds9_close(ds9_obj):
+    '''The persistent connection is reopened after close'''
+    ds9_obj.get('frame')
+    assert ds9_obj._xpa is not None
+
+    ds9_obj.close()
+    assert ds9_obj._xpa is None
+    # closing twice is fine
+    ds9_obj.close()
+
+    assert ds9_obj.get('frame')
+
+
+def test_ds9_context_manager(ds9_title):
+    '''The DS9 object closes its connection on exiting a with block'''
+    with pyds9.DS9(target='*' + ds9_title + '*') as ds9:
+        ds9.get('frame')
+        assert ds9._xpa is not None
+
+    assert ds9._xpa is None
+
+
+def test_async_ds9_gather(run_ds9s):
+    '''AsyncDS9 drives several ds9 instances concurrently'''
+    names = ['test.async1', 'test.async2']
+
+    async def frames():
+        ds9s = [pyds9.AsyncDS9(target='*' + name + '*') for name in names]
+        try:
+            return await asyncio.gather(*[d.get('frame') for d in ds9s])
+        finally:
+            for d in ds9s:
+                await d.close()
+
+    with run_ds9s(*names):
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(frames())
+        finally:
+            loop.close()
+
+    assert result == ['1', '1']
+
+
+def test_async_ds9_aioxpa(xpa_standin, monkeypatch):
+    '''AsyncDS9 awaits the aioxpa coroutines, without the worker thread:
+    concurrent commands overlap'''
+    xpa_standin.values.update(slow=b'slow')
+    calls = []
+
+    async def run():
+        async with pyds9.AsyncDS9('PYDS9TEST:' + xpa_standin.name,
+                                  start=False) as d:
+            call = d._call
+
+            async def spy(name, *args, **kwargs):
+                calls.append(name)
+                return await call(name, *args, **kwargs)
+
+            monkeypatch.setattr(d, '_call', spy)
+            start = time.monotonic()
+            replies = await asyncio.gather(*[d.get('slow') for _ in range(3)])
+            elapsed = time.monotonic() - start
+            assert await d.set('key', b'abcd', 2) == 1
+            assert await d.get('key') == 'ab'
+            with pytest.raises(ValueError, match='undefined command'):
+                await d.get('nonexistent')
+        return replies, elapsed
+
+    loop = asyncio.new_event_loop()
+    try:
+        replies, elapsed = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    assert replies == ['slow'] * 3
+    assert elapsed < 2
+    assert calls == ['close']
+
+
+def test_ds9_broadcast(run_ds9s):
+    '''ds9_broadcast sends a command to all matching ds9s in one call'''
+    names = ['test.bc1', 'test.bc1', 'test.bc2']
+    with run_ds9s(*names):
+        replies = pyds9.ds9_broadcast('test.bc*', 'frame 3')
+        frames = [d.get('frame') for d in pyds9.ds9_openlist('test.bc*')]
+        errors = pyds9.ds9_broadcast('test.bc*', 'nonexistent')
+
+    assert len(replies) == len(names)
+    assert 'DS9:test.bc2' in replies
+    assert list(replies.values()) == [None] * len(names)
+    assert frames == ['3'] * len(names)
+    assert all('XPA$ERROR' in err for err in errors.values())
+
+
+def test_ds9_broadcast_fail():
+    '''ds9_broadcast fails if no ds9 matches the template'''
+    with pytest.raises(ValueError, match='no active ds9'):
+        pyds9.ds9_broadcast('test.nonexistent*', 'frame 2')
+
+
+def test_ds9_group_set(run_ds9s):
+    '''DS9Group sends data once to all the ds9s in the group'''
+    names = ['test.grp1', 'test.grp2']
+    arr = np.arange(6, dtype=np.int16).reshape(2, 3)
+    with run_ds9s(*names):
+        with pyds9.DS9Group('test.grp*') as group:
+            assert len(group.targets()) == len(names)
+            replies = group.set('array [xdim=3 ydim=2 bitpix=16]', arr)
+            assert group._xpa is not None
+        arrs = [d.get_arr2np() for d in pyds9.ds9_openlist('test.grp*')]
+
+    assert group._xpa is None
+    assert sorted(replies) == ['DS9:' + name for name in names]
+    for out in arrs:
+        np.testing.assert_array_equal(out, arr)
+
+
+def test_ds9_gather(run_ds9s):
+    '''ds9_gather returns the reply of each ds9 in one call'''
+    names = ['test.ga1', 'test.ga1', 'test.ga2']
+    with run_ds9s(*names):
+        pyds9.DS9('test.ga2').set('frame 4')
+        frames = pyds9.ds9_gather('test.ga*', 'frame')
+        raw = pyds9.ds9_gather('test.ga*', 'frame', decode=False)
+        errors = pyds9.ds9_gather('test.ga*', 'nonexistent')
+        ids = [t.split()[1] for t in pyds9.ds9_targets('DS9:test.ga1')]
+
+    assert frames.pop('DS9:test.ga2') == '4'
+    assert sorted(frames) == sorted(ids)
+    assert list(frames.values()) == ['1', '1']
+    assert set(raw.values()) == {b'1', b'4'}
+    assert list(errors.values()) == [None] * len(names)
+
+
+def test_ds9_group_get(run_ds9s):
+    '''DS9Group.get returns the reply of each ds9 in the group'''
+    names = ['test.grp3', 'test.grp4']
+    with run_ds9s(*names):
+        with pyds9.DS9Group('test.grp*') as group:
+            group.set('zoom to 4')
+            zooms = group.get('zoom')
+
+    assert zooms == {'DS9:' + name: '4' for name in names}
+
+
+def test_xpa_scratch(ds9_obj):
+    '''The arrays passed to libxpa are reused and left empty after a call'''
+    bufs, lens, names, errs = xpa._scratch(8)
+    assert xpa._scratch(8)[0] is bufs
+    assert xpa._scratch(4)[0] is not bufs
+
+    assert xpa.xpaget(ds9_obj.id.encode(), b'frame', 8) == [b'1\n']
+    assert xpa.xpaaccess(ds9_obj.id.encode(), None, 8)
+    assert not any(bufs) and not any(names) and not any(errs)
+
+
+def test_ds9_verify_ttl(run_ds9s, monkeypatch):
+    '''With verify_ttl=<seconds>, recent calls skip the xpaaccess check and a
+    stopped ds9 is detected by the failure of the call itself'''
+    calls = []
+    xpaaccess = xpa.xpaaccess
+
+    def counting_xpaaccess(*args, **kwargs):
+        calls.append(args)
+        return xpaaccess(*args, **kwargs)
+
+    with run_ds9s('test.ttl'):
+        ds9 = pyds9.DS9('test.ttl', verify_ttl=60)
+        ds9_always = pyds9.DS9('test.ttl', verify=1)
+        monkeypatch.setattr(xpa, 'xpaaccess', counting_xpaaccess)
+        ds9.set('frame 2')
+        assert ds9.get('frame') == '2'
+        assert len(calls) == 1
+
+        # any true verify checks before each call
+        del calls[:]
+        ds9_always.set('frame 1')
+        assert ds9_always.get('frame') == '1'
+        assert len(calls) == 2
+
+    with pytest.raises(ValueError, match='no longer running'):
+        ds9.get('frame')
+
+
+class XPAStandIn(object):
+    '''Minimal XPA access point, written with asyncio and registered in
+    xpans, standing in for ds9: ``xpaset <key>`` stores the data sent with
+    the command and ``xpaget <key>`` returns them; ``xpaget slow`` waits one
+    second before answering'''
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+        self._data = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+
+    def __enter__(self):
+        self.thread.start()
+        self._call(self._start())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._call(self._stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(10)
+
+    async def _start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.method = '7f000001:%d' % port
+        reader, self.ns = await asyncio.open_connection('127.0.0.1',
+                                                        aioxpa.XPA_NSPORT)
+        self.ns.write('add {} PYDS9TEST:{} gs {}\n'.format(
+            self.method, self.name, getpass.getuser()).encode())
+        assert (await reader.readline()).startswith(b'XPA$OK')
+
+    async def _stop(self):
+        self.ns.close()
+        self.server.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    async def _serve(self, reader, writer):
+        where = '(PYDS9TEST:%s %s)' % (self.name, self.method)
+        line = await reader.readline()
+        while line:
+            cmd, *args = line.decode().split()
+            if cmd == 'xpadata':
+                # data channel of the request args[1]
+                self._data.pop(args[1]).set_result((reader, writer))
+                return
+            tid = args[args.index('-i') + 1]
+            key = args[args.index('-i') + 3:]
+            key = key[0] if key else ''
+            status = 'XPA$OK'
+            if cmd in ('xpaget', 'xpaset'):
+                self._data[tid] = self.loop.create_future()
+                writer.write(('%s XPA$DATA connect %s 0 %s\n' % (
+                    tid, tid, where)).encode())
+                await reader.readline()
+                data_reader, data_writer = await self._data[tid]
+                if cmd == 'xpaset':
+                    self.values[key] = await data_reader.read()
+                else:
+                    if key == 'slow':
+                        await asyncio.sleep(1)
+                    if key not in self.values:
+                        status = 'XPA$ERROR undefined command for this xpa'
+                    data_writer.write(self.values.get(key, b''))
+                data_writer.close()
+            else:
+                writer.write(('%s XPA$NODATA %s\n' % (tid, where)).encode())
+                await reader.readline()
+            writer.write(('%s %s %s\n' % (tid, status, where)).encode())
+            line = await reader.readline()
+        writer.close()
+
+
+@pytest.fixture
+def xpa_standin():
+    '''Run a XPAStandIn access point, starting xpans if needed'''
+    if not pyds9.ds9_xpans():
+        time.sleep(1)
+    with XPAStandIn('test.{}'.format(random.randint(0, 10000))) as standin:
+        yield standin
+
+
+def test_aioxpa(xpa_standin):
+    '''The pure-Python client talks to an access point through xpans'''
+    target = 'PYDS9TEST:' + xpa_standin.name
+    name = '{} {}'.format(target, xpa_standin.method)
+    data = np.arange(100000, dtype=np.int32)
+
+    assert aioxpa.xpaaccess(target) == [name]
+    assert aioxpa.xpaaccess(xpa_standin.method) == [name]
+    assert aioxpa.xpaaccess('PYDS9TEST:nonexistent') is None
+    assert aioxpa.xpaset(target, 'key', data) == 1
+    assert aioxpa.xpaget(target, 'key') == [data.tobytes()]
+    assert aioxpa.xpagetall(target, 'nonexistent') == [
+        (name, None, 'XPA$ERROR undefined command for this xpa ({})'
+         .format(name))]
+    with pytest.raises(ValueError, match='undefined command'):
+        aioxpa.xpaget(target, 'nonexistent')
+
+    client = aioxpa.XPAOpen(None)
+    try:
+        assert aioxpa.xpaset(target, 'key', b'abcd', 2, xpa=client) == 1
+        assert aioxpa.xpaget(target, 'key', xpa=client) == [b'ab']
+        # the connections are kept for the next calls
+        assert len(client._idle) == 2
+        assert aioxpa.xpaget(target, 'key', xpa=client) == [b'ab']
+    finally:
+        aioxpa.XPAClose(client)
+
+
+def test_aioxpa_cancel(xpa_standin):
+    '''The requests of the pure-Python client can be cancelled'''
+    target = 'PYDS9TEST:' + xpa_standin.name
+    xpa_standin.values.update(slow=b'slow', key=b'key')
+
+    async def cancel():
+        client = aioxpa.Client()
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(aioxpa.get(target, 'slow',
+                                                  client=client), 0.1)
+            return await aioxpa.get(target, 'key', client=client)
+        finally:
+            client.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        replies = loop.run_until_complete(cancel())
+    finally:
+        loop.close()
+
+    assert [data for _, data, _ in replies] == [b'key']
+
+
+def test_aioxpa_running_loop(xpa_standin):
+    '''The synchronous functions of the pure-Python client can be called
+    from a running event loop'''
+    target = 'PYDS9TEST:' + xpa_standin.name
+    client = aioxpa.XPAOpen(None)
+
+    async def calls():
+        assert aioxpa.xpaset(target, 'key', b'abcd', xpa=client) == 1
+        return aioxpa.xpaget(target, 'key', xpa=client)
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(calls()) == [b'abcd']
+        # and the same connections outside of it
+        assert aioxpa.xpaget(target, 'key', xpa=client) == [b'abcd']
+    finally:
+        loop.close()
+        aioxpa.XPAClose(client)
+
+
+def test_ds9_xpa_backend(ds9_obj, test_data_dir):
+    '''DS9 objects switch to the pure-Python client at runtime'''
+    fits_data = fits.getdata(test_data_dir.join('test.fits').strpath)
+    try:
+        ds9_obj.get('frame')
+        pyds9.set_xpa_backend('asyncio')
+        ds9_obj.set_np2arr(fits_data)
+        assert isinstance(ds9_obj._xpa, aioxpa.Client)
+        np.testing.assert_array_equal(ds9_obj.get_arr2np(), fits_data)
+        assert pyds9.ds9_targets('*' + ds9_obj.target.split(':')[1])
+    finally:
+        pyds9.set_xpa_backend('libxpa')
+    assert ds9_obj.get('frame') == '1'
+    assert not isinstance(ds9_obj._xpa, aioxpa.Client)
+
+    with pytest.raises(ValueError, match='unknown xpa backend'):
+        pyds9.set_xpa_backend('nonexistent')
+
+
+def test_ds9_local_method(monkeypatch):
+    '''With xpa_method 'local', the ds9 started by DS9 uses unix sockets, and
+    is found and addressed like the ones registered with the inet name
+    server'''
+    name = 'test.local{}'.format(random.randint(0, 10000))
+    monkeypatch.setitem(pyds9.ds9Globals, 'xpa_method', 'local')
+    d = pyds9.DS9(name)
+    # left by a ds9 that is gone
+    dead = sp.Popen(['true'])
+    dead.wait()
+    stale = os.path.join(aioxpa.tmpdir(), 'DS9_{}.{}'.format(name, dead.pid))
+    open(stale, 'w').close()
+    try:
+        assert d.method == 'local'
+        assert d.id.startswith(aioxpa.tmpdir())
+        assert transport.is_local(d)
+        assert pyds9.ds9_targets(name) == ['DS9:{} {}'.format(name, d.id)]
+        assert pyds9.ds9_broadcast(name, 'frame 2') == {'DS9:' + name: None}
+        assert pyds9.ds9_gather('DS9:' + name, 'frame') == {
+            'DS9:' + name: '2'}
+        with pyds9.DS9Group('*' + name) as group:
+            assert group.get('frame') == {'DS9:' + name: '2'}
+
+        pyds9.ds9Globals['xpa_method'] = 'inet'
+        assert pyds9.ds9_targets(name) is None
+    finally:
+        os.remove(stale)
+        d.pid.kill()
+        d.pid.communicate()
+
+
+def test_ds9_threads(ds9_obj):
+    '''A DS9 object can be used by several threads at once, each of them
+    with its own xpa connection'''
+    nthreads = 4
+    barrier = threading.Barrier(nthreads)
+    handles = []
+    errors = []
+
+    def work():
+        try:
+            barrier.wait()
+            for i in range(50):
+                assert ds9_obj.get('frame') == '1'
+            handles.append(ds9_obj._xpa)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert len(set(handles)) == nthreads
+    assert ds9_obj._xpa is None
+    ds9_obj.close()
+    assert ds9_obj._handles == {}
+
+
+def test_ds9_map(run_ds9s):
+    '''ds9_map calls a function on each ds9 from a pool of threads'''
+    names = ['test.map1', 'test.map2', 'test.map3']
+    with run_ds9s(*names):
+        ds9list = pyds9.ds9_openlist('test.map*')
+        replies = pyds9.ds9_map(ds9list,
+                                lambda d: d.set('frame ' + d.target[-1]))
+        frames = pyds9.ds9_map('test.map*',
+                               lambda d: (d.target, d.get('frame')),
+                               max_workers=2)
+        with pytest.raises(ValueError, match=r'XPA\$ERROR'):
+            pyds9.ds9_map(ds9list, lambda d: d.get(INVALID_XPA_METHOD))
+
+    assert replies == [1, 1, 1]
+    assert sorted(frames) == [('DS9:' + name, name[-1]) for name in names]
+    assert pyds9.ds9_map([], lambda d: d.get('frame')) == []
+
+
+def test_xpa_handle_libraries(ds9_obj):
+    '''Each persistent handle has a copy of libxpa of its own: a call through
+    a handle does not wait for the calls through the other ones, and a handle
+    closed while its copy is busy is closed when the call ends'''
+    target = ds9_obj.id.encode()
+    busy, other = xpa.XPAOpen(None), xpa.XPAOpen(None)
+    assert busy.library is not other.library
+    try:
+        result = []
+        with busy.library:
+            # as if a call through busy was waiting for a hung ds9
+            thread = threading.Thread(target=lambda: result.append(
+                xpa.xpaget(target, b'frame', 1, xpa=other)))
+            thread.start()
+            thread.join(10)
+            assert result == [[b'1\n']]
+            # e.g. DS9.__del__ run by the garbage collector in this thread
+            xpa.XPAClose(busy)
+            assert list(busy.library.closing) == [busy.ptr]
+        assert not busy.library.closing
+    finally:
+        xpa.XPAClose(other)
+
+
+def test_ds9_retry_own_handle(ds9_obj):
+    '''A call retried on a fresh connection leaves the connections of the
+    other threads alone'''
+    thread = threading.Thread(target=ds9_obj.get, args=('frame',))
+    thread.start()
+    thread.join()
+    ds9_obj.get('frame')
+    others = {ident: handle for ident, handle in ds9_obj._handles.items()
+              if ident != threading.get_ident()}
+    stale = ds9_obj._xpa
+    replies = iter([0, 1])
+    assert ds9_obj._xpacall(lambda xpa=None: next(replies)) == 1
+    assert ds9_obj._xpa is not stale
+    assert all(ds9_obj._handles[ident] is handle
+               for ident, handle in others.items())
+
+
+def test_ds9_pickle(ds9_obj, monkeypatch):
+    '''An unpickled DS9 object talks to the same ds9 without any lookup'''
+    ds9_obj.get('frame')
+    group = pyds9.DS9Group(ds9_obj.target)
+    group.get('frame')
+
+    def no_lookup(*args, **kwargs):
+        raise AssertionError('unexpected lookup')
+
+    monkeypatch.setattr(pyds9, 'ds9_targets', no_lookup)
+    d = pickle.loads(pickle.dumps(ds9_obj))
+    group2 = pickle.loads(pickle.dumps(group))
+    monkeypatch.undo()
+
+    assert (d.target, d.id, d.method, d.verify) == (
+        ds9_obj.target, ds9_obj.id, ds9_obj.method, ds9_obj.verify)
+    assert d._xpa is None
+    assert d.get('frame') == '1'
+    assert group2.get('frame') == {ds9_obj.target: '1'}
+
+
+def test_ds9_fork(ds9_obj):
+    '''A forked child opens its own connection and shared memory segment,
+    and leaves those of the parent alone'''
+    frame = np.arange(64 * 32, dtype=np.float32).reshape(64, 32)
+    assert ds9_obj.set_np2arr(frame, transport='shm') == 1
+    handle = ds9_obj._xpa
+    segment = ds9_obj._transport_data['shm']
+
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ok = (ds9_obj._xpa is None and not ds9_obj._transport_data and
+                  ds9_obj.set_np2arr(frame + 1, transport='shm') == 1 and
+                  ds9_obj.get('frame') == '1')
+            ds9_obj.close()
+        finally:
+            os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), frame + 1)
+    assert ds9_obj.set_np2arr(frame, transport='shm') == 1
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), frame)
+    assert ds9_obj._xpa == handle
+    assert ds9_obj._transport_data['shm'] is segment
+
+
+def test_import():
+    '''Importing pyds9 neither imports astropy, nor looks for the
+    executables, nor checks xpans'''
+    code = ('import sys, pyds9; from pyds9 import pyds9 as p; '
+            'print("astropy" in sys.modules, "progs" in p.ds9Globals, '
+            'p._xpans_checked)')
+    env = dict(os.environ, PATH='')
+    out = sp.check_output([sys.executable, '-c', code], env=env,
+                          cwd=os.path.dirname(os.path.dirname(pyds9.__file__)))
+    assert out.split() == [b'False', b'False', b'False']
+
+
+def test_ds9_running(tmpdir):
+    '''ds9 processes are found from /proc in a few milliseconds, even with
+    thousands of processes'''
+    nprocs = 5000
+    for pid in range(1, nprocs + 1):
+        tmpdir.join(str(pid), 'comm').write('bash\n', ensure=True)
+        tmpdir.join(str(pid), 'cmdline').write('-bash\0')
+    tmpdir.join('self', 'comm').write('ds9\n', ensure=True)
+    tmpdir.mkdir(str(nprocs + 1))  # gone while scanning
+    tmpdir.join(str(nprocs + 2), 'comm').write('python3\n', ensure=True)
+    tmpdir.join(str(nprocs + 2), 'cmdline').write('python3\0ds9.py\0')
+    proc = tmpdir.strpath
+
+    start = time.perf_counter()
+    assert not pyds9._ds9_running(proc)
+    elapsed = time.perf_counter() - start
+    assert elapsed < 0.25
+
+    for comm, cmdline in [('ds9\n', 'ds9\0'),
+                          # versioned binary
+                          ('ds9-8.5\n', '/opt/ds9-8.5\0-title\0x\0'),
+                          # started under another name
+                          ('saods9\n', '/usr/lib/saods9/ds9\0-title\0x\0')]:
+        tmpdir.join(str(nprocs + 3), 'comm').write(comm, ensure=True)
+        tmpdir.join(str(nprocs + 3), 'cmdline').write(cmdline)
+        assert pyds9._ds9_running(proc)
+
+    assert pyds9._ds9_running() in (True, False)
+
+
+def test_ds9_launch():
+    '''DS9.launch starts ds9 in the background, and the new ds9 is found
+    as soon as it answers rather than on the next whole second'''
+    name = 'test.launch{}'.format(random.randint(0, 10000))
+    future = pyds9.DS9.launch(name)
+    d = future.result(timeout=30)
+    try:
+        assert d.target == name
+        assert d.get('frame') == '1'
+    finally:
+        d.set('exit')
+        d.close()
+
+    with pytest.raises(ValueError, match='no active ds9'):
+        pyds9.DS9.launch(name + 'missing', start=False).result(timeout=30)
+
+    # no need to wait for a ds9 that failed to start
+    failed = sp.Popen(['false'])
+    start = time.perf_counter()
+    assert pyds9._wait_targets(name + 'missing', 10, failed) is None
+    assert time.perf_counter() - start < 1
+
+
+def test_ds9_pool():
+    '''DS9Pool leases ds9 instances started in advance, resets them when
+    they are returned, and replaces the dead ones'''
+    prefix = 'test.pool{}.'.format(random.randint(0, 10000))
+    with pool.DS9Pool(2, prefix=prefix) as ds9pool:
+        assert len(pyds9.ds9_targets(prefix + '*')) == 2
+        with ds9pool.lease() as d:
+            assert d.target.startswith(prefix)
+            d.set('cmap heat')
+            assert ds9pool.stats()['busy'] == 1
+        assert d.get('cmap') == 'grey'
+
+        d1 = ds9pool.acquire()
+        d2 = ds9pool.acquire()
+        assert {d1.target, d2.target} == {prefix + '0', prefix + '1'}
+        with pytest.raises(ValueError, match='no ds9 available'):
+            ds9pool.acquire(timeout=0.1)
+        with pytest.raises(ValueError, match='not leased'):
+            ds9pool.release(pyds9.DS9(d1.target, start=False))
+        ds9pool.release(d2)
+
+        # killed while leased: replaced on return
+        ds9pool._processes[d1.target].kill()
+        ds9pool._processes[d1.target].wait()
+        ds9pool.release(d1)
+        d3 = ds9pool.acquire(timeout=30)
+        d4 = ds9pool.acquire(timeout=30)
+        assert {d3.target, d4.target} == {d2.target, prefix + '2'}
+        ds9pool.release(d3)
+        ds9pool.release(d4)
+
+        # killed while idle
+        process = ds9pool._processes[d2.target]
+        process.kill()
+        process.wait()
+        assert ds9pool.check() == 1
+
+        stats = ds9pool.stats()
+        assert stats['leases'] == 5
+        assert stats['replaced'] == 2
+        assert stats['busy'] == 0
+        assert 0 < stats['utilization'] < 1
+        processes = list(ds9pool._processes.values())
+
+    assert all(p.poll() is not None for p in processes)
+    assert pyds9.ds9_targets(prefix + '*') is None
+    with pytest.raises(ValueError, match='closed'):
+        ds9pool.acquire()
+
+
+def _png_header(png):
+    """Check the signature of a png image, and return the width, height,
+    bit depth and color type from its IHDR chunk"""
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    length, chunk = struct.unpack('>I4s', png[8:16])
+    assert (length, chunk) == (13, b'IHDR')
+    return struct.unpack('>IIBB', png[16:26])
+
+
+def test_render_many(tmpdir):
+    '''render_many renders the inputs on a pool of ds9 instances, and yields
+    the images as they are ready'''
+    gradient = np.arange(1, 65, dtype=np.int32).reshape(8, 8)
+    images = [np.roll(gradient, 9 * i) for i in range(6)]
+    path = tmpdir.join('image.fits').strpath
+    fits.PrimaryHDU(images[5]).writeto(path)
+    settings = {'scale': 'log', 'cmap': 'heat', 'regions': ['circle(2,2,1)']}
+    consumed = []
+
+    def inputs():
+        for i, image in enumerate(images[:5]):
+            consumed.append(i)
+            yield image
+        yield path
+
+    prefix = 'test.render{}.'.format(random.randint(0, 10000))
+    with pool.DS9Pool(2, prefix=prefix) as ds9pool:
+        results = pool.render_many(inputs(), settings, pool=ds9pool,
+                                   max_pending=2)
+        first = next(results)
+        assert len(consumed) <= 3
+        results = [first] + list(results)
+        assert [i for i, _ in results] == list(range(6))
+        for _, png in results:
+            width, height, depth, color = _png_header(png)
+            assert width > 0 and height > 0
+            assert depth == 8 and color in (2, 6)
+        # the images are rendered from their own input
+        assert len(set(png for _, png in results)) == 6
+
+        unordered = list(pool.render_many(images, settings, pool=ds9pool,
+                                          ordered=False))
+        assert sorted(i for i, _ in unordered) == list(range(6))
+        assert dict(unordered) == dict(results)
+        assert ds9pool.stats()['leases'] == 12
+
+        with pytest.raises(ValueError, match='XPA'):
+            list(pool.render_many(images, {'nosuchcommand': 1},
+                                  pool=ds9pool))
+        assert ds9pool.stats()['busy'] == 0
+
+    with pytest.raises(ValueError, match='unknown output'):
+        pool.render_many(images, output='gif')
+
+
+def _parse_regions(text):
+    """Return the (shape, values, properties) of the regions listed by
+    ``regions -format ds9 -system image``"""
+    regions = []
+    for line in text.split('\n'):
+        match = re.match(r'(\w+)\(([^)]*)\)(?:\s*#\s*(.*))?$', line.strip())
+        if match:
+            shape, values, props = match.groups()
+            regions.append((shape, [float(v) for v in values.split(',')],
+                            props or ''))
+    return regions
+
+
+def test_ds9_batch(ds9_obj, monkeypatch):
+    '''The set calls of a batch reach ds9 in a single round trip, and the
+    failed ones are reported at the end'''
+    sets = []
+    xpacall = ds9_obj._xpacall
+
+    def counting_xpacall(func, *args):
+        if func in (pyds9.xpa.xpaset, pyds9.xpa.xpasetfd):
+            sets.append(args[1])
+        return xpacall(func, *args)
+
+    monkeypatch.setattr(ds9_obj, '_xpacall', counting_xpacall)
+    ds9_obj.set('regions delete all')
+    del sets[:]
+    image = np.arange(100 * 120, dtype=np.int16).reshape(100, 120)
+    regions = 'circle(10,11,3) # text={a b}\ncircle(20,22,4)'
+    with ds9_obj.batch() as batch:
+        ds9_obj.set_np2arr(image, transport='xpa')
+        for i in range(1, 18):
+            assert ds9_obj.set('zoom {}'.format(i)) == 1
+        ds9_obj.set('cmap heat')
+        ds9_obj.set('regions', regions)
+        with ds9_obj.batch():
+            ds9_obj.set('pan 10 20')
+        assert ds9_obj.get('zoom') != '17'
+        assert not sets
+    assert len(sets) == 1 and sets[0].startswith(b'source ')
+    assert len(batch.commands) == 21
+    assert batch.errors == []
+    np.testing.assert_array_equal(ds9_obj.get_arr2np(), image)
+    assert ds9_obj.get('zoom') == '17'
+    assert ds9_obj.get('cmap') == 'heat'
+    regions = _parse_regions(ds9_obj.get('regions -format ds9 -system image'))
+    assert [shape for shape, _, _ in regions] == ['circle', 'circle']
+    np.testing.assert_allclose([values for _, values, _ in regions],
+                               [[10, 11, 3], [20, 22, 4]])
+    assert 'text={a b}' in regions[0][2]
+
+    # the errors are reported for each failed command
+    del sets[:]
+    with pytest.raises(ValueError, match='2 of 4 batched commands failed'):
+        with ds9_obj.batch() as batch:
+            ds9_obj.set('cmap grey')
+            ds9_obj.set(INVALID_XPA_METHOD)
+            ds9_obj.set('scale log')
+            ds9_obj.set(INVALID_XPA_METHOD + '2')
+    assert len(sets) == 1 and sets[0].startswith(b'source ')
+    assert [paramlist for paramlist, _ in batch.errors] == [
+        INVALID_XPA_METHOD, INVALID_XPA_METHOD + '2']
+    assert all(message for _, message in batch.errors)
+    assert ds9_obj.get('scale') == 'log'
+
+    # dropped
+    with pytest.raises(RuntimeError):
+        with ds9_obj.batch():
+            ds9_obj.set('cmap cool')
+            raise RuntimeError
+    assert ds9_obj.get('cmap') == 'grey'
+
+    # streamed data cannot be recorded
+    with ds9_obj.batch() as batch:
+        with pytest.raises(ValueError, match='batch'):
+            ds9_obj.set_fits(fits.HDUList([fits.PrimaryHDU(image)]),
+                             stream=True)
+    assert batch.commands == []
+
+    # ds9 on another host: sent one by one
+    monkeypatch.setattr(transport, 'is_local', lambda d: False)
+    del sets[:]
+    with ds9_obj.batch():
+        ds9_obj.set('cmap heat')
+        ds9_obj.set('scale linear')
+    assert sets == [b'cmap heat', b'scale linear']
+    assert ds9_obj.get('scale') == 'linear'
+
+
+@pytest.mark.parametrize('name', ['shm', 'file'])
+def test_ds9_batch_transports(ds9_obj, name):
+    '''The shared memory segments and files of the arrays sent in a batch
+    are kept until the batch has run'''
+    if not transport.transports[name].available():
+        pytest.skip('{} transport not available'.format(name))
+    frame = ds9_obj.get('frame')
+    frames = [np.arange(48, dtype=np.int16).reshape(6, 8) * i
+              for i in range(1, 4)]
+    with ds9_obj.batch() as batch:
+        for arr in frames:
+            ds9_obj.set('frame new')
+            ds9_obj.set_np2arr(arr, transport=name)
+        assert len(batch.resources) == 3
+    assert batch.resources == []
+    try:
+        ds9_obj.set('frame last')
+        for arr in frames[::-1]:
+            np.testing.assert_array_equal(ds9_obj.get_arr2np(), arr)
+            ds9_obj.set('frame prev')
+    finally:
+        for _ in frames:
+            ds9_obj.set('frame last')
+            ds9_obj.set('frame delete')
+        ds9_obj.set('frame ' + frame)
+
+
+def test_ds9_set_regions(ds9_obj, monkeypatch):
+    '''set_regions formats regions from arrays, and streams the large sets
+    of regions'''
+    ds9_obj.set_np2arr(np.zeros((200, 200), dtype=np.int16))
+    ds9_obj.set('regions delete all')
+    assert ds9_obj.set_regions(x=np.array([1.5, -2, 100.25]),
+                               y=[10, 20, 30.0004], r=2,
+                               props={'color': 'red'}) == 1
+    regions = _parse_regions(ds9_obj.get('regions -format ds9 -system image'))
+    assert [shape for shape, _, _ in regions] == ['circle'] * 3
+    np.testing.assert_allclose([values for _, values, _ in regions],
+                               [[1.5, 10, 2], [-2, 20, 2], [100.25, 30, 2]])
+    assert all('color=red' in props for _, _, props in regions)
+
+    ds9_obj.set('regions delete all')
+    monkeypatch.setattr(pyds9, 'REGIONS_CHUNK', 2)
+    streamed = []
+    set_from_writer = ds9_obj._set_from_writer
+
+    def spy(paramlist, writer):
+        streamed.append(paramlist)
+        return set_from_writer(paramlist, writer)
+
+    monkeypatch.setattr(ds9_obj, '_set_from_writer', spy)
+    props = ['text={{{}}}'.format(c) for c in 'abcde']
+    ds9_obj.set_regions('box', props=props, decimals=3,
+                        x=np.arange(5) * 10 + 50.5, y=-30.123456789,
+                        width=1.5, height=2.25)
+    assert streamed == ['regions']
+    regions = _parse_regions(ds9_obj.get('regions -format ds9 -system image'))
+    assert [shape for shape, _, _ in regions] == ['box'] * 5
+    np.testing.assert_allclose(
+        [values for _, values, _ in regions],
+        [[x, -30.123, 1.5, 2.25, 0] for x in np.arange(5) * 10 + 50.5])
+    assert [props for _, _, props in regions] == props
+    ds9_obj.set('regions delete all')
+
+    with pytest.raises(ValueError, match='unknown region shape'):
+        ds9_obj.set_regions('polygon', x=1, y=1)
+    with pytest.raises(ValueError, match='missing circle parameters: r'):
+        ds9_obj.set_regions(x=1, y=1)
+    with pytest.raises(ValueError, match='unknown circle parameters: angle'):
+        ds9_obj.set_regions(x=1, y=1, r=1, angle=45)
+    with pytest.raises(ValueError, match='finite'):
+        ds9_obj.set_regions(x=[1, np.nan], y=1, r=1)
+
+
+def test_region_lines():
+    '''The vectorized formatting of the regions matches the usual one'''
+    values = np.concatenate([[0, -0.0004, 0.5, -0.5, 10, 99.9996, 1e6],
+                             np.random.randn(1000) * 1000])
+    lines = pyds9._region_lines('point', [values, values * 1e-3], None, 3)
+    for line, value in zip(lines.decode().splitlines(), values):
+        shape, x, y = re.match(r'(\w+)\(([^,]+),([^,]+)\)$', line).groups()
+        assert (shape, float(x), float(y)) == (
+            'point', round(value, 3), round(value * 1e-3, 3))
+        assert not x.endswith('.') and not x.startswith('-0.000')
+    assert pyds9._region_lines('circle', [[1.5], [2], [0.25]], None,
+                               0) == b'circle(2,2,0)\n'
+    assert pyds9._region_lines('point', [[1], [2]], np.array([b'color=red']),
+                               0) == b'point(1,2) # color=red\n'
@@ -0,0 +1,325 @@
+"""
+Ways of sending data to ds9: through the xpa socket, a shared memory segment
+or a temporary file, and automatic selection of the fastest one
+"""
+
+import atexit
+import contextlib
+import os
+import socket
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import numpy
+
+from .shm import SharedMemory
+
+__all__ = ['Transport', 'XPATransport', 'ShmTransport', 'FileTransport',
+           'TempFile', 'transports', 'select', 'calibrate', 'is_local']
+
+# payloads smaller than this are always sent through the xpa socket
+AUTO_MIN_BYTES = 1 << 20
+
+# sizes of the arrays sent by calibrate, in bytes
+CALIBRATION_SIZES = (1 << 18, 1 << 23)
+
+
+class Transport(object):
+    """A way of sending data to ds9
+
+    Subclasses implement :meth:`send_array` and :meth:`send_fits`. The
+    resources kept for a given DS9 object (e.g. a shared memory segment) are
+    stored in ``ds9._transport_data[name]`` and released by :meth:`release`.
+    """
+
+    #: name used to select the transport
+    name = None
+    #: whether ds9 must run on the same host
+    local = False
+
+    def available(self):
+        """Whether the transport can be used on this platform"""
+        return True
+
+    def send_array(self, ds9, arr, paramlist):
+        """Send the C-contiguous ``arr`` to ds9
+
+        ``paramlist`` is the ``array [xdim=...]`` command describing it.
+        """
+        raise NotImplementedError
+
+    def send_fits(self, ds9, hdul):
+        """Send the :class:`astropy.io.fits.HDUList` ``hdul`` to ds9"""
+        raise NotImplementedError
+
+    def release(self, ds9):
+        """Release the resources kept for ``ds9``"""
+        data = ds9._transport_data.pop(self.name, None)
+        if data is not None:
+            data.close()
+
+
+class XPATransport(Transport):
+    """Send the data through the xpa socket
+
+    Arrays of :attr:`stream_bytes` bytes or more are streamed to ds9 in
+    chunks of :attr:`chunk_bytes`, rather than sent as a single buffer.
+    """
+
+    name = 'xpa'
+    #: size above which arrays are streamed
+    stream_bytes = 1 << 31
+    #: size of the chunks of streamed arrays
+    chunk_bytes = 1 << 26
+
+    def send_array(self, ds9, arr, paramlist):
+        if arr.nbytes < self.stream_bytes:
+            return ds9.set(paramlist, arr)
+
+        data = memoryview(arr.reshape(-1).view(numpy.uint8))
+
+        def write(f):
+            for start in range(0, len(data), self.chunk_bytes):
+                f.write(data[start:start + self.chunk_bytes])
+
+        ds9._selftest()
+        return ds9._set_from_writer(paramlist, write)
+
+    def send_fits(self, ds9, hdul):
+        return ds9._hdulist_to_ds9_fits(hdul)
+
+
+class ShmTransport(Transport):
+    """Copy the data into a shared memory segment that ds9 loads from
+
+    The segment is reused as long as the payloads have the same size. In a
+    :meth:`DS9.batch`, each payload gets its own segment, kept by the batch
+    until it has run.
+    """
+
+    name = 'shm'
+    local = True
+
+    def available(self):
+        from . import shm
+        return shm.libc is not None
+
+    def _segment(self, ds9, size):
+        batch = ds9._current_batch()
+        if batch is not None:
+            segment = SharedMemory(size)
+            batch.keep(segment)
+            return segment
+        segment = ds9._transport_data.get(self.name)
+        if segment is not None and segment.size != size:
+            self.release(ds9)
+            segment = None
+        if segment is None:
+            segment = SharedMemory(size)
+            ds9._transport_data[self.name] = segment
+        return segment
+
+    def send_array(self, ds9, arr, paramlist):
+        segment = self._segment(ds9, arr.nbytes)
+        segment.asarray(arr.dtype, arr.shape)[...] = arr
+        return ds9.set('shm ' + paramlist.replace(
+            'array ', 'array shmid %d ' % segment.shmid, 1))
+
+    def send_fits(self, ds9, hdul):
+        with contextlib.closing(BytesIO()) as newFitsFile:
+            hdul.writeto(newFitsFile)
+            newfits = newFitsFile.getbuffer()
+            segment = self._segment(ds9, len(newfits))
+            segment.asarray()[:] = newfits
+            del newfits
+        return ds9.set('shm fits shmid %d' % segment.shmid)
+
+
+class TempFile(object):
+    """A temporary file, removed when its last reference is released
+
+    The file is created with one reference. Files still existing at exit are
+    removed, by the process that created them only.
+    """
+
+    _lock = threading.Lock()
+    _alive = set()
+
+    def __init__(self, suffix='', dir=None):
+        fd, self.path = tempfile.mkstemp(suffix=suffix, prefix='pyds9-',
+                                         dir=dir)
+        os.close(fd)
+        self._pid = os.getpid()
+        self._refs = 1
+        with self._lock:
+            self._alive.add(self)
+
+    def incref(self):
+        """Add a reference to the file"""
+        with self._lock:
+            if not self._refs:
+                raise ValueError('%s has already been removed' % self.path)
+            self._refs += 1
+        return self
+
+    def decref(self):
+        """Release a reference to the file, removing it if it was the last"""
+        with self._lock:
+            self._refs -= 1
+            if self._refs:
+                return
+            self._alive.discard(self)
+        if self._pid != os.getpid():
+            # a forked child: the file is still used by the parent
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    # so that it can be kept in _transport_data
+    close = decref
+
+    @classmethod
+    def _cleanup(cls):
+        for tmp in list(cls._alive):
+            tmp._refs = 1
+            tmp.decref()
+
+
+atexit.register(TempFile._cleanup)
+
+
+class FileTransport(Transport):
+    """Write the data to a temporary file, in memory (``/dev/shm``) if
+    possible, and tell ds9 to load it
+
+    The file displayed by ds9 is kept until the next one is sent, or the DS9
+    object is closed. In a :meth:`DS9.batch`, the batch also keeps each file
+    until it has run.
+    """
+
+    name = 'file'
+    local = True
+
+    def __init__(self, dir=None):
+        if dir is None and os.access('/dev/shm', os.W_OK):
+            dir = '/dev/shm'
+        self.dir = dir
+
+    def _send(self, ds9, suffix, write, paramlist):
+        tmp = TempFile(suffix=suffix, dir=self.dir)
+        try:
+            write(tmp.path)
+            success = ds9.set(paramlist.format(path=tmp.path))
+        except Exception:
+            tmp.decref()
+            raise
+        batch = ds9._current_batch()
+        if batch is not None:
+            batch.keep(tmp.incref())
+        self.release(ds9)
+        ds9._transport_data[self.name] = tmp
+        return success
+
+    def send_array(self, ds9, arr, paramlist):
+        return self._send(ds9, '.arr', arr.tofile,
+                          paramlist.replace('array ', 'array {path}', 1))
+
+    def send_fits(self, ds9, hdul):
+        return self._send(ds9, '.fits', hdul.writeto, 'file {path}')
+
+
+#: transports available by name
+transports = {t.name: t for t in (XPATransport(), ShmTransport(),
+                                  FileTransport())}
+
+# results of calibrate: transport name => (seconds, seconds per byte)
+_calibration = {}
+_calibration_lock = threading.Lock()
+
+# is_local results, by ds9 id
+_local_ids = {}
+
+
+def is_local(ds9):
+    """Whether ds9 runs on this host, judging from its xpa id"""
+    if ds9.method in ('local', 'unix'):
+        return True
+    if ds9.id not in _local_ids:
+        try:
+            ip = socket.inet_ntoa(bytes.fromhex(ds9.id.split(':')[0]))
+        except (ValueError, OSError):
+            _local_ids[ds9.id] = False
+        else:
+            try:
+                addresses = socket.gethostbyname_ex(socket.gethostname())[2]
+            except OSError:
+                addresses = []
+            _local_ids[ds9.id] = ip.startswith('127.') or ip in addresses
+    return _local_ids[ds9.id]
+
+
+def calibrate(ds9, force=False):
+    """Measure the cost of sending data to ds9 with each local transport
+
+    Arrays of a few sizes are sent to a new frame, which is deleted
+    afterwards. The results are cached, and reused by all the following
+    automatic selections, unless ``force`` is True.
+
+    Returns
+    -------
+    dict
+        transport name => (fixed cost in seconds, seconds per byte)
+    """
+    with _calibration_lock:
+        if _calibration and not force:
+            return dict(_calibration)
+        frame = ds9.get('frame')
+        ds9.set('frame new')
+        try:
+            for t in transports.values():
+                if t.local and not t.available():
+                    continue
+                times = []
+                for size in CALIBRATION_SIZES:
+                    arr = numpy.zeros((size // 4096, 1024), numpy.float32)
+                    paramlist = ('array [xdim=1024,ydim=%d,bitpix=-32]' %
+                                 arr.shape[0])
+                    start = time.perf_counter()
+                    t.send_array(ds9, arr, paramlist)
+                    times.append(time.perf_counter() - start)
+                t.release(ds9)
+                per_byte = ((times[1] - times[0]) /
+                            (CALIBRATION_SIZES[1] - CALIBRATION_SIZES[0]))
+                per_byte = max(per_byte, 0)
+                _calibration[t.name] = (times[0] - per_byte *
+                                        CALIBRATION_SIZES[0], per_byte)
+        finally:
+            ds9.set('frame delete')
+            ds9.set('frame %s' % frame)
+        return dict(_calibration)
+
+
+def select(ds9, name, nbytes):
+    """Return the transport called ``name``, or the fastest one to send
+    ``nbytes`` bytes to ``ds9`` if ``name`` is ``'auto'``
+
+    Small payloads and ds9 instances on other hosts always use the xpa
+    socket; otherwise the choice is based on :func:`calibrate`, except in a
+    :meth:`DS9.batch`, where the commands of the calibration cannot run and
+    the file transport is used.
+    """
+    if name == 'auto':
+        if nbytes < AUTO_MIN_BYTES or not is_local(ds9):
+            return transports['xpa']
+        if ds9._current_batch() is not None:
+            return transports['file']
+        costs = calibrate(ds9)
+        name = min(costs, key=lambda n: costs[n][0] + costs[n][1] * nbytes)
+    try:
+        return transports[name]
+    except KeyError:
+        raise ValueError('unknown transport: %s' % name)
@@ -2,10 +2,15 @@
 python support for XPA client access
 """
 
+import collections
+import contextlib
 import glob
 import os
 import platform
+import shutil
 import sys
+import tempfile
+import threading
 import ctypes
 import ctypes.util
 
@@ -28,6 +33,7 @@ if _libpath:
         libc = ctypes.cdll.msvcrt
     else:
         libc = ctypes.cdll.LoadLibrary(None)
+    libc.free.argtypes = [ctypes.c_void_p]
 else:
     raise ImportError("can't find XPA shared library")
 
@@ -35,81 +41,318 @@ else:
 c_byte_p = ctypes.POINTER(ctypes.c_byte)
 
 
-# free C buffers returned by xpa calls
+# free the C buffers returned by xpa calls in the first len_ entries
 def _freebufs(p_arr, len_):
     for i in range(len_):
         if p_arr[i]:
             libc.free(p_arr[i])
+            p_arr[i] = None
+
+
+# access the memory of python objects supporting the buffer protocol
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [('buf', ctypes.c_void_p),
+                ('obj', ctypes.c_void_p),
+                ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t),
+                ('readonly', ctypes.c_int),
+                ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p),
+                ('shape', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('strides', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('suboffsets', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('internal', ctypes.c_void_p)]
+
+
+# PyBUF_C_CONTIGUOUS from Python's buffer.h
+_PyBUF_C_CONTIGUOUS = 0x0038
+
+_PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_PyObject_GetBuffer.restype = ctypes.c_int
+_PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+                                ctypes.c_int]
+_PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+_PyBuffer_Release.restype = None
+_PyBuffer_Release.argtypes = [ctypes.POINTER(_Py_buffer)]
+
+
+@contextlib.contextmanager
+def _buffer(obj):
+    """Yield the address and size in bytes of the memory of ``obj``
+
+    ``obj`` can be any C-contiguous object supporting the buffer protocol
+    (bytes, numpy.ndarray, array.array, memoryview, mmap, ...). The memory is
+    not copied and the object is locked (e.g. it cannot be resized) until the
+    context exits.
+    """
+    view = _Py_buffer()
+    _PyObject_GetBuffer(obj, ctypes.byref(view), _PyBUF_C_CONTIGUOUS)
+    try:
+        yield view.buf, view.len
+    finally:
+        _PyBuffer_Release(ctypes.byref(view))
+
+
+# the argument types are bound once: the arrays passed to (and filled by)
+# libxpa are declared as pointers, so that arrays of any length are accepted
+c_byte_pp = ctypes.POINTER(c_byte_p)
+
+
+def _bind(dll):
+    """Declare the argument and return types of the functions of ``dll``, a
+    copy of libxpa"""
+
+    ## XPA XPAOpen(char *mode);
+    dll.XPAOpen.restype = ctypes.c_void_p
+    dll.XPAOpen.argtypes = [ctypes.c_char_p]
+
+    ## void XPAClose(XPA xpa);
+    dll.XPAClose.argtypes = [ctypes.c_void_p]
+
+    ## int XPAGet(XPA xpa, char *template, char *paramlist, char *mode,
+    ##            char **bufs, size_t *lens, char **names, char **messages,
+    ##            int n);
+    dll.XPAGet.restype = ctypes.c_int
+    dll.XPAGet.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                           ctypes.c_char_p, ctypes.c_char_p,
+                           c_byte_pp, ctypes.POINTER(ctypes.c_size_t),
+                           c_byte_pp, c_byte_pp,
+                           ctypes.c_int]
+
+    ## int XPAGetFd(XPA xpa, char *template, char *paramlist, char *mode,
+    ##              int *fds, char **names, char **messages, int n);
+    dll.XPAGetFd.restype = ctypes.c_int
+    dll.XPAGetFd.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                             ctypes.c_char_p, ctypes.c_char_p,
+                             ctypes.POINTER(ctypes.c_int),
+                             c_byte_pp, c_byte_pp,
+                             ctypes.c_int]
+
+    ## int XPASet(XPA xpa,
+    ##             char *template, char *paramlist, char *mode,
+    ##             char *buf, size_t len, char **names, char **messages,
+    ##             int n);
+    dll.XPASet.restype = ctypes.c_int
+    dll.XPASet.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                           ctypes.c_char_p, ctypes.c_char_p,
+                           ctypes.c_void_p, ctypes.c_size_t,
+                           c_byte_pp, c_byte_pp,
+                           ctypes.c_int]
+
+    ## int XPASetFd(XPA xpa, char *template, char *paramlist, char *mode,
+    ##              int fd, char **names, char **messages, int n);
+    dll.XPASetFd.restype = ctypes.c_int
+    dll.XPASetFd.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                             ctypes.c_char_p, ctypes.c_char_p,
+                             ctypes.c_int,
+                             c_byte_pp, c_byte_pp,
+                             ctypes.c_int]
+
+    ## int XPAInfo(XPA xpa,
+    ##              char *template, char *paramlist, char *mode,
+    ##              char **names, char **messages, int n);
+    dll.XPAInfo.restype = ctypes.c_int
+    dll.XPAInfo.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                            ctypes.c_char_p, ctypes.c_char_p,
+                            c_byte_pp, c_byte_pp,
+                            ctypes.c_int]
+
+    ## int XPAAccess(XPA xpa,
+    ##              char *template, char *paramlist, char *mode,
+    ##              char **names, char **messages, int n);
+    dll.XPAAccess.restype = ctypes.c_int
+    dll.XPAAccess.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                              ctypes.c_char_p, ctypes.c_char_p,
+                              c_byte_pp, c_byte_pp,
+                              ctypes.c_int]
+
+
+_bind(libxpa)
+XPAGet = libxpa.XPAGet
+XPAGetFd = libxpa.XPAGetFd
+XPASet = libxpa.XPASet
+XPASetFd = libxpa.XPASetFd
+XPAInfo = libxpa.XPAInfo
+XPAAccess = libxpa.XPAAccess
+
+
+# libxpa is not reentrant: the client handles, the id of the current
+# command, the error messages, the connections to the name server, ... are
+# kept in globals, which are used from the start to the end of each call
+# (while waiting for the access points). The calls into the library are
+# serialized, but each persistent handle returned by XPAOpen gets a copy of
+# the library of its own, with its own globals and lock: calls through
+# different handles, e.g. to different ds9 instances, run in parallel, and
+# an access point that does not answer only holds up the calls made through
+# the same handle. The functions of this module can be used from any thread.
+
+# most copies of libxpa loaded for the persistent handles: beyond that, the
+# handles share the least used copies
+MAX_LIBRARIES = 32
+
+
+class _Library(object):
+    """A copy of libxpa, and the lock serializing the calls into it
+
+    Using the object as a context manager holds the lock. The handles
+    closed while the lock was held are closed when it is released (see
+    :func:`XPAClose`).
+    """
+
+    def __init__(self, dll):
+        self.dll = dll
+        self.lock = threading.Lock()
+        # number of open handles using this copy (only used to spread the
+        # handles over the copies), and handles to close
+        self.handles = 0
+        self.closing = collections.deque()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self.dll
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """Close the queued handles, and release the lock"""
+        while True:
+            try:
+                while self.closing:
+                    self.dll.XPAClose(self.closing.popleft())
+                    self.handles -= 1
+            finally:
+                self.lock.release()
+            # a handle queued while we were releasing the lock
+            if not self.closing or not self.lock.acquire(blocking=False):
+                return
+
+
+class _Handle(object):
+    """A persistent connection: the XPA record returned by XPAOpen, and the
+    copy of libxpa it belongs to"""
+
+    def __init__(self, library, ptr):
+        self.library = library
+        self.ptr = ptr
+
+
+def _load_copy():
+    """Load a new copy of libxpa, or return None if it cannot be done
+
+    The dynamic loader loads a library only once per path, so the shared
+    library is copied to a temporary file, removed once loaded.
+    """
+    fd, path = tempfile.mkstemp(prefix='pyds9-',
+                                suffix=os.path.basename(_libpath))
+    try:
+        with os.fdopen(fd, 'wb') as f, open(_libpath, 'rb') as lib:
+            shutil.copyfileobj(lib, f)
+        dll = ctypes.cdll.LoadLibrary(path)
+    except OSError:
+        return None
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            # e.g. a loaded library cannot be removed on Windows
+            pass
+    _bind(dll)
+    return dll
+
+
+# the copy of libxpa used for temporary connections comes first
+_libraries = [_Library(libxpa)]
+_libraries_lock = threading.Lock()
+
+
+def _new_library():
+    """Return the copy of libxpa to use for a new handle: an unused one, a
+    new one if less than MAX_LIBRARIES are loaded, or the least used one"""
+    with _libraries_lock:
+        library = min(_libraries[1:], key=lambda lib: lib.handles,
+                      default=None)
+        if library is None or (library.handles and
+                               len(_libraries) <= MAX_LIBRARIES):
+            dll = _load_copy()
+            if dll is not None:
+                library = _Library(dll)
+                _libraries.append(library)
+            elif library is None:
+                library = _libraries[0]
+        library.handles += 1
+        return library
+
+
+def _library(xpa):
+    """Return the copy of libxpa to call with the handle ``xpa``, and the
+    XPA record to pass it (None for a temporary connection)"""
+    if xpa is None:
+        return _libraries[0], None
+    return xpa.library, xpa.ptr
+
+
+def _after_fork():
+    """Give the child process fresh locks, in case another thread of the
+    parent was in a call when it forked"""
+    global _libraries_lock
+    _libraries_lock = threading.Lock()
+    for library in _libraries:
+        library.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
 
 
-## XPA XPAOpen(char *mode);
-libxpa.XPAOpen.restype = ctypes.c_void_p
-libxpa.XPAOpen.argtypes = [ctypes.c_char_p]
 def XPAOpen(mode):
-    return libxpa.XPAOpen(mode)
+    library = _new_library()
+    with library as dll:
+        ptr = dll.XPAOpen(mode)
+    return _Handle(library, ptr)
 
 
-## void XPAClose(XPA xpa);
-libxpa.XPAClose.argtypes = [ctypes.c_void_p]
 def XPAClose(xpa):
-    libxpa.XPAClose(xpa)
+    # the handle is closed by whoever holds the lock of its library when it
+    # is released: XPAClose never waits for another call, so that it can be
+    # called from a finalizer (e.g. DS9.__del__) run by the garbage
+    # collector in the middle of a call
+    library = xpa.library
+    library.closing.append(xpa.ptr)
+    if library.lock.acquire(blocking=False):
+        library.release()
 
+# default value for n (max number of access points)
+xpa_n = 1024
 
-## int XPAGet(XPA xpa, char *template, char *paramlist, char *mode,
-##            char **bufs, int *lens, char **names, char **messages, int n);
-libxpa.XPAGet.restype = ctypes.c_int
-def XPAGet(xpa, target, paramlist, mode, bufs, lens, names, messages, n):
-    libxpa.XPAGet.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
-                              ctypes.c_char_p, ctypes.c_char_p,
-                              c_byte_p*n, ctypes.c_int*n,
-                              c_byte_p*n, c_byte_p*n,
-                              ctypes.c_int]
-    return libxpa.XPAGet(xpa, target, paramlist, mode,
-                         bufs, lens, names, messages, n)
+# The xpa* routines below accept an optional ``xpa`` handle returned by
+# XPAOpen. When it is None, libxpa opens (and tears down) a temporary
+# connection for each call; a persistent handle keeps the connection to the
+# access point alive between calls.
 
 
-## int XPASet(XPA xpa,
-##             char *template, char *paramlist, char *mode,
-##             char *buf, int len, char **names, char **messages,
-##             int n);
-XPASet = libxpa.XPASet
-libxpa.XPASet.restype = ctypes.c_int
-def XPASet(xpa, target, paramlist, mode, buf, blen, names, messages, n):
-    libxpa.XPASet.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
-                              ctypes.c_char_p, ctypes.c_char_p,
-                              ctypes.c_char_p, ctypes.c_int,
-                              c_byte_p*n, c_byte_p*n,
-                              ctypes.c_int]
-    return libxpa.XPASet(xpa, target, paramlist, mode,
-                         buf, blen, names, messages, n)
+class _ScratchPool(threading.local):
+    """Arrays filled by libxpa, one set per ``n`` and per thread"""
 
+    def __init__(self):
+        self.arrays = {}
 
-## int XPAInfo(XPA xpa,
-##              char *template, char *paramlist, char *mode,
-##              char **names, char **messages, int n);
-XPAInfo = libxpa.XPAInfo
-libxpa.XPAInfo.restype = ctypes.c_int
-def XPAInfo(xpa, target, paramlist, mode, names, messages, n):
-    libxpa.XPAInfo.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
-                               ctypes.c_char_p, ctypes.c_char_p,
-                               c_byte_p*n, c_byte_p*n,
-                               ctypes.c_int]
-    return libxpa.XPAInfo(xpa, target, paramlist, mode, names, messages, n)
-
-
-## int XPAAccess(XPA xpa,
-##              char *template, char *paramlist, char *mode,
-##              char **names, char **messages, int n);
-libxpa.XPAAccess.restype = ctypes.c_int
-def XPAAccess(xpa, target, paramlist, mode, names, messages, n):
-    libxpa.XPAAccess.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
-                                 ctypes.c_char_p, ctypes.c_char_p,
-                                 c_byte_p*n, c_byte_p*n,
-                                 ctypes.c_int]
-    return libxpa.XPAAccess(xpa, target, paramlist, mode, names, messages, n)
+_scratch_pool = _ScratchPool()
 
-# default value for n (max number of access points)
-xpa_n = 1024
+
+def _scratch(n):
+    """Return the (bufs, lens, names, errs) arrays for up to n access points
+
+    The arrays are reused by the following calls in the same thread: libxpa
+    zeroes them at the start of each call, and the entries it fills are
+    released with _freebufs before returning.
+    """
+    arrays = _scratch_pool.arrays.get(n)
+    if arrays is None:
+        buf_t = c_byte_p*n
+        arrays = (buf_t(), (ctypes.c_size_t*n)(), buf_t(), buf_t())
+        _scratch_pool.arrays[n] = arrays
+    return arrays
 
 
 def to_string(buf, size=-1, strip=True):
@@ -122,77 +365,232 @@ def to_string(buf, size=-1, strip=True):
     return s
 
 
-def xpaget(target, plist=None, n=xpa_n):
-    buf_t = c_byte_p*n
-    bufs = buf_t()
-    names = buf_t()
-    errs = buf_t()
-    int_t = ctypes.c_int*n
-    lens = int_t()
+class XPABuffer(object):
+    """Data returned by XPAGet, in the memory allocated by libxpa
+
+    The memory is freed when the object is garbage collected. It can be
+    wrapped without copies into a (writable) numpy array, which keeps the
+    buffer alive::
+
+        >>> arr = numpy.asarray(xpabuf)  # 1D array of uint8
+    """
+
+    def __init__(self, ptr, size):
+        self._ptr = ptr
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __del__(self):
+        if self._ptr:
+            libc.free(self._ptr)
+            self._ptr = None
+
+    @property
+    def __array_interface__(self):
+        return {'version': 3, 'shape': (self._size,), 'typestr': '|u1',
+                'data': (self._ptr, False)}
+
+    def tobytes(self):
+        """Return a copy of the data as bytes"""
+        return ctypes.string_at(self._ptr, self._size)
+
+
+def xpaget(target, plist=None, n=xpa_n, xpa=None):
+    buf = xpagetbuf(target, plist, n, xpa)
+    if buf is not None:
+        buf = [b.tobytes() for b in buf]
+    return buf
+
+
+def xpagetbuf(target, plist=None, n=xpa_n, xpa=None):
+    """Like xpaget, but return the data as a list of :class:`XPABuffer`"""
+    bufs, lens, names, errs = _scratch(n)
     errmsg = ''
-    got = XPAGet(None, target, plist, None, bufs, lens, names, errs, n)
+    library, ptr = _library(xpa)
+    with library as dll:
+        got = dll.XPAGet(ptr, target, plist, None, bufs, lens, names, errs,
+                         n)
     if got:
         buf = []
         for i in range(got):
             if lens[i]:
-                cur = ctypes.string_at(bufs[i], lens[i])
-                buf.append(cur)
+                # the XPABuffer owns (and eventually frees) the memory
+                buf.append(XPABuffer(ctypes.addressof(bufs[i].contents),
+                                     lens[i]))
+                bufs[i] = None
         for i in range(got):
             if errs[i]:
                 errmsg += to_string(errs[i]) + '\n'
     else:
         buf = None
-    _freebufs(bufs, n)
-    _freebufs(names, n)
-    _freebufs(errs, n)
+    _freebufs(bufs, got)
+    _freebufs(names, got)
+    _freebufs(errs, got)
     if errmsg:
         raise ValueError(errmsg)
     return buf
 
 
-def xpaset(target, plist=None, buf=None, blen=-1, n=xpa_n):
-    if blen < 0:
-        if buf is not None:
-            blen = len(buf)
+def xpagetall(target, plist=None, n=xpa_n, xpa=None):
+    """Like xpaget, but report the reply of each target instead of raising
+
+    Returns a list of ``(name, data, error)`` tuples, one per target:
+    ``name`` is the "class:name method" of the access point, ``data`` the
+    bytes it returned (None on error) and ``error`` its error message (None
+    on success).
+    """
+    bufs, lens, names, errs = _scratch(n)
+    library, ptr = _library(xpa)
+    with library as dll:
+        got = dll.XPAGet(ptr, target, plist, None, bufs, lens, names, errs,
+                         n)
+    replies = []
+    for i, (name, err) in enumerate(_replies(got, names, errs)):
+        if err is not None:
+            data = None
+        elif lens[i]:
+            data = ctypes.string_at(bufs[i], lens[i])
         else:
-            blen = 0
-    buf_t = c_byte_p*n
-    names = buf_t()
-    errs = buf_t()
+            data = b''
+        replies.append((name, data, err))
+    _freebufs(bufs, got)
+    _freebufs(names, got)
+    _freebufs(errs, got)
+    return replies
+
+
+def xpagetfd(target, plist=None, fds=None, n=xpa_n, xpa=None):
+    """Like xpaget, but write the data to the file descriptors ``fds``
+
+    The data are streamed as they arrive, without being held in memory. If
+    ``n`` is negative, the replies of up to ``-n`` targets are all written to
+    ``fds[0]``. Returns the number of targets processed.
+    """
+    if n < 0:
+        fds = fds[:1]
+    fd_t = ctypes.c_int*len(fds)
+    _, _, names, errs = _scratch(abs(n))
+    errmsg = ''
+    library, ptr = _library(xpa)
+    with library as dll:
+        got = dll.XPAGetFd(ptr, target, plist, None, fd_t(*fds), names,
+                           errs, n)
+    for i in range(got):
+        if errs[i]:
+            errmsg += to_string(errs[i]) + '\n'
+    _freebufs(names, got)
+    _freebufs(errs, got)
+    if errmsg:
+        raise ValueError(errmsg)
+    return got
+
+
+def xpaset(target, plist=None, buf=None, blen=-1, n=xpa_n, xpa=None):
+    # buf is sent straight from its own memory: see _buffer
+    if buf is None:
+        return _xpaset(target, plist, None, 0, n, xpa)
+    with _buffer(buf) as (ptr, size):
+        if blen < 0 or blen > size:
+            blen = size
+        return _xpaset(target, plist, ptr, blen, n, xpa)
+
+
+def _xpaset(target, plist, ptr, blen, n, xpa):
+    replies = _xpaset_replies(target, plist, ptr, blen, n, xpa)
+    errmsg = ''.join(err + '\n' for _, err in replies if err)
+    if errmsg:
+        raise ValueError(errmsg)
+    return len(replies)
+
+
+def xpasetall(target, plist=None, buf=None, blen=-1, n=xpa_n, xpa=None):
+    """Like xpaset, but report the outcome for each target instead of raising
+
+    The buffer is sent once to all the (up to ``n``) access points matching
+    the template. Returns a list of ``(name, error)`` tuples, one per target,
+    where ``name`` is the "class:name method" of the access point and
+    ``error`` is its error message, or None on success.
+    """
+    if buf is None:
+        return _xpaset_replies(target, plist, None, 0, n, xpa)
+    with _buffer(buf) as (ptr, size):
+        if blen < 0 or blen > size:
+            blen = size
+        return _xpaset_replies(target, plist, ptr, blen, n, xpa)
+
+
+def _xpaset_replies(target, plist, ptr, blen, n, xpa):
+    _, _, names, errs = _scratch(n)
+    library, record = _library(xpa)
+    with library as dll:
+        got = dll.XPASet(record, target, plist, None, ptr, blen, names, errs,
+                         n)
+    replies = _replies(got, names, errs)
+    _freebufs(names, got)
+    _freebufs(errs, got)
+    return replies
+
+
+def _replies(got, names, errs):
+    """Pair the name of each replying access point with its error message"""
+    replies = []
+    for i in range(got):
+        name = to_string(names[i]) if names[i] else ''
+        err = to_string(errs[i]) if errs[i] else None
+        replies.append((name, err))
+    return replies
+
+
+def xpasetfd(target, plist=None, fd=-1, n=xpa_n, xpa=None):
+    """Like xpaset, but send the data read from the file descriptor ``fd``
+
+    The data are read and sent in chunks until the end of file, so they are
+    never held in memory at once. Returns the number of targets processed.
+
+    A temporary connection is always used: libxpa never clears the mode of
+    the clients of a persistent connection, so that after an
+    :func:`xpaset` they would send the previous buffer instead of the data
+    of ``fd``.
+    """
+    _, _, names, errs = _scratch(n)
     errmsg = ''
-    got = XPASet(None, target, plist, None, buf, blen, names, errs, n)
+    library, _ = _library(xpa)
+    with library as dll:
+        got = dll.XPASetFd(None, target, plist, None, fd, names, errs, n)
     for i in range(got):
         if errs[i]:
             errmsg += to_string(errs[i]) + '\n'
-    _freebufs(names, n)
-    _freebufs(errs, n)
+    _freebufs(names, got)
+    _freebufs(errs, got)
     if errmsg:
         raise ValueError(errmsg)
     return got
 
 
-def xpainfo(target, plist=None, n=xpa_n):
-    buf_t = c_byte_p*n
-    names = buf_t()
-    errs = buf_t()
+def xpainfo(target, plist=None, n=xpa_n, xpa=None):
+    _, _, names, errs = _scratch(n)
     errmsg = ''
-    got = XPAInfo(None, target, plist, None, names, errs, n)
+    library, ptr = _library(xpa)
+    with library as dll:
+        got = dll.XPAInfo(ptr, target, plist, None, names, errs, n)
     for i in range(got):
         if errs[i]:
             errmsg += to_string(errs[i]) + '\n'
-    _freebufs(names, n)
-    _freebufs(errs, n)
+    _freebufs(names, got)
+    _freebufs(errs, got)
     if errmsg:
         raise ValueError(errmsg)
     return got
 
 
-def xpaaccess(target, plist=None, n=xpa_n):
-    buf_t = c_byte_p*n
-    names = buf_t()
-    errs = buf_t()
+def xpaaccess(target, plist=None, n=xpa_n, xpa=None):
+    _, _, names, errs = _scratch(n)
     errmsg = ''
-    got = XPAAccess(None, target, plist, None, names, errs, n)
+    library, ptr = _library(xpa)
+    with library as dll:
+        got = dll.XPAAccess(ptr, target, plist, None, names, errs, n)
     if got:
         buf = []
         for i in range(got):
@@ -203,8 +601,8 @@ def xpaaccess(target, plist=None, n=xpa_n):
                 errmsg += to_string(errs[i]) + '\n'
     else:
         buf = None
-    _freebufs(names, n)
-    _freebufs(errs, n)
+    _freebufs(names, got)
+    _freebufs(errs, got)
     if errmsg:
         raise ValueError(errmsg)
     return buf